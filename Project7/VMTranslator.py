@@ -1,6 +1,8 @@
 import os
 
 COMMENT = '//'
+# largest segment index popped into by stepping A instead of going through R14
+STEP_LIMIT = 7
 
 class Parser(object):
     def __init__(self, vm_file):
@@ -52,13 +54,19 @@ class Parser(object):
         return line == '' or line[:2] == COMMENT
 
 class CodeWriter(object):
-    def __init__(self, asm_file):
+    def __init__(self, asm_file, cache_top=False):
         self.asm = open(asm_file, 'w')
         self.bool_count = 0
         self.addresses = self.address_dict()
         self.curr_file = asm_file.replace('.asm', '').split('\\')[-1]
+        # keep the top of the stack in D between commands
+        self.cache_top = cache_top
+        self.top_in_D = False
 
     def write_push_pop(self, operation, segment, num):
+        if self.cache_top:
+            self.write_cached_push_pop(operation, segment, num)
+            return
         self.resolve_address(segment, num)
         if operation == 'push':
             if segment == 'constant':
@@ -78,6 +86,48 @@ class CodeWriter(object):
         else:
             print('error!\n')
     
+    def write_cached_push_pop(self, operation, segment, num):
+        if operation == 'push':
+            self.spill()
+            if segment == 'constant' and num in ['0', '1']:
+                self.write('D=' + num)
+            else:
+                self.resolve_address(segment, num)
+                self.write('D=A' if segment == 'constant' else 'D=M')
+            self.top_in_D = True
+        elif operation == 'pop':
+            self.load_top()
+            self.top_in_D = False
+            self.store_D(segment, num)
+        else:
+            print('error!\n')
+
+    def store_D(self, segment, num):
+        '''
+        pop the cached top into segment[num] without touching the stack
+        '''
+        address = self.addresses.get(segment)
+        if segment in ['local', 'argument', 'this', 'that'] and int(num) <= STEP_LIMIT:
+            self.write('@' + address)
+            self.write('A=M')
+            for x in range(int(num)):
+                self.write('A=A+1')
+        elif segment in ['local', 'argument', 'this', 'that']:
+            # D = value + address, A = D - value, D = D - A
+            self.write('@R14')
+            self.write('M=D')
+            self.write('@' + address)
+            self.write('D=M')
+            self.write('@' + num)
+            self.write('D=D+A')
+            self.write('@R14')
+            self.write('D=D+M')
+            self.write('A=D-M')
+            self.write('D=D-A')
+        else:
+            self.resolve_address(segment, num)
+        self.write('M=D')
+
     def resolve_address(self, segment, num):
         address = self.addresses.get(segment)
         if segment == 'constant':
@@ -96,6 +146,9 @@ class CodeWriter(object):
         '''
         and, or, sub, add, neg, not, eq, lt, gt 
         '''
+        if self.cache_top:
+            self.write_cached_arithmetic(operation)
+            return
         if operation not in ['neg', 'not']:
             self.pop_from_stack()
             self.write('D=M')
@@ -137,6 +190,36 @@ class CodeWriter(object):
 
         self.increase_SP()
 
+    def write_cached_arithmetic(self, operation):
+        self.load_top()
+        if operation == 'neg':
+            self.write('D=-D')
+            return
+        elif operation == 'not':
+            self.write('D=!D')
+            return
+        self.write('@SP')
+        self.write('AM=M-1')
+        if operation in ['eq', 'lt', 'gt']:
+            self.write('D=M-D')
+            self.write('@BOOL{}'.format(self.bool_count))
+            self.write('D;J' + operation.upper())
+            self.write('D=0')
+            self.write('@ENDBOOL{}'.format(self.bool_count))
+            self.write('0;JMP')
+            self.write('(BOOL{})'.format(self.bool_count))
+            self.write('D=-1')
+            self.write('(ENDBOOL{})'.format(self.bool_count))
+            self.bool_count += 1
+        elif operation == 'add':
+            self.write('D=D+M')
+        elif operation == 'or':
+            self.write('D=D|M')
+        elif operation == 'sub':
+            self.write('D=M-D')
+        elif operation == 'and':
+            self.write('D=D&M')
+
     def address_dict(self):
         return {
             'local': 'LCL', # R1
@@ -166,6 +249,21 @@ class CodeWriter(object):
         self.decrease_SP()
         self.write('A=M')
     
+    def spill(self):
+        '''
+        write a cached top back to the stack before code that expects it there
+        '''
+        if self.top_in_D:
+            self.top_in_D = False
+            self.push_D_to_stack()
+
+    def load_top(self):
+        if not self.top_in_D:
+            self.write('@SP')
+            self.write('AM=M-1')
+            self.write('D=M')
+            self.top_in_D = True
+
     def call_SP(self):
         self.write('@SP')
         self.write('A=M')
@@ -173,10 +271,14 @@ class CodeWriter(object):
     def write(self, command):
         self.asm.write(command + '\n')
 
+    def close(self):
+        self.spill()
+        self.asm.close()
+
 class Main(object):
-    def __init__(self, file_path):
+    def __init__(self, file_path, cache_top=False):
         parser = Parser(file_path)
-        self.cw = CodeWriter(parser.asm_file)
+        self.cw = CodeWriter(parser.asm_file, cache_top=cache_top)
 
         while parser.has_next_instruction:
             parser.next()
@@ -185,8 +287,13 @@ class Main(object):
                 self.cw.write_push_pop(parser.curr_instruction[0], parser.curr_instruction[1], parser.curr_instruction[2])
             elif parser.command_type == 'C_ARITHMETIC':
                 self.cw.write_arithmetic(parser.curr_instruction[0])
+        self.cw.close()
 
 if __name__ == '__main__':
-    import sys
-    file_path = sys.argv[1]
-    Main(file_path)
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Translate VM code into Hack assembly')
+    arg_parser.add_argument('file_path', help='a .vm file')
+    arg_parser.add_argument('--cache-top', action='store_true',
+                            help='keep the top of the stack in D, writing it back only at the end')
+    args = arg_parser.parse_args()
+    Main(args.file_path, cache_top=args.cache_top)
@@ -0,0 +1,179 @@
+import sys
+from array import array
+from itertools import permutations
+
+COMMENT = '//'
+
+def comp_dict():
+    comp = {
+        '0': 0b0101010,
+        '1': 0b0111111,
+        '-1': 0b0111010,
+        'D': 0b0001100,
+        'A': 0b0110000,
+        '!D': 0b0001101,
+        '!A': 0b0110001,
+        '-D': 0b0001111,
+        '-A': 0b0110011,
+        'D+1': 0b0011111,
+        'A+1': 0b0110111,
+        'D-1': 0b0001110,
+        'A-1': 0b0110010,
+        'D+A': 0b0000010,
+        'D-A': 0b0010011,
+        'A-D': 0b0000111,
+        'D&A': 0b0000000,
+        'D|A': 0b0010101,
+    }
+    # the commuted spellings, e.g. A+D, 1+D
+    for mnemonic, bits in list(comp.items()):
+        for op in '+&|':
+            if op in mnemonic:
+                left, right = mnemonic.split(op)
+                comp.setdefault(right + op + left, bits)
+    # the a=1 forms read M where the a=0 forms read A
+    for mnemonic, bits in list(comp.items()):
+        if 'A' in mnemonic:
+            comp[mnemonic.replace('A', 'M')] = bits | 0b1000000
+    return comp
+
+def dest_dict():
+    dest = {'': 0}
+    for bits in range(1, 8):
+        registers = [register for register, bit in [('A', 4), ('D', 2), ('M', 1)] if bits & bit]
+        for order in permutations(registers):
+            dest[''.join(order)] = bits
+    return dest
+
+def jump_dict():
+    return {
+        '': 0,
+        'JGT': 1,
+        'JEQ': 2,
+        'JGE': 3,
+        'JLT': 4,
+        'JNE': 5,
+        'JLE': 6,
+        'JMP': 7,
+    }
+
+def symbol_dict():
+    symbols = {
+        'SP': 0,
+        'LCL': 1,
+        'ARG': 2,
+        'THIS': 3,
+        'THAT': 4,
+        'SCREEN': 16384,
+        'KBD': 24576,
+    }
+    for x in range(16):
+        symbols['R' + str(x)] = x
+    return symbols
+
+COMP = comp_dict()
+DEST = dest_dict()
+JUMP = jump_dict()
+
+class Assembler(object):
+    '''
+    two-pass Hack assembler over an iterable of .asm lines
+    '''
+    def __init__(self, lines):
+        self.symbols = symbol_dict()
+        self.next_variable = 16
+        self.c_words = {}
+        self.words = self.second_pass(self.first_pass(lines))
+
+    def first_pass(self, lines):
+        '''
+        strip comments and whitespace, bind each label to the next ROM address
+        '''
+        instructions = []
+        for line in lines:
+            index = line.find(COMMENT)
+            if index >= 0:
+                line = line[:index]
+            line = ''.join(line.split())
+            if not line:
+                continue
+            if line[0] == '(':
+                self.symbols[line[1:-1]] = len(instructions)
+            else:
+                instructions.append(line)
+        return instructions
+
+    def second_pass(self, instructions):
+        words = array('H')
+        append = words.append
+        for instruction in instructions:
+            if instruction[0] == '@':
+                append(self.a_word(instruction[1:]))
+            else:
+                word = self.c_words.get(instruction)
+                if word is None:
+                    word = self.c_words[instruction] = self.c_word(instruction)
+                append(word)
+        return words
+
+    def a_word(self, symbol):
+        if symbol.isdigit():
+            return int(symbol) & 0x7fff
+        address = self.symbols.get(symbol)
+        if address is None:
+            address = self.symbols[symbol] = self.next_variable
+            self.next_variable += 1
+        return address
+
+    def c_word(self, instruction):
+        dest, jump = '', ''
+        comp = instruction
+        if '=' in comp:
+            dest, comp = comp.split('=', 1)
+        if ';' in comp:
+            comp, jump = comp.split(';', 1)
+        try:
+            return 0b111 << 13 | COMP[comp] << 6 | DEST[dest] << 3 | JUMP[jump]
+        except KeyError:
+            raise ValueError('invalid instruction: {}'.format(instruction))
+
+    def text(self):
+        '''
+        the .hack file content, one 16 character binary word per line
+        '''
+        return ''.join(['{:016b}\n'.format(word) for word in self.words])
+
+    def write_hack(self, hack_file):
+        with open(hack_file, 'w') as hack:
+            hack.write(self.text())
+
+    def binary(self):
+        '''
+        the packed words, two bytes each, little endian
+        '''
+        words = self.words
+        if sys.byteorder == 'big':
+            words = array('H', words)
+            words.byteswap()
+        return words.tobytes()
+
+    def write_binary(self, bin_file):
+        with open(bin_file, 'wb') as binary:
+            binary.write(self.binary())
+
+def assemble(lines):
+    return Assembler(lines).words
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Assemble Hack assembly into machine code')
+    arg_parser.add_argument('asm_file', help='a .asm file')
+    arg_parser.add_argument('--binary', action='store_true',
+                            help='write packed 16-bit words to a .bin file instead of a .hack text file')
+    args = arg_parser.parse_args()
+    with open(args.asm_file, 'r') as asm:
+        assembler = Assembler(asm)
+    if args.binary:
+        assembler.write_binary(args.asm_file.replace('.asm', '.bin'))
+    else:
+        assembler.write_hack(args.asm_file.replace('.asm', '.hack'))
@@ -0,0 +1,259 @@
+import re
+from array import array
+
+import numpy as np
+
+from CPUEmulator import RAM_SIZE, load_program
+
+ONE = np.int16(1)
+
+# ALU code -> function of D and y over int16 lanes, int16 arithmetic wraps like the ALU
+ALU = {
+    0b101010: lambda D, y: np.zeros_like(D),
+    0b111111: lambda D, y: np.ones_like(D),
+    0b111010: lambda D, y: np.full_like(D, -1),
+    0b001100: lambda D, y: D,
+    0b110000: lambda D, y: y,
+    0b001101: lambda D, y: ~D,
+    0b110001: lambda D, y: ~y,
+    0b001111: lambda D, y: -D,
+    0b110011: lambda D, y: -y,
+    0b011111: lambda D, y: D + ONE,
+    0b110111: lambda D, y: y + ONE,
+    0b001110: lambda D, y: D - ONE,
+    0b110010: lambda D, y: y - ONE,
+    0b000010: lambda D, y: D + y,
+    0b010011: lambda D, y: D - y,
+    0b000111: lambda D, y: y - D,
+    0b000000: lambda D, y: D & y,
+    0b010101: lambda D, y: D | y,
+}
+
+# jump bits -> the lanes whose ALU output jumps
+CONDITIONS = [
+    None,
+    lambda value: value > 0,
+    lambda value: value == 0,
+    lambda value: value >= 0,
+    lambda value: value < 0,
+    lambda value: value != 0,
+    lambda value: value <= 0,
+    None,
+]
+
+def alu(comp):
+    '''
+    the function of any ALU code, following the zx nx zy ny f no bits
+    '''
+    if comp in ALU:
+        return ALU[comp]
+    zx, nx, zy, ny, f, no = [comp >> shift & 1 for shift in range(5, -1, -1)]
+    def function(D, y):
+        x = np.zeros_like(D) if zx else D
+        x = ~x if nx else x
+        y = np.zeros_like(y) if zy else y
+        y = ~y if ny else y
+        out = x + y if f else x & y
+        return ~out if no else out
+    return function
+
+# every lane, a view instead of a copy
+ALL = slice(None)
+
+class BatchCPU(object):
+    '''
+    one Hack program run on many RAM states at once: RAM is a (lanes, 32768)
+    int16 array, A, D and pc are vectors with one entry per lane
+    while every lane is at the same pc, each instruction is a handful of array
+    operations over all of them, an @X followed by a C instruction is done as
+    one step with X known, so M is the column ram[:, X]
+    lanes that branched apart are stepped one pc group at a time until they
+    meet again, a lane whose pc runs off the program is halted
+    '''
+    def __init__(self, program, lanes):
+        self.lanes = lanes
+        self.ram = np.zeros((lanes, RAM_SIZE), dtype=np.int16)
+        self.load(program)
+
+    def load(self, program):
+        '''
+        program: a .asm/.hack path, e.g. what CodeWriter wrote, or a sequence of instruction words
+        '''
+        if isinstance(program, str):
+            program = load_program(program)
+        self.words = list(program)
+        self.steps = [self.decode(pc, word) for pc, word in enumerate(self.words)]
+        self.pairs = [None] * len(self.words)
+        for pc, word in enumerate(self.words[:-1]):
+            if not word & 0x8000 and self.words[pc + 1] & 0x8000:
+                self.pairs[pc] = self.decode(pc + 1, self.words[pc + 1], word)
+        self.reset()
+
+    def reset(self):
+        lanes = self.lanes
+        self.A = np.zeros(lanes, dtype=np.int16)
+        self.D = np.zeros(lanes, dtype=np.int16)
+        self.pc = np.zeros(lanes, dtype=np.int32)
+        self.cycles = np.zeros(lanes, dtype=np.int64)
+        self.everyone = np.arange(lanes)
+
+    def decode(self, pc, word, known=None):
+        '''
+        the function (lanes, rows) that runs the word at pc for some lanes:
+        lanes indexes A, D and pc, ALL or an index array, rows the same as an
+        index array into ram; known is the value of an @X just before it
+        '''
+        ram = self.ram
+        if not word & 0x8000:
+            value = np.int16(word)
+            def step(lanes, rows):
+                self.A[lanes] = value
+                self.pc[lanes] = pc + 1
+            return step
+        function = alu(word >> 6 & 0x3f)
+        memory = word >> 12 & 1
+        dest, jump = word >> 3 & 7, word & 7
+        condition = CONDITIONS[jump]
+        def step(lanes, rows):
+            if known is None:
+                A = self.A[lanes]
+                address = A & 0x7fff
+                y = ram[rows, address] if memory else A
+            else:
+                address = known
+                y = ram[rows, known] if memory else np.int16(known)
+            value = function(self.D[lanes], y)
+            if dest & 1:
+                ram[rows, address] = value
+            if dest & 4:
+                self.A[lanes] = value
+            elif known is not None:
+                self.A[lanes] = known
+            if dest & 2:
+                self.D[lanes] = value
+            # the jump goes to A as it was before this instruction
+            if jump == 7:
+                self.pc[lanes] = address
+            elif condition is not None:
+                self.pc[lanes] = np.where(condition(value), address, pc + 1)
+            else:
+                self.pc[lanes] = pc + 1
+        return step
+
+    @property
+    def running(self):
+        return self.pc < len(self.steps)
+
+    @property
+    def halted(self):
+        return not self.running.any()
+
+    def run(self, cycles):
+        '''
+        up to cycles more instructions in every lane that has not halted,
+        returns the number of instructions run over all lanes
+        '''
+        steps, pairs, size = self.steps, self.pairs, len(self.steps)
+        pc, spent = self.pc, self.cycles
+        before = int(spent.sum())
+        end = spent + cycles
+        everyone = self.everyone
+        # the lanes have run the same number of instructions
+        even = bool((spent == spent[0]).all())
+        while True:
+            first = pc[0]
+            if first < size and (pc == first).all():
+                left = int(end[0] - spent[0]) if even else int((end - spent).min())
+                if left >= 2 and pairs[first] is not None:
+                    pairs[first](ALL, everyone)
+                    spent += 2
+                    continue
+                if left >= 1:
+                    steps[first](ALL, everyone)
+                    spent += 1
+                    continue
+            lanes = np.nonzero((pc < size) & (spent < end))[0]
+            if not len(lanes):
+                break
+            pcs = pc[lanes]
+            for at in np.unique(pcs):
+                group = lanes[pcs == at]
+                steps[at](group, group)
+                spent[group] += 1
+            even = False
+        return int(spent.sum()) - before
+
+    def step(self, cycles=1):
+        return self.run(cycles)
+
+    def get(self, name):
+        '''
+        RAM[i], A, D or PC of every lane
+        '''
+        if name.startswith('RAM['):
+            return self.ram[:, int(name[4:-1])]
+        return {'A': self.A, 'D': self.D, 'PC': self.pc}[name]
+
+    def set(self, name, values):
+        '''
+        one value for every lane, or a sequence of one per lane
+        '''
+        if name.startswith('RAM['):
+            self.ram[:, int(name[4:-1])] = values
+        else:
+            self.get(name)[:] = values
+
+def parse_setting(setting):
+    '''
+    RAM[256]=7 or RAM[256]=a:b, b exclusive, for values drawn per lane
+    '''
+    match = re.match(r'(RAM\[\d+\]|A|D|PC)=(-?\d+)(?::(-?\d+))?$', setting)
+    if match is None:
+        raise ValueError('not a setting: {}'.format(setting))
+    name, low, high = match.groups()
+    return name, int(low), None if high is None else int(high)
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    from CPUEmulator import CPU
+    arg_parser = argparse.ArgumentParser(description='Run one Hack program over many initial RAM states at once')
+    arg_parser.add_argument('program', help='a .asm/.hack file, e.g. the output of VMTranslator.py')
+    arg_parser.add_argument('--lanes', type=int, default=1000,
+                            help='runs side by side')
+    arg_parser.add_argument('--cycles', type=int, default=100000,
+                            help='instructions per run')
+    arg_parser.add_argument('--set', nargs='+', default=[], metavar='NAME=VALUE',
+                            help='RAM[i]=v sets every lane, RAM[i]=a:b draws each lane\'s value from a to b-1')
+    arg_parser.add_argument('--show', nargs='+', default=['RAM[0]'], metavar='NAME',
+                            help='registers to summarize after the run')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--verify', type=int, default=0, metavar='K',
+                            help='run the first K lanes on the scalar CPU too and compare the whole RAM')
+    args = arg_parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    batch = BatchCPU(args.program, args.lanes)
+    for setting in args.set:
+        name, low, high = parse_setting(setting)
+        batch.set(name, low if high is None else rng.integers(low, high, args.lanes))
+    initial = batch.ram.copy(), batch.A.copy(), batch.D.copy(), batch.pc.copy()
+    start = time.time()
+    batch.run(args.cycles)
+    elapsed = time.time() - start
+    for name in args.show:
+        values = batch.get(name)
+        print('{}: {} distinct, first {}'.format(name, len(np.unique(values)), values[:8].tolist()))
+    print('{} lanes, {} halted, {} cycles in {:.3f}s'.format(
+        args.lanes, int((~batch.running).sum()), int(batch.cycles.sum()), elapsed), file=sys.stderr)
+    mismatches = 0
+    for lane in range(min(args.verify, args.lanes)):
+        cpu = CPU(batch.words)
+        cpu.ram[:] = array('h', initial[0][lane].tolist())
+        cpu.A, cpu.D, cpu.pc = int(initial[1][lane]), int(initial[2][lane]), int(initial[3][lane])
+        cpu.run(args.cycles)
+        if cpu.ram.tolist() != batch.ram[lane].tolist() or cpu.cycles != batch.cycles[lane]:
+            mismatches += 1
+            print('lane {} differs from the scalar CPU'.format(lane), file=sys.stderr)
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,444 @@
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from Assembler import Assembler
+from CPUEmulator import JITCPU
+from VMEmulator import VMEmulator
+from VMProgram import read_vm
+from VMTranslator import CodeWriter, Main, Parser, find_vm_files, translator_digest
+
+# cycles a translated workload may run for before it counts as hung
+CYCLE_LIMIT = 200000000
+# a time this much slower than the baseline is a regression
+TOLERANCE = 0.10
+# and at least this many seconds slower, below that it is timer noise
+MIN_DELTA = 0.001
+
+# CodeWriter options per mode
+MODES = {
+    'plain': {},
+    'bare': dict(numbers=False, comments=False),
+    'optimize': dict(optimize=True),
+    'cache-top': dict(cache_top=True),
+    'fold': dict(fold=True),
+    'fold-cache-top': dict(fold=True, cache_top=True),
+    'shared-compare': dict(shared_compare=True),
+    'trampoline': dict(trampoline=True),
+    'all': dict(fold=True, cache_top=True, optimize=True, shared_compare=True, trampoline=True),
+}
+
+# Sys.init ends with its result in temp 0 and returns to ROM address 32767,
+# past the end of any program, which stops both emulators
+HALT = '''pop temp 0
+push constant 32767
+pop argument 0
+push constant 0
+return
+'''
+
+def recursion(scale):
+    '''
+    fib(n) the slow way, and a sum 1 + ... + n that recurses n deep
+    '''
+    n = min(8 + int(scale * 10), 24)
+    depth = min(int(scale * 1000), 1500)
+    main = '''function Main.fib 0
+push argument 0
+push constant 2
+lt
+if-goto BASE
+push argument 0
+push constant 1
+sub
+call Main.fib 1
+push argument 0
+push constant 2
+sub
+call Main.fib 1
+add
+return
+label BASE
+push argument 0
+return
+function Main.sum 0
+push argument 0
+push constant 0
+eq
+if-goto BASE
+push argument 0
+push argument 0
+push constant 1
+sub
+call Main.sum 1
+add
+return
+label BASE
+push constant 0
+return
+'''
+    sys_vm = '''function Sys.init 0
+push constant {}
+call Main.fib 1
+push constant {}
+call Main.sum 1
+add
+'''.format(n, depth) + HALT
+    return {'Main.vm': main, 'Sys.vm': sys_vm}
+
+def loop(scale):
+    '''
+    two nested counting loops over locals, the inner one summing i & j
+    '''
+    outer = max(int(scale * 100), 1)
+    sys_vm = '''function Sys.init 3
+push constant {}
+pop local 0
+label OUTER
+push constant 100
+pop local 1
+label INNER
+push local 2
+push local 0
+push local 1
+and
+add
+pop local 2
+push local 1
+push constant 1
+sub
+pop local 1
+push local 1
+push constant 0
+gt
+if-goto INNER
+push local 0
+push constant 1
+sub
+pop local 0
+push local 0
+push constant 0
+gt
+if-goto OUTER
+push local 2
+'''.format(outer) + HALT
+    return {'Sys.vm': sys_vm}
+
+def arithmetic(scale, seed=8):
+    '''
+    long straight-line expressions over constants and statics, run a few times
+    '''
+    rng = random.Random(seed)
+    operations = ['add', 'sub', 'and', 'or', 'eq', 'lt', 'gt']
+    lines = ['function Main.storm 0']
+    for x in range(max(int(scale * 400), 1)):
+        lines.append('push static {}'.format(rng.randrange(8)))
+        for y in range(rng.randrange(1, 5)):
+            if rng.random() < 0.5:
+                lines.append('push constant {}'.format(rng.randrange(0x8000)))
+            else:
+                lines.append('push static {}'.format(rng.randrange(8)))
+            lines.append(rng.choice(operations))
+            if rng.random() < 0.2:
+                lines.append(rng.choice(['neg', 'not']))
+        lines.append('pop static {}'.format(rng.randrange(8)))
+    lines += ['push static 0', 'return']
+    sys_vm = '''function Sys.init 1
+push constant 10
+pop local 0
+label REPEAT
+call Main.storm 0
+pop temp 1
+push local 0
+push constant 1
+sub
+pop local 0
+push local 0
+if-goto REPEAT
+push temp 1
+''' + HALT
+    return {'Main.vm': '\n'.join(lines) + '\n', 'Sys.vm': sys_vm}
+
+def many_files(scale):
+    '''
+    StaticsTest grown wide: every ClassN.vm keeps two statics with set / get,
+    and its run calls the next class
+    '''
+    count = max(int(scale * 50), 2)
+    files = {}
+    for x in range(count):
+        call_next = ''
+        if x + 1 < count:
+            call_next = 'push argument 0\ncall Class{}.run 1\nadd\n'.format(x + 1)
+        files['Class{}.vm'.format(x)] = '''function Class{0}.set 0
+push argument 0
+pop static 0
+push argument 1
+pop static 1
+push constant 0
+return
+function Class{0}.get 0
+push static 0
+push static 1
+sub
+return
+function Class{0}.run 0
+push argument 0
+push constant {0}
+call Class{0}.set 2
+pop temp 0
+call Class{0}.get 0
+{1}return
+'''.format(x, call_next)
+    files['Sys.vm'] = '''function Sys.init 1
+push constant 20
+pop local 0
+label REPEAT
+push local 0
+call Class0.run 1
+pop temp 1
+push local 0
+push constant 1
+sub
+pop local 0
+push local 0
+if-goto REPEAT
+push temp 1
+''' + HALT
+    return files
+
+def throughput(scale, seed=11):
+    '''
+    about a million commands of functions that are never called, for the
+    translator alone: too big to assemble, Sys.init halts right away
+    '''
+    rng = random.Random(seed)
+    size = max(int(scale * 1000000), 100)
+    segments = ['local', 'argument', 'this', 'that', 'temp', 'pointer', 'static']
+    operations = ['add', 'sub', 'and', 'or', 'neg', 'not', 'eq', 'lt', 'gt']
+    lines = []
+    while len(lines) < size:
+        lines += ['function Main.f{} 2'.format(len(lines)), 'label LOOP']
+        for x in range(rng.randrange(10, 60)):
+            pick = rng.random()
+            if pick < 0.3:
+                lines.append('push constant {}'.format(rng.randrange(0x8000)))
+            elif pick < 0.55:
+                segment = rng.choice(segments)
+                index = rng.randrange(2) if segment == 'pointer' else rng.randrange(8)
+                lines.append('{} {} {}'.format(rng.choice(['push', 'pop']), segment, index))
+            elif pick < 0.85:
+                lines.append(rng.choice(operations))
+            elif pick < 0.95:
+                lines.append('if-goto LOOP')
+            else:
+                lines.append('call Main.f0 {}'.format(rng.randrange(3)))
+        lines += ['push constant 0', 'return']
+    sys_vm = 'function Sys.init 0\npush constant 0\n' + HALT
+    return {'Main.vm': '\n'.join(lines) + '\n', 'Sys.vm': sys_vm}
+
+WORKLOADS = {
+    'recursion': recursion,
+    'loop': loop,
+    'arithmetic': arithmetic,
+    'many-files': many_files,
+    'throughput': throughput,
+}
+# only run when asked for, they take long
+EXTRA_WORKLOADS = ['throughput']
+# translated but never assembled or run, the code does not fit in the ROM
+TRANSLATE_ONLY = ['throughput']
+
+def write_workload(root, name, files):
+    '''
+    the workload as a directory of .vm files under root, returns its path
+    '''
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    for file_name, text in files.items():
+        with open(os.path.join(path, file_name), 'w') as vm:
+            vm.write(text)
+    return path
+
+def best_time(function, repeat):
+    '''
+    the fastest of repeat runs in seconds, and the last result
+    '''
+    best = None
+    for x in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def parse_all(vm_files):
+    count = 0
+    for vm_file in vm_files:
+        parser = Parser(vm_file)
+        while parser.has_next_instruction:
+            parser.next()
+            count += 1
+        parser.close()
+    return count
+
+def write_all(programs, options):
+    '''
+    CodeWriter alone, over files already read into memory
+    '''
+    asm = io.StringIO()
+    cw = CodeWriter(asm, **options)
+    cw.write_init()
+    for name, program in programs:
+        if cw.folder is not None:
+            program = cw.folder.fold(program)
+        cw.set_file_name(name)
+        cw.write_program(program)
+    cw.close()
+    return asm.getvalue()
+
+def run_main(path, options):
+    Main(path, **options)
+    asm_file = find_vm_files(path)[0]
+    with open(asm_file, 'r') as asm:
+        return asm.read()
+
+def run_vm(path):
+    vm = VMEmulator(path)
+    vm.bootstrap()
+    while not vm.halted and vm.steps < CYCLE_LIMIT:
+        vm.run(1000000)
+    return vm
+
+def run_cpu(words):
+    cpu = JITCPU(words)
+    while not cpu.halted and cpu.cycles < CYCLE_LIMIT:
+        cpu.run(1000000)
+    return cpu
+
+def bench_workload(name, path, modes, repeat=3, execute=True):
+    '''
+    one result dict per mode
+    '''
+    vm_files = find_vm_files(path)[1]
+    parse_time, commands = best_time(lambda: parse_all(vm_files), repeat)
+    programs = [(vm_file, read_vm(vm_file)) for vm_file in vm_files]
+    execute = execute and name not in TRANSLATE_ONLY
+    vm = run_vm(path) if execute else None
+    results = []
+    for mode in modes:
+        options = MODES[mode]
+        write_time, text = best_time(lambda: write_all(programs, options), repeat)
+        main_time, text = best_time(lambda: run_main(path, options), repeat)
+        result = {
+            'workload': name,
+            'mode': mode,
+            'commands': commands,
+            'parse_s': parse_time,
+            'codewriter_s': write_time,
+            'main_s': main_time,
+            'commands_per_s': commands / main_time,
+        }
+        if name in TRANSLATE_ONLY:
+            result['instructions'] = sum(1 for line in text.splitlines() if line and line[0] not in '(/')
+            results.append(result)
+            continue
+        words = Assembler(text.splitlines()).words
+        result['instructions'] = len(words)
+        if vm is not None:
+            cpu = run_cpu(words)
+            result['vm_steps'] = vm.steps
+            result['cycles'] = cpu.cycles
+            # temp 0 holds the answer, both have to halt on the same one
+            result['correct'] = vm.halted and cpu.halted and vm.ram[5] == cpu.ram[5]
+        results.append(result)
+    return results
+
+def run_suite(workloads, modes, scale=1.0, repeat=3, execute=True):
+    root = tempfile.mkdtemp(prefix='vm-bench-')
+    try:
+        results = []
+        for name in workloads:
+            path = write_workload(root, name, WORKLOADS[name](scale))
+            results += bench_workload(name, path, modes, repeat, execute)
+    finally:
+        shutil.rmtree(root)
+    return {
+        'translator': translator_digest(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': scale,
+        'results': results,
+    }
+
+def regressions(baseline, report, tolerance=TOLERANCE):
+    '''
+    lines for every workload / mode that got slower than tolerance allows,
+    emits more instructions, runs more cycles, or stopped being correct
+    '''
+    old = dict(((result['workload'], result['mode']), result) for result in baseline['results'])
+    lines = []
+    for result in report['results']:
+        before = old.get((result['workload'], result['mode']))
+        if before is None:
+            continue
+        label = '{} {}'.format(result['workload'], result['mode'])
+        for key in ['parse_s', 'codewriter_s', 'main_s']:
+            if result[key] > before[key] * (1 + tolerance) and result[key] - before[key] > MIN_DELTA:
+                lines.append('{}: {} {:.4f}s -> {:.4f}s'.format(label, key, before[key], result[key]))
+        for key in ['instructions', 'cycles']:
+            if key in result and key in before and result[key] > before[key]:
+                lines.append('{}: {} {} -> {}'.format(label, key, before[key], result[key]))
+        if before.get('correct') and not result.get('correct', True):
+            lines.append('{}: no longer matches the VM emulator'.format(label))
+    return lines
+
+def table(report):
+    lines = ['{:<12} {:<15} {:>9} {:>9} {:>9} {:>10} {:>8} {:>10}'.format(
+        'workload', 'mode', 'parse ms', 'write ms', 'main ms', 'cmds/s', 'instr', 'cycles')]
+    for result in report['results']:
+        lines.append('{:<12} {:<15} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.0f} {:>8} {:>10}{}'.format(
+            result['workload'], result['mode'], result['parse_s'] * 1000, result['codewriter_s'] * 1000,
+            result['main_s'] * 1000, result['commands'] / result['main_s'], result['instructions'],
+            result.get('cycles', '-'),
+            '' if result.get('correct', True) else '  WRONG'))
+    return lines
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Time the VM translator on generated workloads')
+    arg_parser.add_argument('--out', help='write the results to this .json file')
+    arg_parser.add_argument('--baseline', help='a .json file from an earlier run to check for regressions against')
+    arg_parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                            help='how much slower than the baseline still passes, 0.1 is 10%%')
+    arg_parser.add_argument('--scale', type=float, default=1.0,
+                            help='grow or shrink every workload')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='runs per timing, the fastest one counts')
+    arg_parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS),
+                            default=[name for name in WORKLOADS if name not in EXTRA_WORKLOADS],
+                            help='the workloads to run, throughput (a million commands, translated '
+                                 'only) has to be asked for')
+    arg_parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    arg_parser.add_argument('--no-run', action='store_true',
+                            help='only translate, do not execute the workloads')
+    args = arg_parser.parse_args()
+    report = run_suite(args.workloads, args.modes, args.scale, args.repeat, not args.no_run)
+    for line in table(report):
+        print(line)
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(report, out, indent=1)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline:
+            lines = regressions(json.load(baseline), report, args.tolerance)
+        for line in lines:
+            print(line, file=sys.stderr)
+        if lines:
+            sys.exit(1)
@@ -0,0 +1,493 @@
+import os
+import re
+from array import array
+
+from Assembler import Assembler
+
+RAM_SIZE = 32768
+KBD = 24576
+# entries into a block before it is compiled
+HOT = 2
+# longest straight-line run compiled into one block
+BLOCK_LIMIT = 256
+
+# ALU code (zx nx zy ny f no) -> python expression over D and y, and whether it can overflow
+COMP = {
+    0b101010: ('0', False),
+    0b111111: ('1', False),
+    0b111010: ('-1', False),
+    0b001100: ('D', False),
+    0b110000: ('y', False),
+    0b001101: ('~D', False),
+    0b110001: ('~y', False),
+    0b001111: ('-D', True),
+    0b110011: ('-y', True),
+    0b011111: ('D+1', True),
+    0b110111: ('y+1', True),
+    0b001110: ('D-1', True),
+    0b110010: ('y-1', True),
+    0b000010: ('D+y', True),
+    0b010011: ('D-y', True),
+    0b000111: ('y-D', True),
+    0b000000: ('D&y', False),
+    0b010101: ('D|y', False),
+}
+
+JUMP = ['', '>0', '==0', '>=0', '<0', '!=0', '<=0', '']
+
+def wrap(expr):
+    # back into the signed 16 bit range
+    return '((({}) + 0x8000) & 0xffff) - 0x8000'.format(expr)
+
+def alu_expr(comp):
+    '''
+    the expression for any ALU code, following the zx nx zy ny f no bits
+    '''
+    zx, nx, zy, ny, f, no = [comp >> shift & 1 for shift in range(5, -1, -1)]
+    x = '0' if zx else 'D'
+    x = '~' + x if nx else x
+    y = '0' if zy else 'y'
+    y = '~' + y if ny else y
+    out = wrap('{}+{}'.format(x, y)) if f else '({})&({})'.format(x, y)
+    return '~({})'.format(out) if no else out
+
+def decode_c(word):
+    '''
+    the python expression for the comp part, and the dest and jump bits
+    '''
+    a = word >> 12 & 1
+    comp = word >> 6 & 0x3f
+    expr, overflow = COMP.get(comp, (None, False))
+    if expr is None:
+        expr = alu_expr(comp)
+    elif overflow:
+        expr = wrap(expr)
+    return expr.replace('y', 'ram[A]' if a else 'A'), word >> 3 & 7, word & 7
+
+def c_source(word):
+    expr, dest, jump = decode_c(word)
+    lines = ['def handler(A, D, pc):', '    value = ' + expr]
+    if dest & 1:
+        lines.append('    ram[A] = value')
+    next_A = 'value' if dest & 4 else 'A'
+    next_D = 'value' if dest & 2 else 'D'
+    # the jump goes to A as it was before this instruction
+    if jump == 7:
+        next_pc = 'A & 0x7fff'
+    elif jump:
+        next_pc = '(A & 0x7fff) if value {} else pc + 1'.format(JUMP[jump])
+    else:
+        next_pc = 'pc + 1'
+    lines.append('    return {}, {}, {}'.format(next_A, next_D, next_pc))
+    return '\n'.join(lines)
+
+def block_source(words, start):
+    '''
+    one function (A, D) -> (A, D, pc) for the straight-line run of words
+    from start up to and including its first jump, A is kept as a constant
+    while it holds one so @X / M accesses become ram[X]
+    '''
+    lines = ['def block(A, D):']
+    known = None
+    pc = start
+    for word in words:
+        pc += 1
+        if not word & 0x8000:
+            known = word
+            continue
+        expr, dest, jump = decode_c(word)
+        if known == 0 and expr in [wrap('D+A'), wrap('D-A')]:
+            expr = 'D'
+        elif known is not None:
+            expr = expr.replace('ram[A]', 'ram[{}]'.format(known)).replace('A', str(known))
+        memory = 'ram[{}]'.format(known) if known is not None else 'ram[A]'
+        targets = [target for target, bit in [(memory, 1), ('D', 2), ('A', 4)] if dest & bit]
+        if jump:
+            # the jump goes to A as it was before this instruction
+            target = str(known & 0x7fff) if known is not None else 'A & 0x7fff'
+            if known is None and dest & 4:
+                lines.append('    target = ' + target)
+                target = 'target'
+        value = 'value'
+        if len(targets) == 1 and jump in [0, 7]:
+            lines.append('    {} = {}'.format(targets[0], expr))
+        elif targets == ['D']:
+            lines.append('    D = ' + expr)
+            value = 'D'
+        elif targets or jump not in [0, 7]:
+            lines.append('    value = ' + expr)
+            for name in targets:
+                lines.append('    {} = value'.format(name))
+        if dest & 4:
+            known = None
+        final_A = str(known) if known is not None else 'A'
+        if jump == 7:
+            lines.append('    return {}, D, {}'.format(final_A, target))
+        elif jump:
+            lines.append('    return {}, D, {} if {} {} else {}'.format(final_A, target, value, JUMP[jump], pc))
+    if not words[-1] & 0x8000 or not words[-1] & 7:
+        lines.append('    return {}, D, {}'.format(str(known) if known is not None else 'A', pc))
+    return '\n'.join(lines)
+
+def a_handler(value):
+    def handler(A, D, pc):
+        return value, D, pc + 1
+    return handler
+
+def load_program(program_file):
+    '''
+    the words of a .asm or .hack file
+    '''
+    with open(program_file, 'r') as program:
+        if program_file.endswith('.hack'):
+            return array('H', [int(line, 2) for line in program if line.strip()])
+        return Assembler(program).words
+
+class CPU(object):
+    '''
+    Hack CPU: every distinct instruction word is decoded once into a handler
+    (A, D, pc) -> (A, D, pc), the program is a list of handlers indexed by pc
+    '''
+    def __init__(self, program=None):
+        self.ram = array('h', [0]) * RAM_SIZE
+        self.decoded = {}
+        self.handlers = []
+        self.words = array('H')
+        self.reset()
+        if program is not None:
+            self.load(program)
+
+    def load(self, program):
+        '''
+        program: a .asm/.hack path or a sequence of instruction words
+        '''
+        if isinstance(program, str):
+            program = load_program(program)
+        self.words = array('H', program)
+        self.handlers = [self.decode(word) for word in self.words]
+        self.pc = 0
+
+    def decode(self, word):
+        handler = self.decoded.get(word)
+        if handler is None:
+            if word & 0x8000:
+                namespace = {'ram': self.ram}
+                exec(c_source(word), namespace)
+                handler = namespace['handler']
+            else:
+                handler = a_handler(word)
+            self.decoded[word] = handler
+        return handler
+
+    def reset(self):
+        self.A = 0
+        self.D = 0
+        self.pc = 0
+        self.cycles = 0
+
+    def clear_ram(self):
+        # in place, the handlers hold on to self.ram
+        self.ram[:] = array('h', [0]) * RAM_SIZE
+
+    @property
+    def halted(self):
+        return not 0 <= self.pc < len(self.handlers)
+
+    def run(self, cycles):
+        '''
+        execute up to cycles instructions, stopping early when pc runs off the program
+        returns the number executed
+        '''
+        handlers = self.handlers
+        A, D, pc = self.A, self.D, self.pc
+        done = 0
+        try:
+            for done in range(cycles):
+                A, D, pc = handlers[pc](A, D, pc)
+            else:
+                done = cycles
+        except IndexError:
+            pass
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += done
+        return done
+
+    def step(self, cycles=1):
+        return self.run(cycles)
+
+    def get(self, name):
+        if name.startswith('RAM['):
+            return self.ram[int(name[4:-1])]
+        elif name == 'PC':
+            return self.pc
+        elif name == 'time':
+            return self.cycles
+        return getattr(self, name)
+
+    def set(self, name, value):
+        if name.startswith('RAM['):
+            self.ram[int(name[4:-1])] = value
+        elif name == 'PC':
+            self.pc = value
+        else:
+            setattr(self, name, value)
+
+class JITCPU(CPU):
+    '''
+    Hack CPU that runs straight-line code a block at a time: a block starts
+    wherever execution enters it and ends at its first jump, once it has
+    been entered HOT times its python source is generated and compiled
+    '''
+    def load(self, program):
+        CPU.load(self, program)
+        size = len(self.words)
+        # per entry pc: compiled function, block size, times entered
+        self.functions = [None] * size
+        self.sizes = [0] * size
+        self.entries = [0] * size
+
+    def block_size(self, start):
+        end = start
+        limit = min(len(self.words), start + BLOCK_LIMIT)
+        while end < limit:
+            word = self.words[end]
+            end += 1
+            if word & 0x8000 and word & 7:
+                break
+        return end - start
+
+    def compile_block(self, start, size):
+        namespace = {'ram': self.ram}
+        source = block_source(self.words[start:start + size], start)
+        exec(compile(source, '<block {}>'.format(start), 'exec'), namespace)
+        return namespace['block']
+
+    def run(self, cycles):
+        functions, sizes, entries = self.functions, self.sizes, self.entries
+        A, D, pc = self.A, self.D, self.pc
+        end = len(functions)
+        remaining = cycles
+        while remaining > 0 and 0 <= pc < end:
+            # compiled blocks back to back
+            function = functions[pc]
+            while function is not None and sizes[pc] <= remaining:
+                remaining -= sizes[pc]
+                A, D, pc = function(A, D)
+                if not 0 <= pc < end:
+                    break
+                function = functions[pc]
+            if remaining <= 0 or not 0 <= pc < end:
+                break
+            size = sizes[pc] or self.block_size(pc)
+            if size > remaining:
+                break
+            sizes[pc] = size
+            entries[pc] += 1
+            if entries[pc] >= HOT:
+                functions[pc] = self.compile_block(pc, size)
+                continue
+            # still cold, interpret it
+            self.A, self.D, self.pc = A, D, pc
+            CPU.run(self, size)
+            self.cycles -= size
+            A, D, pc = self.A, self.D, self.pc
+            remaining -= size
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += cycles - remaining
+        if remaining > 0 and not self.halted:
+            # the tail that does not fill a whole block
+            return cycles - remaining + CPU.run(self, remaining)
+        return cycles - remaining
+
+class TestScript(object):
+    '''
+    a .tst script against its .cmp file, for any target with
+    load / set / get / step (ticktock) methods
+    '''
+    STEPS = ['ticktock', 'vmstep']
+
+    def __init__(self, tst_file):
+        self.tst_file = tst_file
+        self.dir = os.path.dirname(tst_file)
+        with open(tst_file, 'r') as tst:
+            text = tst.read()
+        text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+        text = re.sub(r'//[^\n]*', '', text)
+        # a quoted echo message is one token, commas and all
+        self.commands = self.parse(re.findall(r'"[^"]*"|[{}]|[,;]|[^\s,;{}]+', text))
+        self.cmp_file = None
+        self.columns = []
+        self.output = []
+
+    def parse(self, tokens):
+        '''
+        nested list of commands, a repeat block is ('repeat', count, commands)
+        '''
+        blocks = [[]]
+        command = []
+        for token in tokens:
+            if token == '{':
+                blocks[-1].append(command)
+                blocks.append([])
+                command = []
+            elif token == '}':
+                if command:
+                    blocks[-1].append(command)
+                body = blocks.pop()
+                blocks[-1][-1] = (blocks[-1][-1][0], blocks[-1][-1][1:], body)
+                command = []
+            elif token in ',;':
+                if command:
+                    blocks[-1].append(command)
+                command = []
+            else:
+                command.append(token)
+        if command:
+            blocks[-1].append(command)
+        return blocks[0]
+
+    def run(self, target, program=None):
+        '''
+        program replaces whatever the script loads, e.g. an in-memory translation
+        returns True when the output matches the .cmp file
+        '''
+        self.target = target
+        self.program = program
+        self.output = []
+        self.execute(self.commands)
+        return self.compare()
+
+    def execute(self, commands):
+        for command in commands:
+            if isinstance(command, tuple):
+                self.execute_block(*command)
+            else:
+                self.execute_command(command)
+
+    def execute_block(self, keyword, args, body):
+        if keyword == 'repeat' and not args:
+            # no count: until the program stops
+            while not self.target.halted:
+                self.execute(body)
+        elif keyword == 'repeat':
+            count = int(args[0])
+            if all(isinstance(c, list) and c[0] in self.STEPS for c in body):
+                # a plain run of steps goes to the target in one call
+                self.target.step(count * len(body))
+                return
+            for x in range(count):
+                self.execute(body)
+        elif keyword == 'while':
+            while self.condition(args):
+                self.execute(body)
+
+    def condition(self, args):
+        left, op, right = args
+        left, right = self.value(left), self.value(right)
+        return {
+            '=': left == right,
+            '<>': left != right,
+            '<': left < right,
+            '>': left > right,
+            '<=': left <= right,
+            '>=': left >= right,
+        }[op]
+
+    def value(self, token):
+        return int(token) if re.match(r'-?\d+$', token) else self.target.get(token)
+
+    def execute_command(self, command):
+        keyword, args = command[0], command[1:]
+        if keyword == 'load':
+            self.target.load(self.program if self.program is not None else os.path.join(self.dir, *args))
+        elif keyword == 'compare-to':
+            self.cmp_file = os.path.join(self.dir, args[0])
+        elif keyword == 'output-list':
+            self.columns = [self.column(arg) for arg in args]
+            self.output.append(self.header())
+        elif keyword == 'output':
+            self.output.append(self.row())
+        elif keyword == 'set':
+            self.target.set(args[0], int(args[1]))
+        elif keyword in self.STEPS:
+            self.target.step(1)
+
+    def column(self, arg):
+        match = re.match(r'(.+)%([BXDS])(\d+)\.(\d+)\.(\d+)$', arg)
+        if match is None:
+            return arg, 'B', 1, 16, 1
+        name, kind, left, width, right = match.groups()
+        return name, kind, int(left), int(width), int(right)
+
+    def header(self):
+        cells = []
+        for name, kind, left, width, right in self.columns:
+            size = left + width + right
+            name = name[:size]
+            space = size - len(name)
+            cells.append(' ' * (space // 2) + name + ' ' * (space - space // 2))
+        return '|' + '|'.join(cells) + '|'
+
+    def row(self):
+        cells = []
+        for name, kind, left, width, right in self.columns:
+            value = self.target.get(name)
+            if kind == 'D':
+                text = str(value)
+            elif kind == 'X':
+                text = '{:04X}'.format(value & 0xffff)
+            elif kind == 'B':
+                text = '{:016b}'.format(value & 0xffff)
+            else:
+                text = str(value)
+            text = text[-width:].ljust(width) if kind == 'S' else text[-width:].rjust(width)
+            cells.append(' ' * left + text + ' ' * right)
+        return '|' + '|'.join(cells) + '|'
+
+    def compare(self):
+        '''
+        line by line, a * in the .cmp file matches any character
+        '''
+        self.failure = None
+        if self.cmp_file is None:
+            return True
+        with open(self.cmp_file, 'r') as cmp:
+            expected = [line.rstrip() for line in cmp if line.strip()]
+        for number, (got, want) in enumerate(zip(self.output, expected), 1):
+            if len(got) != len(want) or any(w != '*' and g != w for g, w in zip(got, want)):
+                self.failure = number
+                return False
+        if len(self.output) != len(expected):
+            self.failure = min(len(self.output), len(expected)) + 1
+            return False
+        return True
+
+    def write_output(self, out_file):
+        with open(out_file, 'w') as out:
+            out.write('\n'.join(self.output) + '\n')
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    arg_parser = argparse.ArgumentParser(description='Run Hack machine code')
+    arg_parser.add_argument('file_path', help='a .tst script, or a .asm/.hack program')
+    arg_parser.add_argument('--cycles', type=int, default=1000000,
+                            help='instructions to run a program for')
+    arg_parser.add_argument('--jit', action='store_true',
+                            help='compile hot straight-line blocks into python functions')
+    args = arg_parser.parse_args()
+    cpu = JITCPU() if args.jit else CPU()
+    start = time.time()
+    if args.file_path.endswith('.tst'):
+        script = TestScript(args.file_path)
+        if script.run(cpu):
+            print('End of script - Comparison ended successfully')
+        else:
+            print('Comparison failure at line {}'.format(script.failure))
+            sys.exit(1)
+    else:
+        cpu.load(args.file_path)
+        cpu.run(args.cycles)
+    elapsed = time.time() - start
+    print('{} cycles in {:.3f}s'.format(cpu.cycles, elapsed), file=sys.stderr)
@@ -0,0 +1,137 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from CPUEmulator import CPU, JITCPU, TestScript
+from VMEmulator import VMEmulator
+from VMTranslator import Main
+
+# the translator tests of the course and our own, relative to this file
+TEST_ROOTS = ['../nand2tetris/projects/07', '../nand2tetris/projects/08', 'tests']
+
+# the tests of one translator mode, translated in it whatever else is asked for
+TEST_OPTIONS = {
+    'FusedJumps': dict(fold=True),
+    'FoldLabels': dict(fold=True),
+    'PeepholeRewrites': dict(optimize=True),
+}
+
+# copied next to the .asm so the script finds everything it loads
+TEST_FILES = ('.vm', '.tst', '.cmp')
+
+def find_tests(roots, vme=False):
+    '''
+    every .tst script that has a .cmp file and .vm files in its directory,
+    the VME.tst scripts for the VM emulator only when vme is set
+    '''
+    tests = []
+    for root in roots:
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            dirnames.sort()
+            if not any(name.endswith('.vm') for name in filenames):
+                continue
+            if not any(name.endswith('.cmp') for name in filenames):
+                continue
+            for name in sorted(filenames):
+                if name.endswith('VME.tst') and not vme:
+                    continue
+                if name.endswith('.tst'):
+                    tests.append(os.path.join(dirpath, name))
+    return tests
+
+def run_test(tst_file, options, jit=False):
+    '''
+    translate the directory of tst_file with Main in a scratch copy, run the
+    script on a Hack CPU (the VM emulator for a VME.tst) and compare to the .cmp
+    returns a result dict, passed is False with error set if anything raised
+    '''
+    source = os.path.dirname(tst_file)
+    name = os.path.basename(source)
+    result = dict(test=tst_file, name=os.path.basename(tst_file)[:-4], passed=False, failure=None,
+                  error=None, translate_s=0.0, run_s=0.0, cycles=None, instructions=None)
+    scratch = tempfile.mkdtemp(prefix='vm-test-')
+    try:
+        path = os.path.join(scratch, name)
+        os.makedirs(path)
+        vm_files = []
+        for file_name in os.listdir(source):
+            if file_name.endswith(TEST_FILES):
+                shutil.copy(os.path.join(source, file_name), path)
+                if file_name.endswith('.vm'):
+                    vm_files.append(file_name)
+        script = TestScript(os.path.join(path, os.path.basename(tst_file)))
+        if tst_file.endswith('VME.tst'):
+            target = VMEmulator()
+        else:
+            start = time.perf_counter()
+            # the tests without Sys.init set up the stack themselves
+            Main(path, bootstrap='Sys.vm' in vm_files, **dict(options, **TEST_OPTIONS.get(name, {})))
+            result['translate_s'] = time.perf_counter() - start
+            target = JITCPU() if jit else CPU()
+        start = time.perf_counter()
+        result['passed'] = script.run(target)
+        result['run_s'] = time.perf_counter() - start
+        result['failure'] = script.failure
+        if isinstance(target, VMEmulator):
+            result['cycles'] = target.steps
+            result['instructions'] = len(target.code)
+        else:
+            result['cycles'] = target.cycles
+            result['instructions'] = len(target.words)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    finally:
+        shutil.rmtree(scratch)
+    return result
+
+def run_tests(tests, options, jobs=1, jit=False):
+    if jobs > 1 and len(tests) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(run_test, tests, repeat(options), repeat(jit)))
+    return [run_test(test, options, jit) for test in tests]
+
+def report(results):
+    lines = ['{:<4} {:<24} {:>12} {:>8} {:>10} {:>8}'.format(
+        '', 'test', 'translate ms', 'run ms', 'cycles', 'instr')]
+    for result in results:
+        lines.append('{:<4} {:<24} {:>12.1f} {:>8.1f} {:>10} {:>8}'.format(
+            'ok' if result['passed'] else 'FAIL', result['name'], result['translate_s'] * 1000,
+            result['run_s'] * 1000, result['cycles'] if result['cycles'] is not None else '-',
+            result['instructions'] if result['instructions'] is not None else '-'))
+        if result['error']:
+            lines.append('     ' + result['error'])
+        elif not result['passed']:
+            lines.append('     comparison failure at line {}'.format(result['failure']))
+    passed = sum(1 for result in results if result['passed'])
+    lines.append('{} of {} passed'.format(passed, len(results)))
+    return lines
+
+if __name__ == '__main__':
+    import argparse
+    here = os.path.dirname(os.path.abspath(__file__))
+    arg_parser = argparse.ArgumentParser(description='Run the .tst scripts of the translator tests on the translator output')
+    arg_parser.add_argument('roots', nargs='*', default=[os.path.join(here, root) for root in TEST_ROOTS],
+                            help='directories to look for tests in, projects 07 and 08 by default')
+    arg_parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='tests to run at once')
+    arg_parser.add_argument('--jit', action='store_true',
+                            help='run the translated programs on the block compiling CPU')
+    arg_parser.add_argument('--vme', action='store_true',
+                            help='also run the VME.tst scripts on the VM emulator')
+    for flag in ['--trampoline', '--optimize', '--cache-top', '--fold', '--shared-compare',
+                 '--whole-program', '--inline']:
+        arg_parser.add_argument(flag, action='store_true', help='translate with VMTranslator.py ' + flag)
+    args = arg_parser.parse_args()
+    options = dict(trampoline=args.trampoline, optimize=args.optimize, cache_top=args.cache_top, fold=args.fold,
+                   shared_compare=args.shared_compare, whole_program=args.whole_program, inline=args.inline)
+    start = time.perf_counter()
+    results = run_tests(find_tests(args.roots, args.vme), options, args.jobs, args.jit)
+    for line in report(results):
+        print(line)
+    print('{:.2f}s'.format(time.perf_counter() - start), file=sys.stderr)
+    if not all(result['passed'] for result in results):
+        sys.exit(1)
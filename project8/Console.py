@@ -0,0 +1,299 @@
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from CPUEmulator import CPU, JITCPU, KBD
+
+SCREEN = 16384
+ROWS = 256
+COLUMNS = 512
+ROW_WORDS = COLUMNS // 16
+FPS = 30
+# seconds a key from the terminal stays down, a terminal reports no key-up
+HOLD = 0.1
+# a CPU slice is about this part of a frame
+SLICES = 10
+
+# what a terminal sends -> Hack key code
+KEYS = {
+    '\r': 128, '\n': 128, '\x7f': 129, '\x08': 129,
+    '\x1b[D': 130, '\x1b[A': 131, '\x1b[C': 132, '\x1b[B': 133,
+    '\x1b[H': 134, '\x1bOH': 134, '\x1b[F': 135, '\x1bOF': 135,
+    '\x1b[5~': 136, '\x1b[6~': 137, '\x1b[2~': 138, '\x1b[3~': 139,
+    '\x1b': 140, '\x1bOP': 141, '\x1bOQ': 142, '\x1bOR': 143, '\x1bOS': 144,
+}
+
+# braille dot of the pixel at (row, column) of a 4 x 2 character cell
+BRAILLE = np.array([[0x01, 0x08], [0x02, 0x10], [0x04, 0x20], [0x40, 0x80]], dtype=np.uint32)
+
+def escape_size(text, at):
+    '''
+    the length of the escape sequence at text[at]: a whole CSI sequence, ESC [
+    parameters and intermediates up to its final byte, ESC O and one more
+    character, or a lone ESC
+    '''
+    if text[at + 1:at + 2] == '[':
+        end = at + 2
+        while end < len(text) and ' ' <= text[end] <= '?':
+            end += 1
+        if end < len(text) and '@' <= text[end] <= '~':
+            end += 1
+        return end - at
+    if text[at + 1:at + 2] == 'O' and at + 2 < len(text):
+        return 3
+    return 1
+
+def parse_keys(text):
+    '''
+    the Hack key codes of what a terminal sent, anything else is dropped,
+    escape sequences with no key code, like ctrl-arrows, as a whole
+    '''
+    codes = []
+    at = 0
+    while at < len(text):
+        if text[at] == '\x1b':
+            size = escape_size(text, at)
+            if text[at:at + size] in KEYS:
+                codes.append(KEYS[text[at:at + size]])
+            at += size
+            continue
+        char = text[at]
+        if char in KEYS:
+            codes.append(KEYS[char])
+        elif ' ' <= char <= '~':
+            codes.append(ord(char))
+        at += 1
+    return codes
+
+def parse_key(key):
+    '''
+    K or 75
+    '''
+    return int(key) if key.isdigit() and len(key) > 1 else ord(key)
+
+class Screen(object):
+    '''
+    the screen memory map of a CPU as a (256, 512) framebuffer, 1 is black
+    the words are a view of the CPU's RAM, so the CPU writes them at full
+    speed; refresh finds the dirty words by comparing them with a copy of
+    what was last unpacked and unpacks only the rows they are in
+    '''
+    def __init__(self, ram):
+        self.words = np.frombuffer(ram, dtype=np.int16)[SCREEN:KBD].reshape(ROWS, ROW_WORDS)
+        self.shown = np.zeros_like(self.words)
+        self.pixels = np.zeros((ROWS, COLUMNS), dtype=np.uint8)
+        self.dirty_words = 0
+        self.dirty_rows = 0
+
+    def refresh(self):
+        '''
+        bring pixels up to date, returns the indexes of the rows that changed
+        '''
+        changed = self.words != self.shown
+        rows = np.nonzero(changed.any(axis=1))[0]
+        if len(rows):
+            words = self.words[rows]
+            self.shown[rows] = words
+            # pixel 0 of a word is its lowest bit
+            self.pixels[rows] = np.unpackbits(words.astype('<u2').view(np.uint8), axis=1, bitorder='little')
+            self.dirty_words += int(changed.sum())
+            self.dirty_rows += len(rows)
+        return rows
+
+    def write_pbm(self, pbm_file):
+        with open(pbm_file, 'wb') as out:
+            out.write('P4\n{} {}\n'.format(COLUMNS, ROWS).encode())
+            out.write(np.packbits(self.pixels, axis=1).tobytes())
+
+class Keyboard(object):
+    '''
+    keys waiting to go down, press can be called from any thread: it only
+    appends to a deque and update, on the CPU's thread, is the only one that
+    looks at the first key or takes it off
+    update, once a frame, puts the key that is down into RAM[KBD]: the next
+    queued key goes down if none is, a key that has been down hold seconds
+    comes up for at least a frame so a program waiting for the release sees
+    it; the same key queued again while down keeps it down, as when a held
+    key repeats
+    '''
+    def __init__(self, ram, hold=HOLD):
+        self.ram = ram
+        self.hold = hold
+        self.keys = deque()
+        self.key = 0
+        self.since = 0.0
+
+    def press(self, code):
+        self.keys.append(code)
+
+    def update(self, now):
+        if self.key:
+            while self.keys and self.keys[0] == self.key:
+                self.keys.popleft()
+                self.since = now
+            if now - self.since < self.hold:
+                return
+            self.key = 0
+        else:
+            if not self.keys:
+                return
+            self.key = self.keys.popleft()
+        self.since = now
+        self.ram[KBD] = self.key
+
+class Terminal(object):
+    '''
+    draws a Screen on an ANSI terminal in braille characters of 4 x 2 pixels,
+    scale x scale pixels to a dot, and writes only the lines over dirty rows
+    listen reads keys in cbreak mode on a background thread
+    '''
+    def __init__(self, out=sys.stdout, scale=1):
+        self.out = out
+        self.scale = scale
+        self.width = COLUMNS // (2 * scale)
+        self.lines = ROWS // (4 * scale)
+        self.saved = None
+
+    def open(self):
+        self.out.write('\x1b[2J\x1b[?25l')
+        self.out.flush()
+
+    def close(self):
+        if self.saved is not None:
+            import termios
+            termios.tcsetattr(self.saved[0], termios.TCSADRAIN, self.saved[1])
+            self.saved = None
+        self.out.write('\x1b[?25h\x1b[{};1H\n'.format(self.lines + 1))
+        self.out.flush()
+
+    def draw(self, screen, rows):
+        scale = self.scale
+        lines = np.unique(rows // (4 * scale))
+        pixels = screen.pixels.reshape(self.lines, 4, scale, self.width, 2, scale)[lines]
+        # a dot is black if any pixel under it is
+        cells = pixels.max(axis=(2, 5))
+        codes = 0x2800 + (cells * BRAILLE[:, None, :]).sum(axis=(1, 3))
+        text = codes.astype('<u4').tobytes().decode('utf-32-le')
+        width = self.width
+        self.out.write(''.join('\x1b[{};1H{}'.format(line + 1, text[at * width:(at + 1) * width])
+                               for at, line in enumerate(lines.tolist())))
+        self.out.flush()
+
+    def listen(self, keyboard, fd=None):
+        fd = sys.stdin.fileno() if fd is None else fd
+        if not os.isatty(fd):
+            return
+        import termios
+        import tty
+        self.saved = fd, termios.tcgetattr(fd)
+        tty.setcbreak(fd)
+        def read():
+            while True:
+                data = os.read(fd, 64)
+                if not data:
+                    return
+                for code in parse_keys(data.decode('latin-1')):
+                    keyboard.press(code)
+        threading.Thread(target=read, daemon=True).start()
+
+class Console(object):
+    '''
+    a CPU with its screen and keyboard: the CPU runs in slices of about a
+    tenth of a frame with nothing in its loop, between slices the clock is
+    checked and every 1/fps seconds a frame updates the keyboard, refreshes
+    the screen and hands the rows that changed to draw(screen, rows)
+    frames that fall behind are dropped instead of slowing the CPU
+    '''
+    def __init__(self, cpu, fps=FPS, draw=None, hold=HOLD):
+        self.cpu = cpu
+        self.screen = Screen(cpu.ram)
+        self.keyboard = Keyboard(cpu.ram, hold)
+        self.period = 1.0 / fps
+        self.draw = draw
+        self.slice = 1000
+        self.frames = 0
+
+    def run(self, seconds=None, cycles=None):
+        '''
+        until seconds or cycles run out or the CPU halts, returns the number of instructions run
+        '''
+        cpu, period = self.cpu, self.period
+        start = time.perf_counter()
+        deadline = start + period
+        done = 0
+        while not cpu.halted:
+            budget = self.slice if cycles is None else min(self.slice, cycles - done)
+            if budget <= 0:
+                break
+            began = time.perf_counter()
+            done += cpu.run(budget)
+            now = time.perf_counter()
+            if budget == self.slice and now > began:
+                self.slice = max(100, int(budget * period / SLICES / (now - began)))
+            if now >= deadline:
+                self.frame(now)
+                deadline += period
+                if deadline < now:
+                    deadline = now + period
+            if seconds is not None and now - start >= seconds:
+                break
+        self.frame(time.perf_counter())
+        return done
+
+    def frame(self, now):
+        self.frames += 1
+        self.keyboard.update(now)
+        rows = self.screen.refresh()
+        if self.draw is not None and len(rows):
+            self.draw(self.screen, rows)
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Run an interactive Hack program with its screen on the terminal')
+    arg_parser.add_argument('program', help='a .asm/.hack file, e.g. Pong.asm or the output of VMTranslator.py')
+    arg_parser.add_argument('--fps', type=int, default=FPS,
+                            help='screen refreshes per second')
+    arg_parser.add_argument('--jit', action='store_true',
+                            help='run on the block compiling CPU')
+    arg_parser.add_argument('--seconds', type=float,
+                            help='stop after this long, by default run until the program halts or ctrl-c')
+    arg_parser.add_argument('--cycles', type=int,
+                            help='stop after this many instructions')
+    arg_parser.add_argument('--keys', nargs='+', default=[], metavar='KEY',
+                            help='keys to press one after the other before any typed ones, a character or a key code')
+    arg_parser.add_argument('--hold', type=float, default=HOLD,
+                            help='seconds a key stays down')
+    arg_parser.add_argument('--scale', type=int, default=1, choices=[1, 2, 4],
+                            help='screen pixels per braille dot across and down')
+    arg_parser.add_argument('--headless', action='store_true',
+                            help='draw nothing, only track the screen')
+    arg_parser.add_argument('--snapshot', metavar='PBM',
+                            help='write the last frame to a .pbm image')
+    args = arg_parser.parse_args()
+    cpu = JITCPU(args.program) if args.jit else CPU(args.program)
+    terminal = None if args.headless else Terminal(scale=args.scale)
+    console = Console(cpu, args.fps, None if terminal is None else terminal.draw, args.hold)
+    for key in args.keys:
+        console.keyboard.press(parse_key(key))
+    start = time.perf_counter()
+    if terminal is not None:
+        terminal.open()
+        terminal.listen(console.keyboard)
+    try:
+        console.run(args.seconds, args.cycles)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if terminal is not None:
+            terminal.close()
+    elapsed = time.perf_counter() - start
+    screen = console.screen
+    if args.snapshot:
+        screen.write_pbm(args.snapshot)
+    print('{} cycles in {:.2f}s, {:.0f} per second, {} frames, {} dirty words in {} rows'.format(
+        cpu.cycles, elapsed, cpu.cycles / max(elapsed, 1e-9), console.frames,
+        screen.dirty_words, screen.dirty_rows), file=sys.stderr)
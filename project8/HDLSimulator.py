@@ -0,0 +1,1018 @@
+import hashlib
+import os
+from abc import ABC, abstractmethod
+import pickle
+import re
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from CPUEmulator import TestScript, load_program
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# a part with no .hdl file next to the chip is the built-in one, like the Java simulator
+BUILTIN_DIR = os.path.join(HERE, '../nand2tetris/tools/builtInChips')
+# the chip tests of the course, relative to this file; the simulator sits
+# with the other tools of the course in project8 and runs the scripts with
+# the TestScript of CPUEmulator.py
+# the .hdl files of these projects are the course's empty stubs, so every
+# script fails until its chip is written, as it does in Java; with the chips
+# of 01, 02 and 03 replaced by the .hdl files of tools/builtInChips and CPU,
+# Memory and Computer of 05 written out, all 38 pass (Memory with --keys K Y),
+# and an ALU that ignores no fails ALU and ALU-nostat
+TEST_ROOTS = ['../nand2tetris/projects/01', '../nand2tetris/projects/02',
+              '../nand2tetris/projects/03', '../nand2tetris/projects/05']
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'hdl-netlists')
+# part of every cache key, change it when the netlist layout changes
+NETLIST_VERSION = 1
+# runs of a while loop before the script counts as hung
+WHILE_LIMIT = 10000
+MASK = 0xffff
+SHIFTS = np.arange(16, dtype=np.int64)
+WEIGHTS = np.int64(1) << SHIFTS
+
+def tokenize(text):
+    text = re.sub(r'/\*.*?\*/', ' ', text, flags=re.S)
+    text = re.sub(r'//[^\n]*', ' ', text)
+    return re.findall(r'[A-Za-z_]\w*|\d+|\.\.|\S', text)
+
+class Chip(object):
+    '''
+    a parsed .hdl file: inputs and outputs are (name, width) lists, parts
+    (chip name, connections) with every connection (pin, bits, signal, bits)
+    where bits is a (low, high) range or None for the whole bus
+    '''
+    def __init__(self, name, inputs, outputs, parts, builtin=None, clocked=()):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parts = parts
+        self.builtin = builtin
+        self.clocked = list(clocked)
+        self.widths = dict(inputs + outputs)
+        self.input_names = set(name for name, width in inputs)
+        self.output_names = set(name for name, width in outputs)
+
+class HDLParser(object):
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError('unexpected end of file')
+        self.position += 1
+        return token
+
+    def expect(self, token):
+        got = self.next()
+        if got != token:
+            raise ValueError('expected {} but found {}'.format(token, got))
+
+    def chip(self):
+        self.expect('CHIP')
+        name = self.next()
+        self.expect('{')
+        inputs, outputs, parts, builtin, clocked = [], [], [], None, []
+        while self.peek() != '}':
+            keyword = self.next()
+            if keyword == 'IN':
+                inputs = self.pins()
+            elif keyword == 'OUT':
+                outputs = self.pins()
+            elif keyword == 'PARTS':
+                self.expect(':')
+                while self.peek() not in ('}', None):
+                    parts.append(self.part())
+            elif keyword == 'BUILTIN':
+                builtin = self.next()
+                self.expect(';')
+            elif keyword == 'CLOCKED':
+                clocked = [pin for pin, width in self.pins()]
+            else:
+                raise ValueError('unexpected {}'.format(keyword))
+        self.expect('}')
+        return Chip(name, inputs, outputs, parts, builtin, clocked)
+
+    def pins(self):
+        pins = []
+        while True:
+            name = self.next()
+            width = 1
+            if self.peek() == '[':
+                self.next()
+                width = int(self.next())
+                self.expect(']')
+            pins.append((name, width))
+            token = self.next()
+            if token == ';':
+                return pins
+            if token != ',':
+                raise ValueError('expected , or ; after pin {} but found {}'.format(name, token))
+
+    def bus(self):
+        name = self.next()
+        bits = None
+        if self.peek() == '[':
+            self.next()
+            low = high = int(self.next())
+            if self.peek() == '..':
+                self.next()
+                high = int(self.next())
+            self.expect(']')
+            bits = (low, high)
+        return name, bits
+
+    def part(self):
+        chip = self.next()
+        self.expect('(')
+        connections = []
+        while True:
+            pin, pin_bits = self.bus()
+            self.expect('=')
+            signal, signal_bits = self.bus()
+            connections.append((pin, pin_bits, signal, signal_bits))
+            token = self.next()
+            if token == ')':
+                break
+            if token != ',':
+                raise ValueError('expected , or ) in part {} but found {}'.format(chip, token))
+        self.expect(';')
+        return chip, connections
+
+# path -> (modification time, Chip), so a file is parsed once per process
+PARSED = {}
+
+def parse_file(path):
+    mtime = os.path.getmtime(path)
+    if path not in PARSED or PARSED[path][0] != mtime:
+        # some of the built-in chip files have stray cp1252 bytes in comments
+        with open(path, 'r', encoding='latin-1') as hdl:
+            text = hdl.read()
+        try:
+            PARSED[path] = mtime, HDLParser(text).chip()
+        except ValueError as error:
+            raise ValueError('{}: {}'.format(path, error))
+    return PARSED[path][1]
+
+class ChipLibrary(object):
+    '''
+    the chip a part name means: the .hdl file in directory if there is one,
+    the built-in chip otherwise
+    '''
+    def __init__(self, directory, builtin_dir=BUILTIN_DIR):
+        self.directories = [directory, builtin_dir]
+        self.chips = {}
+
+    def get(self, name):
+        if name in self.chips:
+            return self.chips[name]
+        for directory in self.directories:
+            path = os.path.join(directory, name + '.hdl')
+            if os.path.exists(path):
+                chip = parse_file(path)
+                if chip.name != name:
+                    raise ValueError('{}: chip is called {}'.format(path, chip.name))
+                self.chips[name] = chip
+                return chip
+        raise ValueError('no chip named {}'.format(name))
+
+def bit_range(bits, width, what):
+    if bits is None:
+        return range(width)
+    low, high = bits
+    if not 0 <= low <= high < width:
+        raise ValueError('{}[{}..{}] is outside its {} bits'.format(what, low, high, width))
+    return range(low, high + 1)
+
+def gate_bitwise(op, *names):
+    def build(flattener, pins):
+        for bit, out in enumerate(pins['out']):
+            # a 1-bit input like sel goes to every bit
+            inputs = [pins[name][bit if len(pins[name]) > 1 else 0] for name in names]
+            flattener.union(flattener.gate(op, *inputs), out)
+    return build
+
+def gate_mux(flattener, pins):
+    choices = [name for name in 'abcdefgh' if name in pins]
+    for bit, out in enumerate(pins['out']):
+        nets = [pins[name][bit] for name in choices]
+        for select in pins['sel']:
+            nets = [flattener.gate('mux', nets[x], nets[x + 1], select) for x in range(0, len(nets), 2)]
+        flattener.union(nets[0], out)
+
+def gate_dmux(flattener, pins):
+    select = pins['sel']
+    for x, name in enumerate(name for name in 'abcdefgh' if name in pins):
+        net = pins['in'][0]
+        for bit, selector in enumerate(select):
+            net = flattener.gate('and' if x >> bit & 1 else 'andn', net, selector)
+        flattener.union(net, pins[name][0])
+
+def gate_or8way(flattener, pins):
+    nets = pins['in']
+    while len(nets) > 1:
+        nets = [flattener.gate('or', nets[x], nets[x + 1]) for x in range(0, len(nets), 2)]
+    flattener.union(nets[0], pins['out'][0])
+
+def gate_half_adder(flattener, pins):
+    a, b = pins['a'][0], pins['b'][0]
+    flattener.union(flattener.gate('xor', a, b), pins['sum'][0])
+    flattener.union(flattener.gate('and', a, b), pins['carry'][0])
+
+def gate_full_adder(flattener, pins):
+    a, b, c = pins['a'][0], pins['b'][0], pins['c'][0]
+    half = flattener.gate('xor', a, b)
+    flattener.union(flattener.gate('xor', half, c), pins['sum'][0])
+    carry = flattener.gate('or', flattener.gate('and', a, b), flattener.gate('and', half, c))
+    flattener.union(carry, pins['carry'][0])
+
+# built-in chips that become bit-level gates
+GATES = {
+    'Nand': gate_bitwise('nand', 'a', 'b'),
+    'Not': gate_bitwise('not', 'in'),
+    'And': gate_bitwise('and', 'a', 'b'),
+    'Or': gate_bitwise('or', 'a', 'b'),
+    'Xor': gate_bitwise('xor', 'a', 'b'),
+    'Not16': gate_bitwise('not', 'in'),
+    'And16': gate_bitwise('and', 'a', 'b'),
+    'Or16': gate_bitwise('or', 'a', 'b'),
+    'Mux': gate_mux,
+    'Mux16': gate_mux,
+    'Mux4Way16': gate_mux,
+    'Mux8Way16': gate_mux,
+    'DMux': gate_dmux,
+    'DMux4Way': gate_dmux,
+    'DMux8Way': gate_dmux,
+    'Or8Way': gate_or8way,
+    'HalfAdder': gate_half_adder,
+    'FullAdder': gate_full_adder,
+}
+
+# gate -> its output over the (nets, rows) values of its inputs
+OPS = {
+    'nand': lambda a, b, c: ~(a & b),
+    'not': lambda a, b, c: ~a,
+    'and': lambda a, b, c: a & b,
+    'andn': lambda a, b, c: a & ~b,
+    'or': lambda a, b, c: a | b,
+    'xor': lambda a, b, c: a ^ b,
+    'mux': lambda a, b, c: np.where(c, b, a),
+}
+
+class Netlist(object):
+    '''
+    a chip flattened into bit-level gates, D flip-flops and built-in chips
+    that work on whole words (leaves); net 0 is false and net 1 true
+    steps are in topological order, a step is ('gates', op, out, a, b, c)
+    with the index arrays of every gate of one op and level, or ('leaf', x)
+    a Netlist is plain data so it can be pickled into the cache
+    '''
+    def __init__(self, fields):
+        self.name = fields['name']
+        self.size = fields['size']
+        self.inputs = fields['inputs']
+        self.outputs = fields['outputs']
+        self.leaves = fields['leaves']
+        self.dff_in = fields['dff_in']
+        self.dff_out = fields['dff_out']
+        self.steps = fields['steps']
+
+    def fields(self):
+        return dict(self.__dict__)
+
+    @property
+    def combinational(self):
+        return not len(self.dff_in) and all(leaf[0] in FUNCTIONS for leaf in self.leaves)
+
+class Flattener(object):
+    '''
+    instantiates a chip part by part down to gates, flip-flops and leaves;
+    the nets a part output drives are joined to the nets of the signals it
+    is connected to with a union-find
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.parent = [0, 1]
+        # (op, out, a, b, c)
+        self.gates = []
+        # (builtin, input pin -> nets, output pin -> nets, clocked pins)
+        self.leaves = []
+        # (in, out)
+        self.dffs = []
+        self.stack = []
+
+    def new(self, width):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + width))
+        return list(range(start, start + width))
+
+    def find(self, net):
+        parent = self.parent
+        while parent[net] != net:
+            parent[net] = parent[parent[net]]
+            net = parent[net]
+        return net
+
+    def union(self, a, b):
+        # the lower net stays the root, so the constants stay 0 and 1
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+    def gate(self, op, a, b=0, c=0):
+        out = self.new(1)[0]
+        self.gates.append((op, out, a, b, c))
+        return out
+
+    def instantiate(self, chip, pins):
+        '''
+        pins: pin -> nets of every input and output of chip
+        '''
+        if chip.builtin is not None:
+            return self.builtin(chip, pins)
+        if chip.name in self.stack:
+            raise ValueError('{} is a part of itself'.format(chip.name))
+        self.stack.append(chip.name)
+        parts = [(self.library.get(part), connections) for part, connections in chip.parts]
+        signals = dict(pins)
+        driven = set()
+        # an internal signal is as wide as the part output that drives it
+        for part, connections in parts:
+            for pin, pin_bits, signal, signal_bits in connections:
+                if pin not in part.output_names:
+                    continue
+                width = len(bit_range(pin_bits, part.widths[pin], pin))
+                if signal in chip.input_names or signal in ('true', 'false'):
+                    raise ValueError('{}: {} cannot be driven by {}.{}'.format(chip.name, signal, part.name, pin))
+                if signal in chip.output_names:
+                    bits = bit_range(signal_bits, chip.widths[signal], signal)
+                elif signal_bits is not None:
+                    raise ValueError('{}: internal pin {} cannot be subscripted'.format(chip.name, signal))
+                elif signal in signals:
+                    raise ValueError('{}: {} has more than one source'.format(chip.name, signal))
+                else:
+                    signals[signal] = self.new(width)
+                    bits = range(width)
+                if len(bits) != width:
+                    raise ValueError('{}: {}.{} is {} bits wide, {} is {}'.format(
+                        chip.name, part.name, pin, width, signal, len(bits)))
+                for bit in bits:
+                    if (signal, bit) in driven:
+                        raise ValueError('{}: {}[{}] has more than one source'.format(chip.name, signal, bit))
+                    driven.add((signal, bit))
+        for part, connections in parts:
+            # inputs left unconnected are false
+            part_pins = dict((name, [0] * width) for name, width in part.inputs)
+            part_pins.update((name, self.new(width)) for name, width in part.outputs)
+            for pin, pin_bits, signal, signal_bits in connections:
+                if pin not in part.widths:
+                    raise ValueError('{}: {} has no pin {}'.format(chip.name, part.name, pin))
+                targets = bit_range(pin_bits, part.widths[pin], pin)
+                if signal in ('true', 'false'):
+                    nets = [int(signal == 'true')] * len(targets)
+                elif signal in chip.output_names and pin in part.input_names:
+                    raise ValueError('{}: output {} cannot feed {}.{}'.format(chip.name, signal, part.name, pin))
+                elif signal not in signals:
+                    raise ValueError('{}: {} is not connected to anything'.format(chip.name, signal))
+                else:
+                    nets = signals[signal]
+                    nets = [nets[bit] for bit in bit_range(signal_bits, len(nets), signal)]
+                if len(nets) != len(targets):
+                    raise ValueError('{}: {}.{} is {} bits wide, {} is {}'.format(
+                        chip.name, part.name, pin, len(targets), signal, len(nets)))
+                for bit, net in zip(targets, nets):
+                    if pin in part.input_names:
+                        part_pins[pin][bit] = net
+                    else:
+                        self.union(part_pins[pin][bit], net)
+            self.instantiate(part, part_pins)
+        # outputs nothing drives are false
+        for name, width in chip.outputs:
+            for bit in range(width):
+                if (name, bit) not in driven:
+                    self.union(pins[name][bit], 0)
+        self.stack.pop()
+
+    def builtin(self, chip, pins):
+        if chip.builtin in GATES:
+            GATES[chip.builtin](self, pins)
+        elif chip.builtin == 'DFF':
+            self.dffs.append((pins['in'][0], pins['out'][0]))
+        elif chip.builtin in LEAVES:
+            inputs = dict((pin, pins[pin]) for pin, width in chip.inputs)
+            outputs = dict((pin, pins[pin]) for pin, width in chip.outputs)
+            self.leaves.append((chip.builtin, inputs, outputs, chip.clocked))
+        else:
+            raise ValueError('no built-in implementation of {}'.format(chip.builtin))
+
+    def netlist(self, chip, pins):
+        '''
+        the flattened chip with its nets numbered densely and its gates and
+        leaves put in levels: a node runs after every node that drives its inputs
+        '''
+        roots = np.array([self.find(net) for net in range(len(self.parent))])
+        # 0 and 1 are roots and the smallest, so they keep their numbers
+        used, number = np.unique(roots, return_inverse=True)
+        rename = lambda nets: [int(number[net]) for net in nets]
+        gates = [(op,) + tuple(rename(nets)) for op, *nets in self.gates]
+        leaves = []
+        for builtin, inputs, outputs, clocked in self.leaves:
+            inputs = dict((pin, rename(nets)) for pin, nets in inputs.items())
+            outputs = dict((pin, rename(nets)) for pin, nets in outputs.items())
+            leaves.append((builtin, inputs, outputs, clocked))
+        # every node: the nets it reads before the clock and the nets it drives
+        nodes = [(nets[1:], nets[:1]) for op, *nets in gates]
+        for builtin, inputs, outputs, clocked in leaves:
+            reads = [net for pin, nets in inputs.items() if pin not in clocked for net in nets]
+            nodes.append((reads, [net for nets in outputs.values() for net in nets]))
+        driver = {}
+        for node, (reads, drives) in enumerate(nodes):
+            for net in drives:
+                if net in driver or net < 2:
+                    raise ValueError('{}: a net has more than one source'.format(chip.name))
+                driver[net] = node
+        users = [[] for node in nodes]
+        waiting = [0] * len(nodes)
+        for node, (reads, drives) in enumerate(nodes):
+            for net in reads:
+                if net in driver:
+                    users[driver[net]].append(node)
+                    waiting[node] += 1
+        level = [0] * len(nodes)
+        ready = [node for node in range(len(nodes)) if not waiting[node]]
+        for node in ready:
+            for user in users[node]:
+                level[user] = max(level[user], level[node] + 1)
+                waiting[user] -= 1
+                if not waiting[user]:
+                    ready.append(user)
+        if len(ready) != len(nodes):
+            raise ValueError('{}: combinational loop, a signal feeds back without a clocked part'.format(chip.name))
+        depths = [({}, []) for depth in range(max(level) + 1 if level else 0)]
+        for node, (op, *nets) in enumerate(gates):
+            depths[level[node]][0].setdefault(op, []).append(nets)
+        for x in range(len(leaves)):
+            depths[level[len(gates) + x]][1].append(x)
+        steps = []
+        for groups, leaf_indexes in depths:
+            for op, nets in sorted(groups.items()):
+                steps.append(('gates', op) + tuple(np.array(column, dtype=np.intp) for column in zip(*nets)))
+            steps += [('leaf', x) for x in leaf_indexes]
+        return Netlist(dict(
+            name=chip.name,
+            size=len(used),
+            inputs=[(name, rename(pins[name])) for name, width in chip.inputs],
+            outputs=[(name, rename(pins[name])) for name, width in chip.outputs],
+            leaves=leaves,
+            dff_in=np.array(rename(net for net, out in self.dffs), dtype=np.intp),
+            dff_out=np.array(rename(out for net, out in self.dffs), dtype=np.intp),
+            steps=steps,
+        ))
+
+def flatten(library, name):
+    chip = library.get(name)
+    flattener = Flattener(library)
+    pins = dict((pin, flattener.new(width)) for pin, width in chip.inputs + chip.outputs)
+    flattener.instantiate(chip, pins)
+    return flattener.netlist(chip, pins)
+
+def netlist_key(directory, name, builtin_dir=BUILTIN_DIR):
+    '''
+    a digest of every .hdl file the chip could be made of
+    '''
+    digest = hashlib.sha1('{} {}'.format(NETLIST_VERSION, name).encode())
+    for path in [directory, builtin_dir]:
+        for file_name in sorted(os.listdir(path)):
+            if file_name.endswith('.hdl'):
+                with open(os.path.join(path, file_name), 'rb') as hdl:
+                    digest.update(file_name.encode() + b'\0' + hdl.read() + b'\0')
+    return digest.hexdigest()
+
+def load_netlist(hdl_file, cache_dir=CACHE_DIR):
+    '''
+    the Netlist of a .hdl file, from cache_dir when it was flattened before
+    and none of the .hdl files around it changed since; no cache_dir, no cache
+    '''
+    directory, file_name = os.path.split(os.path.abspath(hdl_file))
+    name = file_name[:-len('.hdl')]
+    if cache_dir is None:
+        return flatten(ChipLibrary(directory), name)
+    path = os.path.join(cache_dir, netlist_key(directory, name) + '.pickle')
+    if os.path.exists(path):
+        with open(path, 'rb') as cached:
+            return Netlist(pickle.load(cached))
+    netlist = flatten(ChipLibrary(directory), name)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written aside and renamed, so parallel runs never read half a file
+    scratch = '{}.{}'.format(path, os.getpid())
+    with open(scratch, 'wb') as cached:
+        pickle.dump(netlist.fields(), cached, pickle.HIGHEST_PROTOCOL)
+    os.replace(scratch, path)
+    return netlist
+
+def signed(value, width=16):
+    if width == 16:
+        return np.where(value & 0x8000, value - 0x10000, value)
+    return value
+
+class Leaf(ABC):
+    '''
+    a built-in chip that works on whole words, one value per row: evaluate
+    maps the packed unclocked inputs to outputs, clock_up latches the inputs
+    on tick and clock_down makes the new state visible on tock
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+        self.everyone = np.arange(rows)
+        self.reset()
+
+    def reset(self):
+        pass
+
+    @abstractmethod
+    def evaluate(self, inputs):
+        '''
+        output pin -> packed words, every leaf has outputs to compute
+        '''
+
+    def clock_up(self, inputs):
+        pass
+
+    def clock_down(self):
+        pass
+
+    def get(self, index):
+        raise ValueError('{} has no inside to look at'.format(type(self).__name__))
+
+    def set(self, index, value):
+        raise ValueError('{} has no inside to set'.format(type(self).__name__))
+
+class Function(Leaf):
+    def __init__(self, function, rows):
+        self.function = function
+        Leaf.__init__(self, rows)
+
+    def evaluate(self, inputs):
+        return self.function(inputs)
+
+def alu(pins):
+    x = np.where(pins['zx'], 0, pins['x'])
+    x = np.where(pins['nx'], x ^ MASK, x)
+    y = np.where(pins['zy'], 0, pins['y'])
+    y = np.where(pins['ny'], y ^ MASK, y)
+    out = np.where(pins['f'], (x + y) & MASK, x & y)
+    out = np.where(pins['no'], out ^ MASK, out)
+    return dict(out=out, zr=(out == 0).astype(np.int64), ng=out >> 15)
+
+# built-in chips with no state, pins -> outputs over packed words
+FUNCTIONS = {
+    'Add16': lambda pins: dict(out=(pins['a'] + pins['b']) & MASK),
+    'Inc16': lambda pins: dict(out=(pins['in'] + 1) & MASK),
+    'ALU': alu,
+}
+
+class Register(Leaf):
+    def __init__(self, rows, width=16):
+        self.mask = (1 << width) - 1
+        Leaf.__init__(self, rows)
+
+    def reset(self):
+        self.state = np.zeros(self.rows, dtype=np.int64)
+        self.next = self.state
+
+    def evaluate(self, inputs):
+        return dict(out=self.state)
+
+    def clock_up(self, inputs):
+        self.next = np.where(inputs['load'], inputs['in'], self.state)
+
+    def clock_down(self):
+        self.state = self.next
+
+    def get(self, index):
+        # the inside shows what was latched on tick, out changes on tock
+        return self.next[0]
+
+    def set(self, index, value):
+        self.state = np.full(self.rows, value & self.mask, dtype=np.int64)
+        self.next = self.state
+
+class ProgramCounter(Register):
+    def clock_up(self, inputs):
+        counted = np.where(inputs['inc'], (self.state + 1) & MASK, self.state)
+        self.next = np.where(inputs['reset'], 0, np.where(inputs['load'], inputs['in'], counted))
+
+class RAM(Leaf):
+    '''
+    reads follow the address at once, a write reaches out on tock
+    '''
+    def __init__(self, rows, size):
+        self.size = size
+        Leaf.__init__(self, rows)
+
+    def reset(self):
+        self.memory = np.zeros((self.rows, self.size), dtype=np.int64)
+        self.pending = None
+
+    def evaluate(self, inputs):
+        return dict(out=self.memory[self.everyone, inputs['address']])
+
+    def clock_up(self, inputs):
+        self.pending = inputs['address'], inputs['in'], inputs['load'].astype(bool)
+
+    def clock_down(self):
+        if self.pending is not None:
+            address, value, load = self.pending
+            self.memory[self.everyone[load], address[load]] = value[load]
+            self.pending = None
+
+    def get(self, index):
+        if self.pending is not None:
+            address, value, load = self.pending
+            if load[0] and address[0] == index:
+                return value[0]
+        return self.memory[0, index]
+
+    def set(self, index, value):
+        self.memory[:, index] = value & MASK
+
+class ROM(RAM):
+    def clock_up(self, inputs):
+        pass
+
+    def load(self, words):
+        self.memory[:] = 0
+        self.memory[:, :len(words)] = np.asarray(words, dtype=np.int64)
+
+class Keyboard(Leaf):
+    def reset(self):
+        self.key = np.zeros(self.rows, dtype=np.int64)
+
+    def evaluate(self, inputs):
+        return dict(out=self.key)
+
+    def get(self, index):
+        return self.key[0]
+
+    def set(self, index, value):
+        self.key[:] = value & MASK
+
+# built-in chip -> Leaf for rows
+LEAVES = {
+    'Bit': lambda rows: Register(rows, 1),
+    'Register': Register,
+    'ARegister': Register,
+    'DRegister': Register,
+    'PC': ProgramCounter,
+    'RAM8': lambda rows: RAM(rows, 8),
+    'RAM64': lambda rows: RAM(rows, 64),
+    'RAM512': lambda rows: RAM(rows, 512),
+    'RAM4K': lambda rows: RAM(rows, 4096),
+    'RAM16K': lambda rows: RAM(rows, 16384),
+    'Screen': lambda rows: RAM(rows, 8192),
+    'ROM32K': lambda rows: ROM(rows, 32768),
+    'Keyboard': Keyboard,
+}
+for builtin, function in FUNCTIONS.items():
+    LEAVES[builtin] = lambda rows, function=function: Function(function, rows)
+
+class Simulator(object):
+    '''
+    runs a Netlist over rows independent copies at once: values is a
+    (nets, rows) bool array and each step sets the outputs of a whole level
+    of gates with one array operation; a leaf gets its buses packed into
+    words and its outputs unpacked back into bits
+    '''
+    def __init__(self, netlist, rows=1):
+        self.netlist = netlist
+        self.rows = rows
+        self.pins = dict(netlist.inputs + netlist.outputs)
+        self.input_names = set(name for name, nets in netlist.inputs)
+        self.leaves = [LEAVES[leaf[0]](rows) for leaf in netlist.leaves]
+        self.names = {}
+        for leaf, spec in zip(self.leaves, netlist.leaves):
+            self.names.setdefault(spec[0], leaf)
+        self.values = np.zeros((netlist.size, rows), dtype=bool)
+        self.steps = [self.compile(step) for step in netlist.steps]
+        self.reset()
+
+    def reset(self):
+        # in place, the compiled steps hold on to values
+        self.values[:] = False
+        self.values[1] = True
+        self.dff_state = np.zeros((len(self.netlist.dff_in), self.rows), dtype=bool)
+        self.dff_next = self.dff_state
+        for leaf in self.leaves:
+            leaf.reset()
+        self.clock = 0
+
+    def pack(self, nets):
+        return np.dot(WEIGHTS[:len(nets)], self.values[nets])
+
+    def unpack(self, nets, words):
+        self.values[nets] = np.asarray(words, dtype=np.int64) >> SHIFTS[:len(nets), None] & 1
+
+    def compile(self, step):
+        values = self.values
+        if step[0] == 'gates':
+            op, out, a, b, c = step[1:]
+            function = OPS[op]
+            def run():
+                values[out] = function(values[a], values[b], values[c])
+            return run
+        leaf = self.leaves[step[1]]
+        builtin, inputs, outputs, clocked = self.netlist.leaves[step[1]]
+        reads = [(pin, nets) for pin, nets in sorted(inputs.items()) if pin not in clocked]
+        writes = sorted(outputs.items())
+        pack, unpack = self.pack, self.unpack
+        def run():
+            outputs = leaf.evaluate(dict((pin, pack(nets)) for pin, nets in reads))
+            for pin, nets in writes:
+                unpack(nets, outputs[pin])
+        return run
+
+    def leaf_inputs(self, x):
+        inputs = self.netlist.leaves[x][1]
+        return dict((pin, self.pack(nets)) for pin, nets in inputs.items())
+
+    def eval(self):
+        self.values[self.netlist.dff_out] = self.dff_state
+        for step in self.steps:
+            step()
+
+    def tick(self):
+        self.eval()
+        self.dff_next = self.values[self.netlist.dff_in]
+        for x, leaf in enumerate(self.leaves):
+            leaf.clock_up(self.leaf_inputs(x))
+        self.clock += 1
+
+    def tock(self):
+        self.dff_state = self.dff_next
+        for leaf in self.leaves:
+            leaf.clock_down()
+        self.eval()
+        self.clock += 1
+
+    def leaf(self, name):
+        if name not in self.names:
+            raise ValueError('{} has no part {}'.format(self.netlist.name, name))
+        return self.names[name]
+
+    def get_rows(self, name):
+        nets = self.pins[name]
+        return signed(self.pack(nets), len(nets))
+
+    def get(self, name):
+        '''
+        a pin, time, or the inside of a built-in part: ARegister[] or RAM16K[7]
+        '''
+        if name == 'time':
+            return '{}{}'.format(self.clock // 2, '+' if self.clock % 2 else '')
+        match = re.match(r'(\w+)\[(\d*)\]$', name)
+        if match is not None:
+            index = int(match.group(2) or 0)
+            return int(signed(self.leaf(match.group(1)).get(index)))
+        if name not in self.pins:
+            raise ValueError('{} has no pin {}'.format(self.netlist.name, name))
+        return int(self.get_rows(name)[0])
+
+    def set(self, name, value):
+        match = re.match(r'(\w+)\[(\d*)\]$', name)
+        if match is not None:
+            self.leaf(match.group(1)).set(int(match.group(2) or 0), value)
+        elif name in self.input_names:
+            self.unpack(self.pins[name], np.asarray(value, dtype=np.int64) & MASK)
+        else:
+            raise ValueError('{} has no input pin {}'.format(self.netlist.name, name))
+
+    def load_rom(self, program_file):
+        self.leaf('ROM32K').load(load_program(program_file))
+
+    def press(self, key):
+        self.leaf('Keyboard').set(0, key)
+
+class Recorder(object):
+    '''
+    stands in for the chip on the first run of a batched script, keeping
+    the inputs of every eval; outputs read as whatever results has for the
+    latest eval, nothing on the first run
+    '''
+    def __init__(self, netlist, results=None):
+        self.name = netlist.name
+        self.widths = dict((name, len(nets)) for name, nets in netlist.inputs + netlist.outputs)
+        self.inputs = dict((name, 0) for name, nets in netlist.inputs)
+        self.results = results
+        self.evals = []
+
+    def set(self, name, value):
+        if name not in self.inputs:
+            raise ValueError('{} has no input pin {}'.format(self.name, name))
+        width = self.widths[name]
+        self.inputs[name] = int(signed(value & ((1 << width) - 1), width))
+
+    def eval(self):
+        self.evals.append(dict(self.inputs))
+
+    def get(self, name):
+        if name in self.inputs:
+            return self.inputs[name]
+        if name not in self.widths:
+            raise ValueError('{} has no pin {}'.format(self.name, name))
+        if self.results is None or not self.evals:
+            return 0
+        return int(self.results[name][len(self.evals) - 1])
+
+def run_batch(netlist, evals):
+    '''
+    every eval of a script at once, the outputs of each as name -> values
+    '''
+    simulator = Simulator(netlist, max(len(evals), 1))
+    for name, nets in netlist.inputs:
+        simulator.set(name, [row[name] for row in evals] or 0)
+    simulator.eval()
+    return dict((name, simulator.get_rows(name)) for name, nets in netlist.outputs)
+
+def parse_value(token):
+    '''
+    a value in a script: 7, -7, %B101, %XFF or %D7
+    '''
+    if token.startswith('%B'):
+        return int(token[2:], 2)
+    if token.startswith('%X'):
+        return int(token[2:], 16)
+    if token.startswith('%D'):
+        return int(token[2:])
+    return int(token)
+
+# commands a script can use and still run as one batch
+BATCH_COMMANDS = set(['load', 'output-file', 'compare-to', 'output-list', 'set', 'eval', 'output',
+                      'echo', 'clear-echo', 'repeat'])
+
+class HDLScript(TestScript):
+    '''
+    a chip test script of projects 01-05; when the chip has no state and the
+    script only sets, evals and outputs, the script runs twice: once to
+    collect the inputs of every eval, then again with the outputs of all of
+    them from a single Simulator pass with one row per eval
+    keys are pressed one by one on the Keyboard as the script enters a while
+    loop, for the scripts that wait for someone at the keyboard
+    '''
+    STEPS = []
+
+    def __init__(self, tst_file, cache_dir=CACHE_DIR, keys=()):
+        TestScript.__init__(self, tst_file)
+        self.cache_dir = cache_dir
+        self.keys = list(keys)
+        self.netlists = {}
+        self.results = None
+        self.batched = False
+
+    def netlist(self, file_name):
+        if file_name not in self.netlists:
+            self.netlists[file_name] = load_netlist(os.path.join(self.dir, file_name), self.cache_dir)
+        return self.netlists[file_name]
+
+    def keywords(self, commands):
+        for command in commands:
+            if isinstance(command, tuple):
+                yield command[0]
+                for keyword in self.keywords(command[2]):
+                    yield keyword
+            else:
+                yield command[0]
+
+    def batchable(self):
+        loads = [command[1] for command in self.commands if isinstance(command, list) and command[0] == 'load']
+        if len(loads) != 1 or not set(self.keywords(self.commands)) <= BATCH_COMMANDS:
+            return False
+        return self.netlist(loads[0]).combinational
+
+    def run(self, target=None, program=None):
+        self.output = []
+        self.target = None
+        self.batched = self.batchable()
+        if self.batched:
+            self.results = None
+            self.execute(self.commands)
+            self.results = run_batch(self.target_netlist, self.target.evals)
+            self.output = []
+        self.execute(self.commands)
+        return self.compare()
+
+    def execute_block(self, keyword, args, body):
+        if keyword != 'while':
+            return TestScript.execute_block(self, keyword, args, body)
+        if self.keys:
+            self.target.press(self.keys.pop(0))
+        for x in range(WHILE_LIMIT):
+            if not self.condition(args):
+                return
+            self.execute(body)
+        raise ValueError('while {} still running after {} times, is it waiting for --keys?'.format(
+            ' '.join(args), WHILE_LIMIT))
+
+    def execute_command(self, command):
+        keyword, args = command[0], command[1:]
+        if keyword == 'load':
+            self.target_netlist = self.netlist(args[0])
+            if self.batched:
+                self.target = Recorder(self.target_netlist, self.results)
+            else:
+                self.target = Simulator(self.target_netlist)
+        elif keyword == 'set':
+            self.target.set(args[0], parse_value(args[1]))
+        elif keyword == 'eval':
+            self.target.eval()
+        elif keyword == 'tick':
+            self.target.tick()
+        elif keyword == 'tock':
+            self.target.tock()
+        elif keyword == 'ROM32K' and args[0] == 'load':
+            self.target.load_rom(os.path.join(self.dir, args[1]))
+        elif keyword not in ('echo', 'clear-echo', 'output-file'):
+            TestScript.execute_command(self, command)
+
+def find_scripts(roots):
+    '''
+    every .tst script under roots that loads a .hdl chip
+    '''
+    scripts = []
+    for root in roots:
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if not name.endswith('.tst'):
+                    continue
+                path = os.path.join(dirpath, name)
+                with open(path, 'r') as tst:
+                    if re.search(r'^\s*load\s+\S+\.hdl', tst.read(), re.M):
+                        scripts.append(path)
+    return scripts
+
+def run_script(tst_file, cache_dir=CACHE_DIR, keys=()):
+    result = dict(test=tst_file, name=os.path.basename(tst_file)[:-4], passed=False, failure=None,
+                  error=None, seconds=0.0, batched=False)
+    start = time.perf_counter()
+    try:
+        script = HDLScript(tst_file, cache_dir, keys)
+        result['passed'] = script.run()
+        result['failure'] = script.failure
+        result['batched'] = script.batched
+    except ValueError as error:
+        result['error'] = str(error)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def report(results):
+    lines = []
+    for result in results:
+        lines.append('{:<4} {:<24} {:>8.1f} ms{}'.format(
+            'ok' if result['passed'] else 'FAIL', result['name'], result['seconds'] * 1000,
+            '  batched' if result['batched'] else ''))
+        if result['error']:
+            lines.append('     ' + result['error'])
+        elif not result['passed']:
+            lines.append('     comparison failure at line {}'.format(result['failure']))
+    passed = sum(1 for result in results if result['passed'])
+    lines.append('{} of {} passed'.format(passed, len(results)))
+    return lines
+
+def parse_key(key):
+    '''
+    K or 75
+    '''
+    return int(key) if key.isdigit() and len(key) > 1 else ord(key)
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Run the .tst scripts of chips written in HDL')
+    arg_parser.add_argument('paths', nargs='*', default=[os.path.join(HERE, root) for root in TEST_ROOTS],
+                            help='.tst scripts or directories of them, projects 01, 02, 03 and 05 by default')
+    arg_parser.add_argument('--keys', nargs='+', default=[], metavar='KEY',
+                            help='keys to hold down, one per while loop of a script, a character or a key code')
+    arg_parser.add_argument('--cache', default=CACHE_DIR, metavar='DIR',
+                            help='where flattened netlists are kept between runs')
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help='flatten every chip again')
+    args = arg_parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache
+    scripts = []
+    for path in args.paths:
+        scripts += [path] if path.endswith('.tst') else find_scripts([path])
+    start = time.perf_counter()
+    results = [run_script(script, cache_dir, [parse_key(key) for key in args.keys]) for script in scripts]
+    for line in report(results):
+        print(line)
+    print('{:.2f}s'.format(time.perf_counter() - start), file=sys.stderr)
+    if not all(result['passed'] for result in results):
+        sys.exit(1)
@@ -0,0 +1,124 @@
+LABEL = '('
+
+# M=... instructions that only touch RAM[A], so A and D are still valid after them
+IN_PLACE = ['M=M+D', 'M=M-D', 'M=D+M', 'M=D-M', 'M=M&D', 'M=D&M', 'M=M|D', 'M=D|M',
+            'M=-M', 'M=!M', 'M=D', 'M=0', 'M=-1', 'M=1']
+
+class Peephole(object):
+    '''
+    rule-driven rewrites over a buffered Hack instruction stream
+    '''
+    def __init__(self):
+        self.rules = self.rule_list()
+        self.saved = dict((name, 0) for name, size, first, rule in self.rules)
+
+    def rule_list(self):
+        # (name, window size, first command or None for any, rule),
+        # a rule returns the replacement or None
+        return [
+            ('push-pop fusion', 9, '@SP', self.push_pop),
+            ('push-pop fusion', 8, '@SP', self.push_pop_top),
+            ('redundant SP adjustment', 4, '@SP', self.sp_adjust),
+            ('in-place stack top', 5, '@SP', self.in_place_top),
+            ('SP decrement', 3, '@SP', self.sp_decrement),
+            ('dead @X load', 2, None, self.dead_load),
+        ]
+
+    def optimize(self, lines):
+        '''
+        lines is a list of (command, code) pairs as given to CodeWriter.write,
+        labels stop a rule from matching across them, comments are skipped over
+        one pass: the rules are tried in order on the window starting at each
+        line, a replacement goes back in front of the lines still to come and
+        the lines a window reaching into it could start at are looked at again
+        '''
+        # the rules a window starting with a given command can match, in order
+        # and the widest of them
+        anywhere = [rule for rule in self.rules if rule[2] is None]
+        anywhere = anywhere, max(rule[1] for rule in anywhere)
+        starting = {}
+        for name, size, first, rule in self.rules:
+            if first is not None:
+                rules = [other for other in self.rules if other[2] in (None, first)]
+                starting[first] = rules, max(other[1] for other in rules)
+        widest = max(rule[1] for rule in self.rules)
+        out = []
+        append = out.append
+        # the lines still to come, the next one last
+        rest = lines[::-1]
+        while rest:
+            line = rest.pop()
+            command = line[0]
+            # every window starts with an A load
+            if not line[1] or command[0] != '@':
+                append(line)
+                continue
+            rules, width = starting.get(command, anywhere)
+            window = [command]
+            # where the rest of the window is in rest
+            positions = []
+            j = len(rest)
+            while j and len(window) < width:
+                j -= 1
+                following = rest[j]
+                if following[1]:
+                    window.append(following[0])
+                    positions.append(j)
+                elif following[0][0] == LABEL:
+                    break
+            for name, size, first, rule in rules:
+                if len(window) < size:
+                    continue
+                replace = rule(window[:size])
+                if replace is None:
+                    continue
+                low = positions[size - 2]
+                # comments inside the window go in front of the replacement
+                out.extend(note for note in reversed(rest[low:]) if not note[1])
+                del rest[low:]
+                rest.extend((command, True) for command in reversed(replace))
+                self.saved[name] += size - len(replace)
+                self.back_up(out, rest, widest - 1)
+                break
+            else:
+                append(line)
+        return out
+
+    def back_up(self, out, rest, count):
+        # return the last count code lines of out to rest, not past a label
+        while count and out and not out[-1][0].startswith(LABEL):
+            line = out.pop()
+            rest.append(line)
+            if line[1]:
+                count -= 1
+
+    def push_pop(self, window):
+        # push D; pop D leaves D, A and RAM[SP] exactly as the store alone does
+        if window == ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1', '@SP', 'M=M-1', 'A=M', 'D=M']:
+            return ['@SP', 'A=M', 'M=D']
+
+    def push_pop_top(self, window):
+        # the same with the pop already as @SP AM=M-1 D=M
+        if window == ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1', '@SP', 'AM=M-1', 'D=M']:
+            return ['@SP', 'A=M', 'M=D']
+
+    def sp_adjust(self, window):
+        if window in (['@SP', 'M=M+1', '@SP', 'M=M-1'], ['@SP', 'M=M-1', '@SP', 'M=M+1']):
+            return ['@SP']
+
+    def in_place_top(self, window):
+        # pop, operate on the top, push it back: leave SP where it was
+        if window[:2] == ['@SP', 'AM=M-1'] and window[2] in IN_PLACE and window[3:] == ['@SP', 'M=M+1']:
+            return ['@SP', 'A=M-1', window[2]]
+
+    def sp_decrement(self, window):
+        if window == ['@SP', 'M=M-1', 'A=M']:
+            return ['@SP', 'AM=M-1']
+
+    def dead_load(self, window):
+        # the first A load is overwritten before anything reads it
+        if window[0].startswith('@') and window[1].startswith('@'):
+            return [window[1]]
+
+    def report(self):
+        return ['{}: {} instructions saved'.format(name, count) for name, count in self.saved.items()]
@@ -0,0 +1,250 @@
+from array import array
+
+from Assembler import Assembler
+from CPUEmulator import CPU
+from VMTranslator import find_vm_files, source_map, translate
+
+# frames followed from LCL before a broken chain is given up on
+MAX_DEPTH = 4096
+# the $$ code that is part of making or leaving a frame, the other $$
+# routines are called like leaf functions
+FRAMED = ('$$INIT', '$$CALL', '$$RETURN')
+
+class ProfileCPU(CPU):
+    '''
+    Hack CPU that counts the cycles spent at every pc, and the cycles spent
+    in every VM call stack: owners[pc] is the function pc belongs to, the
+    callers are found by following the saved LCL of every frame up from LCL
+    and looking up the owner of the call before its return address
+    '''
+    def __init__(self, program, owners, moving=None, returns=None, leaves=()):
+        self.owners = owners
+        # pcs of return sequences, LCL changes there before the new function runs
+        self.moving = moving or bytearray(len(owners))
+        # for the pcs of a call, the address it returns to
+        self.returns = returns or array('l', [-1]) * len(owners)
+        # owners without a frame of their own, the shared compare routines
+        self.leaves = set(leaves)
+        CPU.__init__(self, program)
+
+    def load(self, program):
+        CPU.load(self, program)
+        self.counts = array('L', [0]) * len(self.words)
+        # call stack, a tuple of owners outermost first -> cycles
+        self.stacks = {}
+        self.stack = ()
+        self.top = None
+        self.lcl = None
+
+    def walk(self, pc, stack=()):
+        '''
+        the call stack at pc, stack is the one so far
+        '''
+        ram, owners = self.ram, self.owners
+        if owners[pc] in self.leaves:
+            # called from whatever ran before it
+            if stack and stack[-1] in self.leaves:
+                stack = stack[:-1]
+            return stack + (owners[pc],)
+        frame = ram[1]
+        stack = [owners[pc]]
+        if self.returns[pc] >= 0 and frame >= 5 and ram[frame - 5] == self.returns[pc]:
+            # the callee's frame is set up but it has not been jumped to yet
+            stack = []
+        while 5 <= frame and len(stack) < MAX_DEPTH:
+            address = ram[frame - 5]
+            if not 0 < address <= len(owners):
+                break
+            # the jump just before the return address is the caller's
+            stack.append(owners[address - 1])
+            caller = ram[frame - 4]
+            if caller >= frame:
+                break
+            frame = caller
+        return tuple(reversed(stack))
+
+    def run(self, cycles):
+        handlers, counts, ram = self.handlers, self.counts, self.ram
+        owners, moving, stacks = self.owners, self.moving, self.stacks
+        A, D, pc = self.A, self.D, self.pc
+        stack, top, lcl = self.stack, self.top, self.lcl
+        done = mark = 0
+        try:
+            for done in range(cycles):
+                if (owners[pc] != top or ram[1] != lcl) and not moving[pc]:
+                    stacks[stack] = stacks.get(stack, 0) + done - mark
+                    mark = done
+                    top, lcl = owners[pc], ram[1]
+                    stack = self.walk(pc, stack)
+                counts[pc] += 1
+                A, D, pc = handlers[pc](A, D, pc)
+            else:
+                done = cycles
+        except IndexError:
+            pass
+        stacks[stack] = stacks.get(stack, 0) + done - mark
+        self.A, self.D, self.pc = A, D, pc
+        self.stack, self.top, self.lcl = stack, top, lcl
+        self.cycles += done
+        return done
+
+class Profile(object):
+    '''
+    cycle counts of a ProfileCPU run grouped by VM command, kind of command,
+    function and call stack, with the source map of the translation
+    '''
+    def __init__(self, entries, size):
+        self.entries = entries
+        self.functions = sorted(set(entry['function'] or '?' for entry in entries))
+        ids = dict((function, x) for x, function in enumerate(self.functions))
+        self.owners = array('l', [0]) * size
+        self.moving = bytearray(size)
+        self.returns = array('l', [-1]) * size
+        self.leaves = [ids[function] for function in self.functions
+                       if function.startswith('$$') and function not in FRAMED]
+        for entry in entries:
+            command = entry['command'] or ''
+            for pc in range(entry['start'], min(entry['end'], size)):
+                self.owners[pc] = ids[entry['function'] or '?']
+                if command == 'return' or entry['function'] in ('$$CALL', '$$RETURN'):
+                    self.moving[pc] = 1
+                elif command.startswith('call ') or entry['function'] == '$$INIT':
+                    # the bootstrap is one call Sys.init
+                    self.returns[pc] = entry['end']
+
+    def cpu(self, words):
+        return ProfileCPU(words, self.owners, self.moving, self.returns, self.leaves)
+
+    def commands(self, cpu):
+        '''
+        (cycles, times run, entry) per translated command, most cycles first
+        '''
+        rows = []
+        for entry in self.entries:
+            cycles = sum(cpu.counts[entry['start']:entry['end']])
+            if cycles:
+                rows.append((cycles, cpu.counts[entry['start']], entry))
+        return sorted(rows, key=lambda row: -row[0])
+
+    def kinds(self, cpu):
+        '''
+        kind -> [cycles, times run], push local and call count as kinds of their own
+        '''
+        kinds = {}
+        for cycles, runs, entry in self.commands(cpu):
+            words = (entry['command'] or entry['function'] or '?').split()
+            kind = ' '.join(words[:2]) if words[0] in ('push', 'pop') else words[0]
+            total = kinds.setdefault(kind, [0, 0])
+            total[0] += cycles
+            total[1] += runs
+        return kinds
+
+    def self_cycles(self, cpu):
+        cycles = dict((function, 0) for function in self.functions)
+        for pc, count in enumerate(cpu.counts):
+            cycles[self.functions[self.owners[pc]]] += count
+        return cycles
+
+    def call_graph(self, cpu):
+        '''
+        function -> inclusive cycles, (caller, callee) -> cycles spent in callee
+        called from caller, from the call stacks the CPU saw
+        '''
+        inclusive = {}
+        edges = {}
+        for stack, cycles in cpu.stacks.items():
+            names = [self.functions[owner] for owner in stack]
+            for name in set(names):
+                inclusive[name] = inclusive.get(name, 0) + cycles
+            for edge in set(zip(names, names[1:])):
+                edges[edge] = edges.get(edge, 0) + cycles
+        return inclusive, edges
+
+    def collapsed(self, cpu):
+        '''
+        one line per call stack, outermost function first, in the collapsed
+        stack format flamegraph.pl and speedscope read
+        '''
+        lines = []
+        for stack, cycles in sorted(cpu.stacks.items()):
+            if stack and cycles:
+                lines.append('{} {}'.format(';'.join(self.functions[owner] for owner in stack), cycles))
+        return lines
+
+    def report(self, cpu, top=20):
+        cycles_run = max(cpu.cycles, 1)
+        percent = lambda cycles: 100.0 * cycles / cycles_run
+        lines = ['{} cycles'.format(cpu.cycles), '', 'commands:',
+                 '{:>10} {:>6} {:>9}  {:<24} {}'.format('cycles', '%', 'runs', 'where', 'command')]
+        for cycles, runs, entry in self.commands(cpu)[:top]:
+            where = entry['function'] or '?'
+            if entry['file'] is not None:
+                where = '{}:{}'.format(entry['file'], entry['line'] or '?')
+            lines.append('{:>10} {:>6.2f} {:>9}  {:<24} {}'.format(
+                cycles, percent(cycles), runs, where, entry['command'] or entry['function']))
+        lines += ['', 'kinds:', '{:>10} {:>6} {:>9}  {}'.format('cycles', '%', 'runs', 'kind')]
+        kinds = sorted(self.kinds(cpu).items(), key=lambda item: -item[1][0])
+        for kind, (cycles, runs) in kinds[:top]:
+            lines.append('{:>10} {:>6.2f} {:>9}  {}'.format(cycles, percent(cycles), runs, kind))
+        inclusive, edges = self.call_graph(cpu)
+        self_cycles = self.self_cycles(cpu)
+        lines += ['', 'functions:', '{:>10} {:>6} {:>10} {:>6}  {}'.format('self', '%', 'total', '%', 'function')]
+        for function in sorted(self.functions, key=lambda function: -self_cycles[function])[:top]:
+            if not self_cycles[function]:
+                break
+            # $$CALL and $$RETURN run between frames, on no stack of their own
+            total = max(inclusive.get(function, 0), self_cycles[function])
+            lines.append('{:>10} {:>6.2f} {:>10} {:>6.2f}  {}'.format(
+                self_cycles[function], percent(self_cycles[function]), total, percent(total), function))
+        lines += ['', 'call graph:']
+        for function in sorted(inclusive, key=lambda function: -inclusive[function])[:top]:
+            lines.append('{} {}'.format(function, inclusive[function]))
+            for (caller, callee), cycles in sorted(edges.items(), key=lambda item: -item[1]):
+                if callee == function:
+                    lines.append('    <- {} {}'.format(caller, cycles))
+            for (caller, callee), cycles in sorted(edges.items(), key=lambda item: -item[1]):
+                if caller == function:
+                    lines.append('    -> {} {}'.format(callee, cycles))
+        return lines
+
+def profile(file_path, cycles, bootstrap=True, whole_program=False, inline=False, **options):
+    '''
+    translate a .vm file or directory with comments on, run it on a ProfileCPU
+    returns the Profile and the CPU
+    '''
+    vm_files = find_vm_files(file_path)[1]
+    lines = translate(vm_files, bootstrap=bootstrap, whole_program=whole_program, inline=inline,
+                      comments=True, **options)
+    words = Assembler(lines).words
+    result = Profile(source_map(lines, vm_files), len(words))
+    cpu = result.cpu(words)
+    if not bootstrap:
+        cpu.ram[0] = 256
+    cpu.run(cycles)
+    return result, cpu
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Count where translated VM code spends its Hack cycles')
+    arg_parser.add_argument('file_path', help='a .vm file or a directory of .vm files')
+    arg_parser.add_argument('--cycles', type=int, default=10000000,
+                            help='instructions to run the program for')
+    arg_parser.add_argument('--top', type=int, default=20,
+                            help='rows per table')
+    arg_parser.add_argument('--collapsed', metavar='FILE',
+                            help='write the call stacks in collapsed stack format for flame graphs')
+    arg_parser.add_argument('--no-bootstrap', action='store_true',
+                            help='leave out the bootstrap code, start at the first file with SP=256')
+    for flag in ['--trampoline', '--optimize', '--cache-top', '--fold', '--shared-compare',
+                 '--whole-program', '--inline']:
+        arg_parser.add_argument(flag, action='store_true', help='translate with VMTranslator.py ' + flag)
+    args = arg_parser.parse_args()
+    result, cpu = profile(args.file_path, args.cycles, bootstrap=not args.no_bootstrap,
+                          whole_program=args.whole_program, inline=args.inline, trampoline=args.trampoline,
+                          optimize=args.optimize, cache_top=args.cache_top, fold=args.fold,
+                          shared_compare=args.shared_compare)
+    for line in result.report(cpu, args.top):
+        print(line)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as collapsed:
+            collapsed.write(''.join(line + '\n' for line in result.collapsed(cpu)))
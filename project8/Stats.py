@@ -0,0 +1,79 @@
+import time
+from contextlib import contextmanager
+
+# the order phases are reported in
+PHASES = ['scan', 'parse', 'optimize', 'fold', 'generate', 'peephole', 'write', 'other']
+
+class Stats(object):
+    '''
+    opt-in timers and counters of a translation: seconds per phase, commands
+    per kind with the instructions written for them, and output bytes
+    a phase started inside another is not counted in the outer one, so the
+    phases add up to the whole run
+    every hook is called as hook(event, name, value) with
+    ('phase', phase, seconds), ('command', kind, instructions), ('bytes', None, count)
+    a Stats that is not enabled records nothing and costs next to nothing
+    '''
+    def __init__(self, hooks=(), enabled=True):
+        self.enabled = enabled
+        self.hooks = list(hooks)
+        self.seconds = {}
+        self.commands = {}
+        self.instructions = {}
+        self.bytes = 0
+        # [phase, seconds spent in the phases inside it] per running phase
+        self.running = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def notify(self, event, name, value):
+        for hook in self.hooks:
+            hook(event, name, value)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        self.running.append([name, 0.0])
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            inner = self.running.pop()[1]
+            if self.running:
+                self.running[-1][1] += seconds
+            self.add_time(name, seconds - inner)
+
+    def add_time(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        if self.hooks:
+            self.notify('phase', name, seconds)
+
+    def add_command(self, kind, instructions):
+        self.commands[kind] = self.commands.get(kind, 0) + 1
+        self.instructions[kind] = self.instructions.get(kind, 0) + instructions
+        if self.hooks:
+            self.notify('command', kind, instructions)
+
+    def add_bytes(self, count):
+        self.bytes += count
+        if self.hooks:
+            self.notify('bytes', None, count)
+
+    def report(self):
+        lines = []
+        for name in PHASES + sorted(set(self.seconds) - set(PHASES)):
+            if name in self.seconds:
+                lines.append('{:<10} {:>9.4f}s'.format(name, self.seconds[name]))
+        lines.append('{:<10} {:>9.4f}s'.format('total', sum(self.seconds.values())))
+        for kind in sorted(self.commands, key=lambda kind: -self.instructions[kind]):
+            lines.append('{:<10} {:>9} commands {:>10} instructions'.format(
+                kind, self.commands[kind], self.instructions[kind]))
+        lines.append('{} bytes written'.format(self.bytes))
+        return lines
+
+# what a CodeWriter without stats uses
+NO_STATS = Stats(enabled=False)
@@ -0,0 +1,351 @@
+from VMProgram import COMMAND_TYPES, SCRATCH
+from VMTranslator import Parser, find_vm_files
+
+RAM_SIZE = 32768
+
+SEGMENT_POINTERS = {
+    'local': 1, # LCL
+    'argument': 2, # ARG
+    'this': 3, # THIS
+    'that': 4, # THAT
+}
+
+SEGMENT_BASES = {
+    'pointer': 3, # R3, R4
+    'temp': 5, # R5-12
+}
+
+FUSED_JUMPS = {
+    'if-eq': lambda x, y: x == y, 'if-eq0': lambda x, y: x == y,
+    'if-ne': lambda x, y: x != y,
+    'if-lt': lambda x, y: x < y, 'if-lt0': lambda x, y: x < y,
+    'if-ge': lambda x, y: x >= y, 'if-ge0': lambda x, y: x >= y,
+    'if-gt': lambda x, y: x > y, 'if-gt0': lambda x, y: x > y,
+    'if-le': lambda x, y: x <= y, 'if-le0': lambda x, y: x <= y,
+}
+
+def wrap(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+class VMEmulator(object):
+    '''
+    runs VM commands directly: the memory is one list laid out like the Hack
+    RAM (SP, LCL, ARG, THIS, THAT in RAM[0-4], the stack from there on), every
+    command is compiled once into a closure pc -> next pc, with labels and
+    functions resolved to command indexes up front (a label is not a step)
+    '''
+    def __init__(self, program=None):
+        self.ram = [0] * RAM_SIZE
+        self.code = []
+        self.commands = []
+        self.functions = {}
+        self.pc = 0
+        self.steps = 0
+        if program is not None:
+            self.load(program)
+
+    def load(self, program):
+        '''
+        program: a .vm file, a directory of them, or a list of .vm paths and
+        (name, VMProgram) pairs, such as the folded programs of VMOptimizer
+        '''
+        vm_files = find_vm_files(program)[1] if isinstance(program, str) else program
+        self.commands = []
+        self.labels = {}
+        for vm_file in vm_files:
+            self.read(vm_file)
+        self.resolve()
+        self.code = [self.compile(*command) for command in self.commands]
+        self.pc = self.functions.get('Sys.init', 0)
+
+    def instructions(self, vm_file):
+        '''
+        (command type, words) of every command of a .vm path or (name, VMProgram) pair
+        '''
+        if not isinstance(vm_file, str):
+            name, program = vm_file
+            for i in range(len(program)):
+                words = program.words(i)
+                yield COMMAND_TYPES[words[0]], words
+            return
+        parser = Parser(vm_file)
+        try:
+            while parser.has_next_instruction:
+                parser.next()
+                yield parser.command_type, parser.curr_instruction
+        finally:
+            parser.close()
+
+    def read(self, vm_file):
+        name = vm_file if isinstance(vm_file, str) else vm_file[0]
+        curr_file = name.replace('.vm', '').split('/')[-1]
+        function = None
+        for command_type, instruction in self.instructions(vm_file):
+            if command_type == 'C_FUNCTION' and instruction[0] == 'function':
+                function = instruction[1]
+            elif instruction[0] == 'label':
+                # not a step of its own, it names the command after it
+                self.labels[(curr_file, function, instruction[1])] = len(self.commands)
+                continue
+            # file, function, command type, words
+            self.commands.append((curr_file, function, command_type, instruction))
+
+    def resolve(self):
+        self.functions = {}
+        self.statics = {}
+        for index, (curr_file, function, command_type, instruction) in enumerate(self.commands):
+            if instruction[0] == 'function':
+                self.functions[instruction[1]] = index
+            elif command_type == 'C_PP' and instruction[1] in ('static', SCRATCH):
+                # the same first-come order the assembler gives File.i and
+                # $$INLINEi variables, the inliner's scratch belongs to no file
+                owner = curr_file if instruction[1] == 'static' else None
+                self.statics.setdefault((owner, int(instruction[2])), 16 + len(self.statics))
+
+    def compile(self, curr_file, function, command_type, instruction):
+        ram = self.ram
+        operation = instruction[0]
+
+        if command_type == 'C_PP':
+            segment, index = instruction[1], int(instruction[2])
+            if segment in SEGMENT_POINTERS:
+                pointer = SEGMENT_POINTERS[segment]
+                if operation == 'push':
+                    def command(pc):
+                        sp = ram[0]
+                        ram[sp] = ram[ram[pointer] + index]
+                        ram[0] = sp + 1
+                        return pc + 1
+                else:
+                    def command(pc):
+                        sp = ram[0] - 1
+                        ram[0] = sp
+                        ram[ram[pointer] + index] = ram[sp]
+                        return pc + 1
+                return command
+            if segment == 'constant':
+                def command(pc):
+                    sp = ram[0]
+                    ram[sp] = index
+                    ram[0] = sp + 1
+                    return pc + 1
+                return command
+            if segment == 'static':
+                address = self.statics[(curr_file, index)]
+            elif segment == SCRATCH:
+                address = self.statics[(None, index)]
+            else:
+                address = SEGMENT_BASES[segment] + index
+            if operation == 'push':
+                def command(pc):
+                    sp = ram[0]
+                    ram[sp] = ram[address]
+                    ram[0] = sp + 1
+                    return pc + 1
+            else:
+                def command(pc):
+                    sp = ram[0] - 1
+                    ram[0] = sp
+                    ram[address] = ram[sp]
+                    return pc + 1
+            return command
+
+        elif command_type == 'C_ARITHMETIC':
+            return self.compile_arithmetic(operation)
+
+        elif command_type == 'C_BRANCH':
+            target = self.labels.get((curr_file, function, instruction[1]))
+            if target is None:
+                raise ValueError('unknown label: {}'.format(instruction[1]))
+            if operation == 'goto':
+                return lambda pc: target
+            if operation in FUSED_JUMPS:
+                return self.compile_jump(operation, target)
+            def command(pc):
+                sp = ram[0] - 1
+                ram[0] = sp
+                return target if ram[sp] else pc + 1
+            return command
+
+        elif command_type == 'C_FUNCTION' and operation == 'function':
+            zeros = [0] * int(instruction[2])
+            count = len(zeros)
+            def command(pc):
+                sp = ram[0]
+                ram[sp:sp + count] = zeros
+                ram[0] = sp + count
+                return pc + 1
+            return command
+
+        elif command_type == 'C_FUNCTION':
+            name, args = instruction[1], int(instruction[2])
+            if name not in self.functions:
+                def command(pc):
+                    raise ValueError('call to undefined function {}'.format(name))
+                return command
+            target = self.functions[name]
+            def command(pc):
+                sp = ram[0]
+                ram[sp] = pc + 1
+                ram[sp + 1:sp + 5] = ram[1:5]
+                ram[2] = sp - args
+                ram[1] = ram[0] = sp + 5
+                return target
+            return command
+
+        elif command_type == 'C_RETURN':
+            def command(pc):
+                frame = ram[1]
+                arg = ram[2]
+                address = ram[frame - 5]
+                ram[arg] = ram[ram[0] - 1]
+                ram[0] = arg + 1
+                ram[1:5] = ram[frame - 4:frame]
+                return address
+            return command
+
+        raise ValueError('unknown command: {}'.format(' '.join(instruction)))
+
+    def compile_jump(self, operation, target):
+        '''
+        the optimizer's compare-and-branch commands, if-lt L and if-lt0 L
+        '''
+        ram = self.ram
+        condition = FUSED_JUMPS[operation]
+        if operation.endswith('0'):
+            def command(pc):
+                sp = ram[0] - 1
+                ram[0] = sp
+                return target if condition(ram[sp], 0) else pc + 1
+            return command
+        def command(pc):
+            sp = ram[0] - 2
+            ram[0] = sp
+            return target if condition(ram[sp], ram[sp + 1]) else pc + 1
+        return command
+
+    def compile_arithmetic(self, operation):
+        '''
+        and, or, sub, add, neg, not, eq, lt, gt, and the optimizer's eq0, lt0, gt0
+        '''
+        ram = self.ram
+        if operation in ['neg', 'not', 'eq0', 'lt0', 'gt0']:
+            unary = {
+                'neg': lambda y: wrap(-y),
+                'not': lambda y: ~y,
+                'eq0': lambda y: -1 if y == 0 else 0,
+                'lt0': lambda y: -1 if y < 0 else 0,
+                'gt0': lambda y: -1 if y > 0 else 0,
+            }[operation]
+            def command(pc):
+                sp = ram[0] - 1
+                ram[sp] = unary(ram[sp])
+                return pc + 1
+            return command
+        binary = {
+            'add': lambda x, y: wrap(x + y),
+            'sub': lambda x, y: wrap(x - y),
+            'and': lambda x, y: x & y,
+            'or': lambda x, y: x | y,
+            'eq': lambda x, y: -1 if x == y else 0,
+            'lt': lambda x, y: -1 if x < y else 0,
+            'gt': lambda x, y: -1 if x > y else 0,
+        }[operation]
+        def command(pc):
+            sp = ram[0] - 1
+            ram[0] = sp
+            ram[sp - 1] = binary(ram[sp - 1], ram[sp])
+            return pc + 1
+        return command
+
+    def bootstrap(self):
+        '''
+        what the translator's write_init does: SP = 256, call Sys.init
+        a return from Sys.init ends the program
+        '''
+        ram = self.ram
+        ram[0] = 256
+        ram[256] = len(self.code)
+        ram[257:261] = ram[1:5]
+        ram[2] = 256
+        ram[1] = ram[0] = 261
+        self.pc = self.functions['Sys.init']
+
+    @property
+    def halted(self):
+        return not 0 <= self.pc < len(self.code)
+
+    def run(self, steps):
+        '''
+        execute up to steps commands, returns the number executed
+        '''
+        code = self.code
+        pc = self.pc
+        done = 0
+        try:
+            for done in range(steps):
+                pc = code[pc](pc)
+            else:
+                done = steps
+        except IndexError:
+            if 0 <= pc < len(code):
+                self.pc = pc
+                raise
+        self.pc = pc
+        self.steps += done
+        return done
+
+    def step(self, steps=1):
+        return self.run(steps)
+
+    def address(self, name):
+        '''
+        RAM[i], sp, local, argument, this, that, segment[i]
+        '''
+        name = name.lower()
+        if name == 'sp':
+            return 0
+        elif name in SEGMENT_POINTERS:
+            return SEGMENT_POINTERS[name]
+        segment, index = name[:-1].split('[')
+        if segment == 'ram':
+            return int(index)
+        elif segment in SEGMENT_POINTERS:
+            return self.ram[SEGMENT_POINTERS[segment]] + int(index)
+        return SEGMENT_BASES[segment] + int(index)
+
+    def get(self, name):
+        if name == 'time':
+            return self.steps
+        return self.ram[self.address(name)]
+
+    def set(self, name, value):
+        self.ram[self.address(name)] = value
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    from CPUEmulator import TestScript
+    arg_parser = argparse.ArgumentParser(description='Run VM code without translating it')
+    arg_parser.add_argument('file_path', help='a VME .tst script, or a .vm file or directory')
+    arg_parser.add_argument('--steps', type=int, default=1000000,
+                            help='VM commands to run a program for')
+    args = arg_parser.parse_args()
+    vm = VMEmulator()
+    start = time.time()
+    if args.file_path.endswith('.tst'):
+        script = TestScript(args.file_path)
+        if script.run(vm):
+            print('End of script - Comparison ended successfully')
+        else:
+            print('Comparison failure at line {}'.format(script.failure))
+            sys.exit(1)
+    else:
+        vm.load(args.file_path)
+        if 'Sys.init' in vm.functions:
+            vm.bootstrap()
+        vm.run(args.steps)
+        print('RAM[0..4]: {}'.format(vm.ram[0:5]))
+    elapsed = time.time() - start
+    print('{} steps in {:.3f}s'.format(vm.steps, elapsed), file=sys.stderr)
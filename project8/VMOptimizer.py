@@ -0,0 +1,267 @@
+from VMProgram import ALL_SEGMENTS, COMMAND_TYPES, OPCODES, OPERATIONS, SCRATCH, VMProgram
+
+# leaf functions with at most this many commands between function and return are inlined
+INLINE_LIMIT = 8
+# scratch 0-7 hold the arguments, locals and saved pointers of an inlined call
+SCRATCH_SIZE = 8
+
+FUNCTION = OPCODES['function']
+CALL = OPCODES['call']
+RETURN = OPCODES['return']
+PUSH = OPCODES['push']
+POP = OPCODES['pop']
+IF_GOTO = OPCODES['if-goto']
+GOTO = OPCODES['goto']
+NOT = OPCODES['not']
+BRANCHES = tuple(OPCODES[command] for command in OPERATIONS if COMMAND_TYPES[command] == 'C_BRANCH')
+UNARY = tuple(OPCODES[command] for command in ['neg', 'not', 'eq0', 'lt0', 'gt0'])
+
+def wrap(value):
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+# what push constant can hold, -1 is made by the ALU directly
+def pushable(value):
+    return 0 <= value <= 0x7fff or value == -1
+
+def fold_dict():
+    '''
+    opcode -> the function it applies to constant operands
+    '''
+    functions = {
+        'add': lambda x, y: wrap(x + y),
+        'sub': lambda x, y: wrap(x - y),
+        'and': lambda x, y: x & y,
+        'or': lambda x, y: x | y,
+        'eq': lambda x, y: -1 if x == y else 0,
+        'lt': lambda x, y: -1 if x < y else 0,
+        'gt': lambda x, y: -1 if x > y else 0,
+        'neg': lambda x: wrap(-x),
+        'not': lambda x: ~x,
+    }
+    return dict((OPCODES[command], function) for command, function in functions.items())
+
+FOLD = fold_dict()
+# x op 0 is x
+IDENTITY = (OPCODES['add'], OPCODES['sub'], OPCODES['or'])
+# op op is nothing
+INVOLUTIONS = (OPCODES['neg'], OPCODES['not'])
+# push constant 0; eq is eq0
+AGAINST_ZERO = dict((OPCODES[command], OPCODES[command + '0']) for command in ['eq', 'lt', 'gt'])
+# compare; if-goto L is if-compare L, compare; not; if-goto L the opposite jump
+JUMPS = dict((OPCODES[compare], (OPCODES[jump], OPCODES[opposite])) for compare, jump, opposite in [
+    ('eq', 'if-eq', 'if-ne'), ('lt', 'if-lt', 'if-ge'), ('gt', 'if-gt', 'if-le'),
+    ('eq0', 'if-eq0', 'if-goto'), ('lt0', 'if-lt0', 'if-ge0'), ('gt0', 'if-gt0', 'if-le0')])
+
+class VMOptimizer(object):
+    '''
+    whole-program passes over a list of (name, VMProgram) pairs, one per .vm file:
+    drop the functions Sys.init can never reach, inline small leaf functions
+    '''
+    def __init__(self, inline=False):
+        self.inline = inline
+        self.removed = 0
+        self.inlined = 0
+        self.folded = 0
+
+    def optimize(self, programs):
+        programs = list(programs)
+        if self.inline:
+            programs = self.inline_calls(programs)
+        if not any('Sys.init' in self.functions(program) for name, program in programs):
+            # no entry point, everything may be called from outside
+            return programs
+        return self.remove_dead(programs)
+
+    def functions(self, program):
+        '''
+        name -> (start, end), the command range of every function in program
+        '''
+        functions = {}
+        starts = [i for i, opcode in enumerate(program.opcodes) if opcode == FUNCTION]
+        for start, end in zip(starts, starts[1:] + [len(program)]):
+            functions[program.symbols[program.names[start]]] = (start, end)
+        return functions
+
+    def call_graph(self, programs):
+        '''
+        function name -> the names it calls
+        '''
+        graph = {}
+        for name, program in programs:
+            for function, (start, end) in self.functions(program).items():
+                graph[function] = set(program.symbols[program.names[i]]
+                                      for i in range(start, end) if program.opcodes[i] == CALL)
+        return graph
+
+    def reachable(self, graph, root='Sys.init'):
+        seen = set([root])
+        stack = [root]
+        while stack:
+            for callee in graph.get(stack.pop(), ()):
+                if callee not in seen:
+                    seen.add(callee)
+                    stack.append(callee)
+        return seen
+
+    def remove_dead(self, programs):
+        live = self.reachable(self.call_graph(programs))
+        result = []
+        for name, program in programs:
+            functions = self.functions(program)
+            dead = set()
+            for function, (start, end) in functions.items():
+                if function not in live:
+                    dead.update(range(start, end))
+                    self.removed += 1
+            if not dead:
+                result.append((name, program))
+                continue
+            kept = VMProgram()
+            for i in range(len(program)):
+                if i not in dead:
+                    kept.copy(program, i)
+            if len(kept):
+                result.append((name, kept))
+        return result
+
+    def leaf_body(self, program, start, end):
+        '''
+        the commands between function and return of a straight-line leaf function
+        that leaves exactly its return value on the stack, None for anything else
+        '''
+        body = range(start + 1, end - 1)
+        if end - start - 2 > INLINE_LIMIT or program.opcodes[end - 1] != RETURN:
+            return None
+        depth = 0
+        for i in body:
+            opcode = program.opcodes[i]
+            if opcode in BRANCHES or opcode in (CALL, FUNCTION, RETURN):
+                return None
+            if opcode == PUSH:
+                depth += 1
+            elif opcode == POP or opcode not in UNARY:
+                depth -= 1
+            if depth < 0:
+                return None
+        return body if depth == 1 else None
+
+    def inline_calls(self, programs):
+        leaves = {}
+        for index, (name, program) in enumerate(programs):
+            for function, (start, end) in self.functions(program).items():
+                body = self.leaf_body(program, start, end)
+                if body is not None:
+                    leaves[function] = (index, program, start, body)
+        result = []
+        for index, (name, program) in enumerate(programs):
+            inlined = VMProgram()
+            for i in range(len(program)):
+                if program.opcodes[i] == CALL:
+                    leaf = leaves.get(program.symbols[program.names[i]])
+                    if leaf is not None and self.expand(inlined, index, program.numbers[i], *leaf):
+                        self.inlined += 1
+                        continue
+                inlined.copy(program, i)
+            result.append((name, inlined))
+        return result
+
+    def expand(self, out, caller, args, callee, program, start, body):
+        '''
+        append the body of the leaf function at start to out, in place of call f args:
+        the arguments and locals live in scratch, popped pointers are saved there too
+        returns False if the call can't be inlined
+        '''
+        local_count = program.numbers[start]
+        pointers = sorted(set(program.numbers[i] for i in body
+                              if program.opcodes[i] == POP and ALL_SEGMENTS[program.segments[i]] == 'pointer'))
+        if args + local_count + len(pointers) > SCRATCH_SIZE:
+            return False
+        for i in body:
+            segment = ALL_SEGMENTS[program.segments[i]] if program.opcodes[i] in (PUSH, POP) else None
+            # statics belong to the callee's file
+            if segment == 'static' and caller != callee:
+                return False
+            if segment == 'argument' and program.numbers[i] >= args:
+                return False
+        for x in reversed(range(args)):
+            out.append(POP, SCRATCH, str(x))
+        for x in range(local_count):
+            out.append(PUSH, 'constant', '0')
+            out.append(POP, SCRATCH, str(args + x))
+        saved = dict((pointer, args + local_count + x) for x, pointer in enumerate(pointers))
+        for pointer, scratch in saved.items():
+            out.append(PUSH, 'pointer', str(pointer))
+            out.append(POP, SCRATCH, str(scratch))
+        for i in body:
+            segment = ALL_SEGMENTS[program.segments[i]] if program.opcodes[i] in (PUSH, POP) else None
+            if segment == 'argument':
+                out.append(program.opcodes[i], SCRATCH, str(program.numbers[i]))
+            elif segment == 'local':
+                out.append(program.opcodes[i], SCRATCH, str(args + program.numbers[i]))
+            else:
+                out.copy(program, i)
+        for pointer, scratch in saved.items():
+            out.append(PUSH, SCRATCH, str(scratch))
+            out.append(POP, 'pointer', str(pointer))
+        return True
+
+    def fold(self, program):
+        '''
+        constant folding and compare / branch fusion within one file, the rewrites
+        look at the end of what is written so far, so one feeds the next
+        '''
+        out = []
+        for i in range(len(program)):
+            out.append((program.opcodes[i],) + program.args(i))
+            while self.rewrite(out):
+                pass
+        self.folded += len(program) - len(out)
+        return VMProgram(out)
+
+    def constant(self, out, back):
+        # the value of out[-back] if it is a push constant
+        if len(out) >= back:
+            opcode, segment, number = out[-back]
+            if opcode == PUSH and segment == 'constant':
+                return int(number)
+        return None
+
+    def rewrite(self, out):
+        opcode, name = out[-1][0], out[-1][1]
+        previous = out[-2][0] if len(out) > 1 else None
+        y = self.constant(out, 2)
+        if opcode in FOLD and opcode not in UNARY:
+            x = self.constant(out, 3)
+            if x is not None and y is not None and pushable(FOLD[opcode](x, y)):
+                out[-3:] = [(PUSH, 'constant', str(FOLD[opcode](x, y)))]
+                return True
+            if y == 0 and opcode in IDENTITY:
+                del out[-2:]
+                return True
+            if y == 0 and opcode in AGAINST_ZERO:
+                out[-2:] = [(AGAINST_ZERO[opcode], None, None)]
+                return True
+        elif opcode in FOLD:
+            if y is not None and pushable(FOLD[opcode](y)):
+                out[-2:] = [(PUSH, 'constant', str(FOLD[opcode](y)))]
+                return True
+            if previous == opcode and opcode in INVOLUTIONS:
+                del out[-2:]
+                return True
+        elif opcode == IF_GOTO:
+            if y is not None:
+                out[-2:] = [(GOTO, name, None)] if y else []
+                return True
+            if previous in JUMPS:
+                out[-2:] = [(JUMPS[previous][0], name, None)]
+                return True
+            # a compare gives 0 or -1, so not is the opposite compare
+            if previous == NOT and len(out) > 2 and out[-3][0] in JUMPS:
+                out[-3:] = [(JUMPS[out[-3][0]][1], name, None)]
+                return True
+        return False
+
+    def report(self):
+        return ['{} unreachable functions removed'.format(self.removed),
+                '{} calls inlined'.format(self.inlined),
+                '{} commands folded away'.format(self.folded)]
@@ -0,0 +1,262 @@
+from array import array
+from operator import itemgetter
+
+COMMENT = '//'
+
+# characters read from a .vm file at a time
+CHUNK_SIZE = 1 << 20
+# distinct lines whose tokens tokenize and VMProgram.read remember
+TOKEN_CACHE = 1 << 16
+
+# the commands of the VM language
+COMMANDS = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not',
+            'push', 'pop', 'label', 'goto', 'if-goto', 'function', 'call', 'return']
+# not VM language, the optimizer writes these: eq0 is push constant 0; eq,
+# if-lt L pops y and x and jumps if x < y, if-lt0 L pops x and jumps if x < 0
+# tokenize doesn't know them, a VMProgram that has them is passed on as is
+FUSED = ['eq0', 'lt0', 'gt0',
+         'if-eq', 'if-ne', 'if-lt', 'if-ge', 'if-gt', 'if-le',
+         'if-eq0', 'if-lt0', 'if-ge0', 'if-gt0', 'if-le0']
+# opcode ids are indexes into OPERATIONS, the commands come first
+OPERATIONS = COMMANDS + FUSED
+OPCODES = dict((command, opcode) for opcode, command in enumerate(OPERATIONS))
+COMMAND_OPCODES = dict((command, OPCODES[command]) for command in COMMANDS)
+
+def command_types():
+    types = {}
+    for command in OPERATIONS:
+        if command in ['push', 'pop']:
+            types[command] = 'C_PP'
+        elif command in ['label', 'goto'] or command.startswith('if-'):
+            types[command] = 'C_BRANCH'
+        elif command in ['function', 'call']:
+            types[command] = 'C_FUNCTION'
+        elif command == 'return':
+            types[command] = 'C_RETURN'
+        else:
+            types[command] = 'C_ARITHMETIC'
+    return types
+
+COMMAND_TYPES = command_types()
+
+class Memo(dict):
+    '''
+    a dict that fills itself, memo[key] is function(key) worked out once, so
+    map(memo.__getitem__, keys) only leaves C for the keys it has not seen
+    only the first limit keys are kept, all of them when limit is None
+    '''
+    def __init__(self, function, limit=TOKEN_CACHE):
+        self.function = function
+        self.limit = limit
+
+    def __missing__(self, key):
+        value = self.function(key)
+        if self.limit is None or len(self) < self.limit:
+            self[key] = value
+        return value
+
+def read_lines(vm_file, chunk_size=CHUNK_SIZE):
+    '''
+    yield the lines of a .vm path or text stream a list at a time, the file
+    is read chunk_size characters at a time, so memory stays flat
+    '''
+    vm = open(vm_file, 'r') if isinstance(vm_file, str) else vm_file
+    try:
+        tail = ''
+        while True:
+            chunk = vm.read(chunk_size)
+            lines = (tail + chunk).split('\n')
+            # the last piece may be a line cut in half, unless the file is done
+            tail = lines.pop() if chunk else ''
+            yield lines
+            if not chunk:
+                break
+    finally:
+        if vm is not vm_file:
+            vm.close()
+
+def tokenize(vm_file, chunk_size=CHUNK_SIZE):
+    '''
+    yield (opcode, arg1, arg2) for every command of a .vm path or text stream,
+    missing arguments are None, comments and blank lines are dropped
+    '''
+    # most lines of a .vm file are repeats, the token of the first TOKEN_CACHE
+    # distinct ones is kept, None for a line without a command
+    known = {}
+    number = 0
+    for lines in read_lines(vm_file, chunk_size):
+        for line in lines:
+            number += 1
+            if line in known:
+                token = known[line]
+            else:
+                token = tokenize_line(line, number)
+                if len(known) < TOKEN_CACHE:
+                    known[line] = token
+            if token is not None:
+                yield token
+
+def tokenize_line(line, number):
+    if COMMENT in line:
+        line = line[:line.index(COMMENT)]
+    words = line.split()
+    if not words:
+        return None
+    opcode = COMMAND_OPCODES.get(words[0].lower())
+    if opcode is None or len(words) > 3:
+        raise ValueError('line {}: unknown command: {}'.format(number, line.strip()))
+    if opcode in PUSH_POP and len(words) > 1 and words[1] not in SEGMENTS:
+        raise ValueError('line {}: unknown segment: {}'.format(number, words[1]))
+    return opcode, words[1] if len(words) > 1 else None, words[2] if len(words) > 2 else None
+
+# the segments of the VM language
+SEGMENTS = ['constant', 'local', 'argument', 'this', 'that', 'pointer', 'temp', 'static']
+# not VM language, RAM of the inliner's own that no .vm file can name, it holds
+# the arguments, locals and saved pointers of an inlined call
+SCRATCH = 'scratch'
+# segment ids are indexes into ALL_SEGMENTS, the segments come first
+ALL_SEGMENTS = SEGMENTS + [SCRATCH]
+SEGMENT_IDS = dict((segment, number) for number, segment in enumerate(ALL_SEGMENTS))
+PUSH_POP = (OPCODES['push'], OPCODES['pop'])
+# outside any 16-bit value, so push constant -1 keeps its number
+NO_NUMBER = -0x10000
+
+class VMProgram(object):
+    '''
+    parsed VM commands as parallel arrays, one entry per command:
+    opcode, segment id, number (index or argument count), symbol id,
+    -1 where a command has no segment or symbol, NO_NUMBER where it has no number
+    function and label names are interned, symbols[id] is the name
+    '''
+    def __init__(self, tokens=()):
+        self.opcodes = array('B')
+        self.segments = array('b')
+        self.numbers = array('l')
+        self.names = array('l')
+        self.symbols = []
+        self.symbol_ids = {}
+        self.extend(tokens)
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def intern(self, name):
+        symbol = self.symbol_ids.get(name)
+        if symbol is None:
+            symbol = self.symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name)
+        return symbol
+
+    def append(self, opcode, arg1=None, arg2=None):
+        self.extend([(opcode, arg1, arg2)])
+
+    def extend(self, tokens):
+        # a repeated command is decoded once
+        decoded = Memo(lambda token: self.decode(*token), limit=None)
+        self.add_rows(list(map(decoded.__getitem__, tokens)))
+
+    def read(self, vm_file, chunk_size=CHUNK_SIZE):
+        '''
+        append the commands of a .vm path or text stream, a line is decoded the
+        first time it is seen and its repeats are dict lookups
+        '''
+        rows = Memo(self.decode_line)
+        number = 0
+        for lines in read_lines(vm_file, chunk_size):
+            try:
+                self.add_rows(list(filter(None, map(rows.__getitem__, lines))))
+            except ValueError:
+                # once more line by line, for the number of the line at fault
+                for offset, line in enumerate(lines, number + 1):
+                    self.decode_line(line, offset)
+                raise
+            number += len(lines)
+
+    def decode_line(self, line, number=0):
+        token = tokenize_line(line, number)
+        return None if token is None else self.decode(*token)
+
+    def add_rows(self, rows):
+        '''
+        append (opcode, segment id, number, symbol id) rows to the arrays
+        '''
+        for column, values in enumerate([self.opcodes, self.segments, self.numbers, self.names]):
+            values.extend(map(itemgetter(column), rows))
+
+    def rows(self):
+        '''
+        the (opcode, segment id, number, symbol id) row of every command
+        '''
+        return zip(self.opcodes, self.segments, self.numbers, self.names)
+
+    def decode(self, opcode, arg1, arg2):
+        '''
+        the (opcode, segment id, number, symbol id) row of one command
+        '''
+        if opcode in PUSH_POP:
+            segment = SEGMENT_IDS.get(arg1)
+            if segment is None:
+                raise ValueError('unknown segment: {}'.format(arg1))
+            return opcode, segment, int(arg2), -1
+        number = NO_NUMBER if arg2 is None else int(arg2)
+        return opcode, -1, number, -1 if arg1 is None else self.intern(arg1)
+
+    def args(self, i):
+        '''
+        the two arguments of command i as strings, None where there is none
+        '''
+        return self.row_args(self.segments[i], self.numbers[i], self.names[i])
+
+    def row_args(self, segment, number, name):
+        '''
+        args of a command given by its columns
+        '''
+        arg1 = arg2 = None
+        if segment >= 0:
+            arg1 = ALL_SEGMENTS[segment]
+        elif name >= 0:
+            arg1 = self.symbols[name]
+        if number != NO_NUMBER:
+            arg2 = str(number)
+        return arg1, arg2
+
+    def words(self, i):
+        '''
+        command i as the list of words it was written with
+        '''
+        return self.row_words((self.opcodes[i], self.segments[i], self.numbers[i], self.names[i]))
+
+    def row_words(self, row):
+        '''
+        words of a command given by its (opcode, segment id, number, symbol id) row
+        '''
+        opcode, segment, number, name = row
+        return [OPERATIONS[opcode]] + [arg for arg in self.row_args(segment, number, name) if arg is not None]
+
+    def copy(self, program, i):
+        '''
+        append command i of another program
+        '''
+        self.append(program.opcodes[i], *program.args(i))
+
+    def text(self):
+        return ''.join(' '.join(self.words(i)) + '\n' for i in range(len(self)))
+
+def read_vm(vm_file):
+    '''
+    the VMProgram of one .vm path or text stream
+    '''
+    program = VMProgram()
+    program.read(vm_file)
+    return program
+
+def command_lines(vm_file):
+    '''
+    the line number of every command of a .vm path, in the order read_vm gives them
+    '''
+    numbers = []
+    with open(vm_file, 'r') as vm:
+        for number, line in enumerate(vm, 1):
+            if line.split(COMMENT, 1)[0].split():
+                numbers.append(number)
+    return numbers
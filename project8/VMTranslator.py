@@ -1,74 +1,230 @@
+import hashlib
+import io
+import json
 import os
+import re
+import sys
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, count, islice, repeat
 
-COMMENT = '//'
+from Assembler import Assembler
+from Peephole import Peephole
+from Stats import NO_STATS, Stats
+from VMOptimizer import VMOptimizer
+from VMProgram import COMMENT, COMMANDS, COMMAND_TYPES, OPERATIONS, ALL_SEGMENTS, SCRATCH, Memo, VMProgram, command_lines, read_vm, tokenize
+
+# largest segment index popped into by stepping A instead of going through R13
+STEP_LIMIT = 7
+# output lines held back before one writelines
+FLUSH_LINES = 65536
+# distinct push / pop commands whose instructions are remembered
+TEMPLATE_CACHE = 4096
+
+POINTERS = {
+    'local': 'LCL', # R1
+    'argument': 'ARG', # R2
+    'this': 'THIS', # R3
+    'that': 'THAT', # R4
+}
+
+BASES = {
+    'pointer': 3, # R3, R4
+    'temp': 5, # R5-12
+}
+
+# constants the ALU makes without an A load
+SHORT_CONSTANTS = {0: '0', 1: '1', -1: '-1'}
+
+# the fused jumps that go through a compare routine: routine, jump on its result
+COMPARE_JUMPS = {
+    'if-lt': ('lt', 'D;JNE'), 'if-ge': ('lt', 'D;JEQ'),
+    'if-gt': ('gt', 'D;JNE'), 'if-le': ('gt', 'D;JEQ'),
+}
+
+# the // N endings of instruction numbers, in pieces: ' // ' + number // 1000, then the last digits
+LAST_DIGITS = ['%03d\n' % number for number in range(1000)]
+FIRST_DIGITS = ['%d\n' % number for number in range(1000)]
+
+def number_endings(start):
+    '''
+    the two endless streams the // N endings from N = start on are made of
+    '''
+    first, low = divmod(start, 1000)
+    prefixes = chain.from_iterable(repeat(' // {}'.format(high) if high else ' // ', 1000 - (low if high == first else 0))
+                                   for high in count(first))
+    digits = chain.from_iterable((LAST_DIGITS if high else FIRST_DIGITS)[low if high == first else 0:]
+                                 for high in count(first))
+    return prefixes, digits
+
+# push D, pop into D
+PUSH_D = ('@SP', 'A=M', 'M=D', '@SP', 'M=M+1')
+POP_D = ('@SP', 'AM=M-1', 'D=M')
+# push LCL, ARG, THIS and THAT
+PUSH_FRAME = sum((('@' + pointer, 'D=M') + PUSH_D for pointer in ['LCL', 'ARG', 'THIS', 'THAT']), ())
+# what every call does between pushing its return address and ARG = SP-n-5:
+# push LCL, ARG, THIS and THAT, LCL = SP, D = SP
+CALL_FRAME = PUSH_D + PUSH_FRAME + ('@SP', 'D=M', '@LCL', 'M=D', '@SP', 'D=M')
+# TEMP = LCL, RES = *(TEMP - 5), *ARG = pop(), SP = ARG + 1
+# THAT, THIS, ARG, LCL = *(TEMP - 1), *(TEMP - 2), *(TEMP - 3), *(TEMP - 4), goto RES
+# with TEMP in R13 and RES in R14, if there is no argument *ARG covers the return address
+RETURN_CODE = (('@LCL', 'D=M', '@R13', 'M=D') +
+               ('@R13', 'D=M', '@5', 'D=D-A', 'A=D', 'D=M', '@R14', 'M=D') +
+               ('@SP', 'M=M-1', 'A=M', 'D=M', '@ARG', 'A=M', 'M=D') +
+               ('@ARG', 'D=M', '@SP', 'M=D+1') +
+               sum((('@R13', 'D=M', '@' + str(offset), 'D=D-A', 'A=D', 'D=M', '@' + pointer, 'M=D')
+                    for offset, pointer in enumerate(['THAT', 'THIS', 'ARG', 'LCL'], 1)), ()) +
+               ('@R14', 'A=M', '0;JMP'))
+# y into D and SP down to x, with A at x
+POP_Y = ('@SP', 'M=M-1', 'A=M', 'D=M', '@SP', 'M=M-1', 'A=M')
+
+def template_dict():
+    '''
+    segment -> (instructions that load segment[index] into D,
+                instructions that store D into segment[index])
+    with {base}, {index} and {address} filled in per command
+    '''
+    templates = {'constant': (('@{index}', 'D=A'), None)}
+    for segment in POINTERS:
+        templates[segment] = (
+            ('@{base}', 'D=M', '@{index}', 'A=D+A', 'D=M'),
+            # D = value + address, A = D - value, D = D - A
+            ('@R13', 'M=D', '@{base}', 'D=M', '@{index}', 'D=D+A', '@R13', 'D=D+M', 'A=D-M', 'D=D-A', 'M=D'))
+    for segment in ['pointer', 'temp', 'static', SCRATCH]:
+        templates[segment] = (('@{address}', 'D=M'), ('@{address}', 'M=D'))
+    return templates
+
+TEMPLATES = template_dict()
+
+def expand(template, segment, index, curr_file):
+    if segment == 'static':
+        address = '{}.{}'.format(curr_file, index)
+    elif segment == SCRATCH:
+        # assembler variables like the statics, no VM command can reach them
+        address = '$$INLINE{}'.format(index)
+    else:
+        address = 'R{}'.format(BASES.get(segment, 0) + index)
+    return tuple(line.format(base=POINTERS.get(segment), index=index, address=address) for line in template)
+
+def step_to(segment, index):
+    # A = segment base + index by stepping, shorter than the @index D+A form for small indexes
+    return ('@' + POINTERS[segment], 'A=M' if index == 0 else 'A=M+1') + ('A=A+1',) * (index - 1)
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def load_code(segment, index, curr_file=''):
+    '''
+    the instructions that put segment[index] in D
+    '''
+    if segment not in TEMPLATES:
+        raise ValueError('unknown segment: {}'.format(segment))
+    if segment == 'constant' and index in SHORT_CONSTANTS:
+        return ('D=' + SHORT_CONSTANTS[index],)
+    if segment in POINTERS and index <= 1:
+        return step_to(segment, index) + ('D=M',)
+    return expand(TEMPLATES[segment][0], segment, index, curr_file)
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def store_code(segment, index, curr_file=''):
+    '''
+    the instructions that put D in segment[index], D is not kept
+    '''
+    if segment not in TEMPLATES or TEMPLATES[segment][1] is None:
+        raise ValueError('cannot pop into segment: {}'.format(segment))
+    if segment in POINTERS and index <= STEP_LIMIT:
+        return step_to(segment, index) + ('M=D',)
+    return expand(TEMPLATES[segment][1], segment, index, curr_file)
+
+@lru_cache(maxsize=TEMPLATE_CACHE)
+def push_pop_code(operation, segment, index, curr_file=''):
+    '''
+    the whole instruction block of push / pop segment index
+    '''
+    if operation == 'push' and segment == 'constant' and index in SHORT_CONSTANTS:
+        return ('@SP', 'A=M', 'M=' + SHORT_CONSTANTS[index], '@SP', 'M=M+1')
+    if operation == 'push':
+        return load_code(segment, index, curr_file) + PUSH_D
+    if operation == 'pop':
+        return POP_D + store_code(segment, index, curr_file)
+    raise ValueError('unknown command: {}'.format(operation))
 
 class Parser(object):
+    '''
+    the command by command interface over tokenize
+    '''
     def __init__(self, vm_file):
-        self.vm = open(vm_file, 'r')
+        # a path, or an already open text stream
+        self.close_vm = isinstance(vm_file, str)
+        self.vm = open(vm_file, 'r') if self.close_vm else vm_file
         self.curr_instruction = None
-        self.asm_file = vm_file.replace('.vm', '.asm')
-        self.commands = self.command_dict()
+        self.command_type = None
+        if self.close_vm:
+            self.asm_file = vm_file.replace('.vm', '.asm')
         self.initialize()
 
     @property
     def has_next_instruction(self):
-        return bool(self.next_instruction)
-    @property
-    def command_type(self):
-        if len(self.curr_instruction) > 0:
-            return self.commands.get(self.curr_instruction[0].lower())
-
-    def command_dict(self):
-        return {
-            'and': 'C_ARITHMETIC',
-            'or': 'C_ARITHMETIC',
-            'sub': 'C_ARITHMETIC',
-            'add': 'C_ARITHMETIC',
-            'neg': 'C_ARITHMETIC',
-            'not': 'C_ARITHMETIC',
-            'eq': 'C_ARITHMETIC',
-            'lt': 'C_ARITHMETIC',
-            'gt': 'C_ARITHMETIC',
-            'push': 'C_PP',
-            'pop': 'C_PP',
-            'label': 'C_BRANCH',
-            'if-goto': 'C_BRANCH',
-            'goto': 'C_BRANCH',
-            'function': 'C_FUNCTION',
-            'call': 'C_FUNCTION',
-            'return': 'C_RETURN',
-        }
+        return self.next_token is not None
 
     def initialize(self):
         self.vm.seek(0)
-        line = self.vm.readline().strip()
-        while self.is_comment(line):
-            line = self.vm.readline().strip()
-        self.load_next_instruction(line)
+        self.tokens = tokenize(self.vm)
+        self.next_token = next(self.tokens, None)
 
     def next(self):
-        self.curr_instruction = self.next_instruction
-        self.load_next_instruction()
-
-    def load_next_instruction(self, line=None):
-        line = line if line != None else self.vm.readline().strip()
-        if line == '':
-            line = self.vm.readline().strip()
-        self.next_instruction = line.split(COMMENT)[0].strip().split()
+        self.curr_token = opcode, arg1, arg2 = self.next_token
+        command = COMMANDS[opcode]
+        if arg1 is None:
+            self.curr_instruction = [command]
+        elif arg2 is None:
+            self.curr_instruction = [command, arg1]
+        else:
+            self.curr_instruction = [command, arg1, arg2]
+        self.command_type = COMMAND_TYPES[command]
+        self.next_token = next(self.tokens, None)
 
-    def is_comment(self, line):
-        return line == '' or line[:2] == COMMENT
-    
     def close(self):
-        self.vm.close()
+        if self.close_vm:
+            self.vm.close()
 
 class CodeWriter(object):
-    def __init__(self, asm_file):
-        self.asm = open(asm_file, 'w')
+    def __init__(self, asm_file, trampoline=False, optimize=False, cache_top=False, fold=False,
+                 shared_compare=False, numbers=True, comments=True, stats=None):
+        # a path, or any object with a write method
+        self.close_asm = isinstance(asm_file, str)
+        self.asm = open(asm_file, 'w') if self.close_asm else asm_file
+        # finished instructions, written out per file and every FLUSH_LINES,
+        # with the labels and comments in between as (instructions before, line)
+        self.lines = []
+        self.notes = []
+        # the // N instruction numbers and the // <vm command> comments
+        self.numbers = numbers
+        self.comments = comments
         self.bool_count = 0
         self.func_count = 0
         self.line_count = 0
-        self.addresses = self.address_dict()
+        self.curr_file = ''
+        # VM labels are scoped to the function they are in
+        self.curr_function = None
+        self.operations = self.operation_dict()
+        self.arithmetic = self.arithmetic_dict()
+        self.jumps = self.jump_dict()
+        # share one $$CALL / $$RETURN routine among all call sites
+        self.trampoline = trampoline
+        # eq / lt / gt jump to one $$EQ / $$LT / $$GT routine each
+        self.shared_compare = shared_compare
+        # hold everything back for the peephole pass until flush()
+        self.peephole = Peephole() if optimize else None
+        self.buffer = [] if optimize else None
+        # keep the top of the stack in D between commands
+        self.cache_top = cache_top
+        self.top_in_D = False
+        # fold constants and fuse compares into jumps before writing a file
+        self.folder = VMOptimizer() if fold else None
+        self.options = dict(trampoline=trampoline, optimize=optimize, cache_top=cache_top, fold=fold,
+                            shared_compare=shared_compare, numbers=numbers, comments=comments)
+        # not an option, the output is the same either way
+        self.stats = stats if stats is not None else NO_STATS
 
     def write_init(self):
         self.write('@256')
@@ -78,288 +234,924 @@ class CodeWriter(object):
         self.write_function('call', 'Sys.init', '0')
 
     def set_file_name(self, vm_file):
+        self.spill()
         self.curr_file = vm_file.replace('.vm', '').split('/')[-1]
+        self.curr_function = None
+        # labels are file-scoped, so every file can be translated on its own
+        self.bool_count = 0
+        self.func_count = 0
+        self.write_lines()
         self.write('//////', code=False)
         self.write('// {}'.format(self.curr_file), code=False)
 
     def write_push_pop(self, operation, segment, num):
-        self.resolve_address(segment, num)
-        if operation == 'push':
-            if segment == 'constant':
-                self.write('D=A')
-            else:
-                self.write('D=M')
-            self.push_D_to_stack()
-        elif operation == 'pop':    
-            self.write('D=A')
-            self.write('@R13') # available space
-            self.write('M=D')
-            self.pop_from_stack()
-            self.write('D=M')
-            self.write('@R13')
-            self.write('A=M')
-            self.write('M=D')
+        index = int(num)
+        # only static addresses depend on the file
+        curr_file = self.curr_file if segment == 'static' else ''
+        if self.cache_top:
+            self.write_cached_push_pop(operation, segment, index, curr_file)
         else:
-            print('error!\n')
+            self.write_all(push_pop_code(operation, segment, index, curr_file))
     
-    def resolve_address(self, segment, num):
-        address = self.addresses.get(segment)
-        if segment == 'constant':
-            self.write('@' + str(num))
-        elif segment in ['local', 'argument', 'this', 'that']:
-            self.write('@' + str(address))
-            self.write('D=M')
-            self.write('@' + num)
-            self.write('A=D+A')
-        elif segment in ['temp', 'pointer']:
-            self.write('@R' + str(address + int(num)))
-        elif segment == 'static':
-            self.write('@' + self.curr_file + '.' + str(num))
+    def write_cached_push_pop(self, operation, segment, index, curr_file):
+        if operation == 'push':
+            self.spill()
+            self.write_all(load_code(segment, index, curr_file))
+            self.top_in_D = True
+        elif operation == 'pop':
+            self.load_top()
+            self.top_in_D = False
+            self.write_all(store_code(segment, index, curr_file))
+        else:
+            raise ValueError('unknown command: {}'.format(operation))
 
     def write_arithmetic(self, operation):
         '''
         and, or, sub, add, neg, not, eq, lt, gt 
         '''
-        if operation not in ['neg', 'not']:
-            self.pop_from_stack()
-            self.write('D=M')
-        self.pop_from_stack()
+        if self.shared_compare and operation in ['eq', 'lt', 'gt']:
+            self.write_compare_call(operation)
+            if self.cache_top:
+                self.top_in_D = True
+            else:
+                self.increase_SP()
+            return
+        if self.cache_top:
+            self.write_cached_arithmetic(operation)
+            return
+        if operation in self.arithmetic:
+            self.write_all(self.arithmetic[operation])
+            return
+        if operation in ['eq0', 'lt0', 'gt0']:
+            # the top turns into -1, back to 0 unless it compared true
+            self.write_all(('@SP', 'A=M-1', 'D=M', 'M=-1'))
+            self.write('@' + self.bool_label('BOOL'))
+            self.write(self.jumps['if-' + operation])
+            self.write_all(('@SP', 'A=M-1', 'M=0'))
+            self.write('({})'.format(self.bool_label('BOOL')), code=False)
+            self.bool_count += 1
+            return
+        if operation not in ['eq', 'lt', 'gt']:
+            raise ValueError('unknown command: {}'.format(operation))
+        true, end = self.bool_label('BOOL'), self.bool_label('ENDBOOL')
+        self.write_all(POP_Y + ('D=M-D', '@' + true, self.operations[operation],
+                                '@SP', 'A=M', 'M=0', '@' + end, '0;JMP'))
+        self.write('({})'.format(true), code=False)
+        self.write_all(('@SP', 'A=M', 'M=-1'))
+        self.write('({})'.format(end), code=False)
+        self.bool_count += 1
+        self.increase_SP()
 
+    def write_cached_arithmetic(self, operation):
+        self.load_top()
+        if operation in ['eq0', 'lt0', 'gt0']:
+            self.write('@' + self.bool_label('BOOL'))
+            self.write(self.jumps['if-' + operation])
+            self.write('D=0')
+            self.write('@' + self.bool_label('ENDBOOL'))
+            self.write('0;JMP')
+            self.write('({})'.format(self.bool_label('BOOL')), code=False)
+            self.write('D=-1')
+            self.write('({})'.format(self.bool_label('ENDBOOL')), code=False)
+            self.bool_count += 1
+            return
+        if operation == 'neg':
+            self.write('D=-D')
+            return
+        elif operation == 'not':
+            self.write('D=!D')
+            return
+        self.write('@SP')
+        self.write('AM=M-1')
         if operation in ['eq', 'lt', 'gt']:
             self.write('D=M-D')
-            self.write('@BOOL{}'.format(self.bool_count))
-            if operation == 'eq':
-                self.write('D;JEQ')
-            elif operation == 'lt':
-                self.write('D;JLT')
-            elif operation == 'gt':
-                self.write('D;JGT')
-            
-            self.call_SP()
-            self.write('M=0')
-            self.write('@ENDBOOL{}'.format(self.bool_count))
+            self.write('@' + self.bool_label('BOOL'))
+            self.write('D;J' + operation.upper())
+            self.write('D=0')
+            self.write('@' + self.bool_label('ENDBOOL'))
             self.write('0;JMP')
-
-            self.write('(BOOL{})'.format(self.bool_count), code=False)
-            self.call_SP()
-            self.write('M=-1')
-            self.write('(ENDBOOL{})'.format(self.bool_count), code=False)
+            self.write('({})'.format(self.bool_label('BOOL')), code=False)
+            self.write('D=-1')
+            self.write('({})'.format(self.bool_label('ENDBOOL')), code=False)
             self.bool_count += 1
-        elif operation in ['add', 'or', 'sub', 'and', 'neg', 'not']:
-            if operation == 'add':
-                self.write('M=M+D')
-            elif operation == 'or':
-                self.write('M=M|D')
-            elif operation == 'sub':
-                self.write('M=M-D')
-            elif operation == 'and':
-                self.write('M=M&D')
-            elif operation == 'neg':
-                self.write('M=-M')
-            elif operation == 'not':
-                self.write('M=!M')
-        self.increase_SP()
+        elif operation == 'add':
+            self.write('D=D+M')
+        elif operation == 'or':
+            self.write('D=D|M')
+        elif operation == 'sub':
+            self.write('D=M-D')
+        elif operation == 'and':
+            self.write('D=D&M')
+
+    def jump_dict(self):
+        # the jump of each fused compare-and-branch
+        jumps = {}
+        for compare, jump in [('eq', 'JEQ'), ('ne', 'JNE'), ('lt', 'JLT'), ('ge', 'JGE'), ('gt', 'JGT'), ('le', 'JLE')]:
+            jumps['if-' + compare] = 'D;' + jump
+            jumps['if-' + compare + '0'] = 'D;' + jump
+        return jumps
 
-    def address_dict(self):
+    def operation_dict(self):
+        # the instruction each arithmetic command applies to the stack top
         return {
-            'local': 'LCL', # R1
-            'argument': 'ARG', # R2
-            'this': 'THIS', # R3
-            'that': 'THAT', # R4
-            'pointer': 3, # R3, R4
-            'temp': 5, # R5-12
-            'static': 16, # R16-255
+            'add': 'M=M+D',
+            'sub': 'M=M-D',
+            'and': 'M=M&D',
+            'or': 'M=M|D',
+            'neg': 'M=-M',
+            'not': 'M=!M',
+            'eq': 'D;JEQ',
+            'lt': 'D;JLT',
+            'gt': 'D;JGT',
         }
 
+    def arithmetic_dict(self):
+        # the whole code of the arithmetic commands without labels
+        arithmetic = {}
+        for operation in ['add', 'sub', 'and', 'or']:
+            arithmetic[operation] = POP_Y + (self.operations[operation], '@SP', 'M=M+1')
+        for operation in ['neg', 'not']:
+            arithmetic[operation] = ('@SP', 'M=M-1', 'A=M', self.operations[operation], '@SP', 'M=M+1')
+        return arithmetic
+
+    def bool_label(self, kind):
+        # file-scoped, '$' never appears in a VM label
+        return '{}$${}{}'.format(self.curr_file, kind, self.bool_count)
+
     def write_branch(self, segment, name):
         '''
         if-goto LOOP_START 
         label LOOP_START
         '''
+        if segment in self.jumps:
+            self.write_jump(segment, name)
+            return
+        if segment == 'if-goto' and self.cache_top:
+            self.load_top()
+            self.top_in_D = False
+            self.write('@' + self.branch_label(name))
+            self.write('D;JNE')
+            return
+        self.spill()
         if segment == 'label':
-            self.write('({}${})'.format(self.curr_file, name), code=False)
+            self.write('({})'.format(self.branch_label(name)), code=False)
         elif segment == 'if-goto':
-            self.pop_from_stack()
-            self.write('D=M')
-            self.write('@{}${}'.format(self.curr_file, name))
-            self.write('D; JNE')
+            self.write_all(('@SP', 'M=M-1', 'A=M', 'D=M', '@' + self.branch_label(name), 'D; JNE'))
         elif segment == 'goto':
-            self.write('@{}${}'.format(self.curr_file, name))
-            self.write('D;JMP')
+            self.write_all(('@' + self.branch_label(name), 'D;JMP'))
+
+    def write_jump(self, operation, name):
+        '''
+        if-lt L: pop y and x, jump if x < y
+        if-lt0 L: pop x, jump if x < 0
+        '''
+        if self.shared_compare and operation in COMPARE_JUMPS:
+            # D is the -1 / 0 the routine returns, jump on it instead of x - y
+            compare, jump = COMPARE_JUMPS[operation]
+            self.write_compare_call(compare)
+            self.top_in_D = False
+            self.write('@' + self.branch_label(name))
+            self.write(jump)
+            return
+        self.load_top()
+        self.top_in_D = False
+        if not operation.endswith('0'):
+            self.write_all(('@SP', 'AM=M-1', 'D=M-D'))
+        self.write_all(('@' + self.branch_label(name), self.jumps[operation]))
+
+    def write_compare_call(self, operation):
+        '''
+        D = return-address, goto $$EQ / $$LT / $$GT
+        with the top cached in D it goes to R14 and the routine is entered at $Y
+        leaves the -1 / 0 result in D and in RAM[SP], with SP below it
+        '''
+        routine = '$$' + operation.upper()
+        if self.top_in_D:
+            self.write('@R14')
+            self.write('M=D')
+            routine += '$Y'
+        RES = self.bool_label('CMP')
+        self.bool_count += 1
+        self.write('@' + RES)
+        self.write('D=A')
+        self.write('@' + routine)
+        self.write('0;JMP')
+        self.write('({})'.format(RES), code=False)
+
+    def branch_label(self, name):
+        # a label before any function belongs to the file
+        return '{}${}'.format(self.curr_function or self.curr_file, name)
 
     def write_function(self, operation, name, num):
+        self.spill()
         if operation == 'function':
+            self.curr_function = name
             self.write('({})'.format(name), code=False)
-            for x in range(int(num)):
-                self.write('D=0')
-                self.push_D_to_stack()
+            self.write_all((('D=0',) + PUSH_D) * int(num))
         elif operation == 'call':
-            RES = name + 'RES' + str(self.func_count) # unique 
+            RES = '{}$${}RES{}'.format(self.curr_file, name, self.func_count) # unique 
             self.func_count += 1
 
-            # push return-address
-            self.write('@' + RES)
-            self.write('D=A')
-            self.push_D_to_stack()
-            
-            # push LCL
-            # push ARG
-            # push THIS
-            # push THAT
-            for address in ['LCL', 'ARG', 'THIS', 'THAT']:
-                self.write('@' + address)
-                self.write('D=M')
-                self.push_D_to_stack()
-
-            # LCL = SP
-            self.write('@SP')
-            self.write('D=M')
-            self.write('@LCL')
-            self.write('M=D')
+            if self.trampoline:
+                self.write_trampoline_call(name, num, RES)
+                return
 
+            # push return-address, push LCL, ARG, THIS, THAT, LCL = SP
             # ARG = SP-n-5
-            self.write('@SP')
-            self.write('D=M')
-            self.write('@' + str(int(num) + 5))
-            self.write('D=D-A')
-            self.write('@ARG')
-            self.write('M=D')
-
             # goto f
-            self.write('@'+name)
-            self.write('0;JMP')
+            self.write_all(('@' + RES, 'D=A') + CALL_FRAME +
+                           ('@' + str(int(num) + 5), 'D=D-A', '@ARG', 'M=D', '@' + name, '0;JMP'))
 
             # (return_address)
             self.write('({})'.format(RES), code=False)
-        
-    def write_return(self):
-        TEMP = 'R13'
-        RES = 'R14'
 
-        # TEMP = LCL
-        self.write('@LCL')
+    def push_frame(self):
+        self.write_all(PUSH_FRAME)
+
+    def write_trampoline_call(self, name, num, RES):
+        '''
+        R13 = f, R14 = nArgs, R15 = return-address, goto $$CALL
+        '''
+        for value, register in [(RES, 'R15'), (num, 'R14'), (name, 'R13')]:
+            self.write('@' + str(value))
+            self.write('D=A')
+            self.write('@' + register)
+            self.write('M=D')
+        self.write('@$$CALL')
+        self.write('0;JMP')
+        self.write('({})'.format(RES), code=False)
+
+    def write_trampolines(self):
+        '''
+        the shared routines that every call site and return jumps to,
+        placed after all translated code
+        '''
+        self.write('($$CALL)', code=False)
+        # push return-address
+        self.write('@R15')
         self.write('D=M')
-        self.write('@' + TEMP)
-        self.write('M=D')
-        
-        # RET = *(TEMP - 5)
-        # if no argument, the return address will be covered
-        self.write('@' + TEMP)
+        self.push_D_to_stack()
+        self.push_frame()
+
+        # ARG = SP-n-5
+        self.write('@SP')
         self.write('D=M')
+        self.write('@R14')
+        self.write('D=D-M')
         self.write('@5')
         self.write('D=D-A')
-        self.write('A=D')
-        self.write('D=M')
-        self.write('@' + RES)
+        self.write('@ARG')
         self.write('M=D')
 
-        # *ARG = pop()
-        self.pop_from_stack()
+        # LCL = SP
+        self.write('@SP')
         self.write('D=M')
-        self.write('@ARG')
-        self.write('A=M')
+        self.write('@LCL')
         self.write('M=D')
 
-        # SP = ARG + 1
-        self.write('@ARG')
-        self.write('D=M')
-        self.write('@SP')
-        self.write('M=D+1')
-
-        # THAT = *(FRAME-1)
-        # THIS = *(FRAME-2)
-        # ARG = *(FRAME-3)
-        # LCL = *(FRAME-4)
-        offset = 1
-        for address in ['@THAT', '@THIS', '@ARG', '@LCL']:
-            self.write('@' + TEMP)
+        # goto f
+        self.write('@R13')
+        self.write('A=M')
+        self.write('0;JMP')
+
+        self.write('($$RETURN)', code=False)
+        self.write_return_body()
+
+    def write_compare_routines(self):
+        '''
+        $$EQ, $$LT, $$GT: R13 = return-address, R14 = y, pop x and y
+        x - y only decides when x and y have the same sign, where it can't
+        overflow, otherwise the sign of x alone does
+        '''
+        for operation in ['eq', 'lt', 'gt']:
+            routine = '$$' + operation.upper()
+            # entered with y already in R14
+            self.write('({}$Y)'.format(routine), code=False)
+            self.write('@R13')
+            self.write('M=D')
+            self.write('@{}$X'.format(routine))
+            self.write('0;JMP')
+
+            self.write('({})'.format(routine), code=False)
+            self.write('@R13')
+            self.write('M=D')
+            self.write('@SP')
+            self.write('AM=M-1')
             self.write('D=M')
-            self.write('@' + str(offset))
-            self.write('D=D-A')
-            self.write('A=D')
+            self.write('@R14')
+            self.write('M=D')
+
+            self.write('({}$X)'.format(routine), code=False)
+            self.write('@SP')
+            self.write('AM=M-1')
             self.write('D=M')
-            self.write(address)
+            if operation != 'eq':
+                # x < 0 <= y is lt, y < 0 <= x is gt
+                negative, positive = ('TRUE', 'FALSE') if operation == 'lt' else ('FALSE', 'TRUE')
+                self.write('@{}$NEG'.format(routine))
+                self.write('D;JLT')
+                self.write('@R14')
+                self.write('D=M')
+                self.write('@{}${}'.format(routine, positive))
+                self.write('D;JLT')
+                self.write('@{}$DIFF'.format(routine))
+                self.write('0;JMP')
+                self.write('({}$NEG)'.format(routine), code=False)
+                self.write('@R14')
+                self.write('D=M')
+                self.write('@{}${}'.format(routine, negative))
+                self.write('D;JGE')
+                self.write('({}$DIFF)'.format(routine), code=False)
+                self.write('@SP')
+                self.write('A=M')
+                self.write('D=M')
+            self.write('@R14')
+            self.write('D=D-M')
+            self.write('@{}$TRUE'.format(routine))
+            self.write(self.operations[operation])
+            self.write('({}$FALSE)'.format(routine), code=False)
+            self.write('D=0')
+            self.write('@{}$END'.format(routine))
+            self.write('0;JMP')
+            self.write('({}$TRUE)'.format(routine), code=False)
+            self.write('D=-1')
+            self.write('({}$END)'.format(routine), code=False)
+            self.write('@SP')
+            self.write('A=M')
             self.write('M=D')
-            offset += 1
+            self.write('@R13')
+            self.write('A=M')
+            self.write('0;JMP')
+
+    def write_return(self):
+        self.spill()
+        if self.trampoline:
+            self.write('@$$RETURN')
+            self.write('0;JMP')
+        else:
+            self.write_return_body()
+
+    def write_return_body(self):
+        self.write_all(RETURN_CODE)
+
+    def command_table(self, program):
+        '''
+        the writer of every opcode, called with the index of a command in program
+        '''
+        segments, numbers = program.segments, program.numbers
+        symbols, names = program.symbols, program.names
+        table = []
+        for command in OPERATIONS:
+            kind = COMMAND_TYPES[command]
+            if kind == 'C_PP':
+                write = lambda i, command=command: self.write_push_pop(command, ALL_SEGMENTS[segments[i]], numbers[i])
+            elif kind == 'C_ARITHMETIC':
+                write = lambda i, command=command: self.write_arithmetic(command)
+            elif kind == 'C_BRANCH':
+                write = lambda i, command=command: self.write_branch(command, symbols[names[i]])
+            elif kind == 'C_FUNCTION':
+                write = lambda i, command=command: self.write_function(command, symbols[names[i]], str(numbers[i]))
+            else:
+                write = lambda i: self.write_return()
+            table.append(write)
+        return table
+
+    def plain_code(self, opcode, segment, number):
+        '''
+        the instructions of a command that only depend on the command, None for the others
+        '''
+        if self.cache_top:
+            return None
+        command = OPERATIONS[opcode]
+        if COMMAND_TYPES[command] == 'C_PP':
+            segment = ALL_SEGMENTS[segment]
+            return push_pop_code(command, segment, number, self.curr_file if segment == 'static' else '')
+        return self.arithmetic.get(command)
+
+    def write_program(self, program):
+        table = self.command_table(program)
+        if self.stats.enabled:
+            with self.stats.phase('generate'):
+                self.write_program_stats(program, table)
+            return
+        # the code and the comment of every distinct command are made once
+        commands = Memo(lambda row: (self.plain_code(*row[:3]), self.comment(program, row)))
+        opcodes = program.opcodes
+        # write_text empties self.lines and self.notes in place
+        lines, notes = self.lines, self.notes
+        buffered = self.buffer is not None
+        for i, (code, comment) in enumerate(map(commands.__getitem__, program.rows())):
+            if comment is None:
+                pass
+            elif buffered:
+                self.write(comment, code=False)
+            else:
+                notes.append((len(lines), comment))
+            if len(lines) >= FLUSH_LINES:
+                self.write_lines()
+            if code is None:
+                table[opcodes[i]](i)
+            elif buffered:
+                self.write_all(code)
+            else:
+                lines.extend(code)
+
+    def comment(self, program, row):
+        '''
+        the // <vm command> comment of a command, None when they are left out
+        '''
+        if self.comments:
+            return '// ' + ' '.join(program.row_words(row))
+        return None
+
+    def write_program_stats(self, program, table):
+        '''
+        write_program counting every command and the instructions written for it,
+        before the peephole pass
+        '''
+        opcodes = program.opcodes
+        for i in range(len(program)):
+            if self.comments:
+                self.write('// ' + ' '.join(program.words(i)), code=False)
+            if len(self.lines) >= FLUSH_LINES:
+                self.write_lines()
+            if self.buffer is not None:
+                start = len(self.buffer)
+                table[opcodes[i]](i)
+                count = sum(1 for command, code in self.buffer[start:] if code)
+            else:
+                # write_lines may run in between, it adds what it writes to line_count
+                start = self.line_count + len(self.lines)
+                table[opcodes[i]](i)
+                count = self.line_count + len(self.lines) - start
+            self.stats.add_command(OPERATIONS[opcodes[i]], count)
 
-        # gotp RES
-        self.write('@' + RES)
-        self.write('A=M')
-        self.write('0;JMP')
-        
     def push_D_to_stack(self):
-        self.write('@SP')
-        self.write('A=M')
-        self.write('M=D')
-        self.increase_SP()
+        self.write_all(('@SP', 'A=M', 'M=D', '@SP', 'M=M+1'))
 
     def increase_SP(self):
-        self.write('@SP')
-        self.write('M=M+1')
+        self.write_all(('@SP', 'M=M+1'))
 
-    def decrease_SP(self):
-        self.write('@SP')
-        self.write('M=M-1')
+    def spill(self):
+        '''
+        write a cached top back to the stack before code that expects it there
+        '''
+        if self.top_in_D:
+            self.top_in_D = False
+            self.push_D_to_stack()
+
+    def load_top(self):
+        if not self.top_in_D:
+            self.write_all(('@SP', 'AM=M-1', 'D=M'))
+            self.top_in_D = True
 
-    def pop_from_stack(self):
-        self.decrease_SP()
-        self.write('A=M')
-    
-    def call_SP(self):
-        self.write('@SP')
-        self.write('A=M')
-    
     def write(self, command, code=True):
-        self.asm.write(command)
+        if self.buffer is not None:
+            self.buffer.append((command, code))
+        elif code:
+            self.lines.append(command)
+        else:
+            self.emit(command, code)
+
+    def write_all(self, commands):
+        '''
+        write a run of instructions with one call
+        '''
+        if self.buffer is not None:
+            self.buffer.extend([(command, True) for command in commands])
+        else:
+            self.lines.extend(commands)
+
+    def emit(self, command, code=True):
         if code:
-            self.asm.write(' // ' + str(self.line_count))
-            self.line_count += 1
-        self.asm.write('\n')
+            self.lines.append(command)
+        elif command[0] == '(' or self.comments:
+            self.notes.append((len(self.lines), command))
+
+    def write_lines(self):
+        '''
+        hand the held lines to the file in one go, numbering the instructions
+        '''
+        if self.stats.enabled:
+            with self.stats.phase('write'):
+                self.stats.add_bytes(self.write_text())
+        else:
+            self.write_text()
+
+    def write_text(self):
+        '''
+        returns the number of characters written
+        '''
+        lines = self.lines
+        pieces = []
+        if self.numbers:
+            prefixes, digits = number_endings(self.line_count)
+            endings = list(islice(digits, len(lines)))
+        # a label or comment goes on the end of the instruction before it
+        for before, note in self.notes:
+            if not before:
+                pieces.append(note + '\n')
+            elif self.numbers:
+                endings[before - 1] += note + '\n'
+            else:
+                lines[before - 1] += '\n' + note
+        if self.numbers:
+            pieces.extend(chain.from_iterable(zip(lines, prefixes, endings)))
+        elif lines:
+            pieces.extend(('\n'.join(lines), '\n'))
+        text = ''.join(pieces)
+        if text:
+            self.asm.write(text)
+        self.line_count += len(lines)
+        del lines[:]
+        del self.notes[:]
+        return len(text)
+
+    def write_fragment(self, text, count, saved=None, start=0):
+        '''
+        add the output of another CodeWriter, numbered from start, after everything so far
+        returns the text as written and the number it starts from now
+        '''
+        self.flush()
+        offset = self.line_count - start
+        if offset and self.numbers:
+            text = re.sub(r' // (\d+)$', lambda match: ' // ' + str(int(match.group(1)) + offset), text, flags=re.M)
+        with self.stats.phase('write'):
+            self.asm.write(text)
+        if self.stats.enabled:
+            self.stats.add_bytes(len(text))
+        start = self.line_count
+        self.line_count += count
+        if saved:
+            for name, value in saved.items():
+                self.peephole.saved[name] += value
+        return text, start
+
+    def flush(self):
+        self.spill()
+        if self.buffer:
+            with self.stats.phase('peephole'):
+                lines = self.peephole.optimize(self.buffer)
+            for command, code in lines:
+                self.emit(command, code)
+            self.buffer = []
+        self.write_lines()
 
     def close(self):
-        self.asm.close()
+        self.spill()
+        if self.trampoline or self.shared_compare:
+            self.write('//////', code=False)
+            # stop a program that runs off its end from falling into the routines
+            self.write('($$HALT)', code=False)
+            self.write('@$$HALT')
+            self.write('0;JMP')
+        if self.trampoline:
+            self.write_trampolines()
+        if self.shared_compare:
+            self.write_compare_routines()
+        self.flush()
+        if self.close_asm:
+            self.asm.close()
 
 class Main(object):
-    def __init__(self, file_path):
-        self.Parse_file(file_path)
-        self.cw = CodeWriter(self.asm_file)
-        self.cw.write_init()
-        for vm_file in self.vm_files:
-            self.translate(vm_file)
-        self.cw.close()
+    def __init__(self, file_path, bootstrap=True, jobs=1, cache=None, whole_program=False, inline=False,
+                 stats=None, **options):
+        # time spent outside every other phase counts as other
+        self.stats = stats if stats is not None else NO_STATS
+        with self.stats.phase('other'):
+            self.Parse_file(file_path)
+            self.cw = CodeWriter(self.asm_file, stats=stats, **options)
+            self.optimizer = VMOptimizer(inline) if whole_program or inline else None
+            if bootstrap:
+                self.cw.write_init()
+            if self.optimizer is not None:
+                with self.stats.phase('optimize'):
+                    sources = optimize_sources(self.vm_files, self.optimizer)
+                write_sources(self.cw, sources, jobs, cache)
+            elif jobs > 1 or cache is not None:
+                write_sources(self.cw, self.vm_files, jobs, cache)
+            else:
+                for vm_file in self.vm_files:
+                    self.translate(vm_file)
+            self.cw.close()
 
     def Parse_file(self, file_path):
-        if '.vm' in file_path:
-            self.asm_file = file_path.replace('.vm', '.asm')
-            self.vm_files = [file_path]
-        else:
-            file_path = file_path[:-1] if file_path[-1] == '/' else file_path
-            path_elements = file_path.split('\\')
-            path = '/'.join(path_elements)
-            self.asm_file = path + '/' + path_elements[-1] + '.asm'
-            dirpaths, dirnames, filenames = next(os.walk(file_path), [[], [], []])
-            vm_files = filter(lambda x: '.vm' in x, filenames)
-            self.vm_files = [path + '/' + vm_file for vm_file in vm_files]
+        with self.stats.phase('scan'):
+            self.asm_file, self.vm_files = find_vm_files(file_path)
 
     def translate(self, vm_file):
-        parser = Parser(vm_file)
-        self.cw.set_file_name(vm_file)
-        while parser.has_next_instruction:
-            parser.next()
-            self.cw.write('// ' + ' '.join(parser.curr_instruction), code=False)
-            if parser.command_type == 'C_PP':
-                self.cw.write_push_pop(parser.curr_instruction[0], parser.curr_instruction[1], parser.curr_instruction[2])
-            elif parser.command_type == 'C_ARITHMETIC':
-                self.cw.write_arithmetic(parser.curr_instruction[0])
-            elif parser.command_type == 'C_BRANCH':
-                self.cw.write_branch(parser.curr_instruction[0], parser.curr_instruction[1])
-            elif parser.command_type == 'C_FUNCTION':
-                self.cw.write_function(parser.curr_instruction[0], parser.curr_instruction[1], parser.curr_instruction[2])
-            elif parser.command_type == 'C_RETURN':
-                self.cw.write_return()
-        parser.close()
+        translate_vm(self.cw, vm_file, vm_file)
+
+def find_vm_files(file_path):
+    '''
+    the .asm file to write and the .vm files to read for a file or directory
+    '''
+    if '.vm' in file_path:
+        return file_path.replace('.vm', '.asm'), [file_path]
+    file_path = file_path[:-1] if file_path[-1] in '/\\' else file_path
+    path = '/'.join(file_path.split('\\'))
+    asm_file = path + '/' + path.split('/')[-1] + '.asm'
+    dirpaths, dirnames, filenames = next(os.walk(file_path), [[], [], []])
+    vm_files = filter(lambda x: '.vm' in x, sorted(filenames))
+    return asm_file, [path + '/' + vm_file for vm_file in vm_files]
+
+def translate_vm(cw, name, vm_file):
+    '''
+    write every command of one .vm path or stream through cw
+    '''
+    with cw.stats.phase('parse'):
+        program = read_vm(vm_file)
+    write_vm_program(cw, name, program)
+
+def write_vm_program(cw, name, program):
+    if cw.folder is not None:
+        with cw.stats.phase('fold'):
+            program = cw.folder.fold(program)
+    cw.set_file_name(name)
+    cw.write_program(program)
+
+def source_program(source):
+    '''
+    (name, VMProgram) of a .vm path, a (name, vm text) pair or a (name, VMProgram) pair
+    '''
+    if isinstance(source, str):
+        return source, read_vm(source)
+    name, program = source
+    if isinstance(program, str):
+        program = read_vm(io.StringIO(program))
+    return name, program
+
+def source_text(source):
+    '''
+    (name, vm text) of a source, what its cached fragment is keyed by
+    '''
+    if isinstance(source, str):
+        with open(source, 'r') as vm:
+            return source, vm.read()
+    name, program = source
+    return name, program if isinstance(program, str) else program.text()
+
+def optimize_sources(sources, optimizer):
+    '''
+    run the whole-program passes of optimizer over all sources at once,
+    returns (name, VMProgram) pairs for the files that still have commands
+    '''
+    return optimizer.optimize([source_program(source) for source in sources])
+
+def translate_fragment(source, options):
+    '''
+    one source on a CodeWriter of its own, in a worker
+    returns the asm text, its instruction count, the peephole savings and
+    the number its instructions start from
+    '''
+    name, program = source_program(source)
+    return program_fragment(name, program, options)
+
+def program_fragment(name, program, options):
+    '''
+    translate_fragment of a VMProgram that is already parsed
+    '''
+    asm = io.StringIO()
+    cw = CodeWriter(asm, **options)
+    write_vm_program(cw, name, program)
+    cw.flush()
+    return asm.getvalue(), cw.line_count, cw.peephole.saved if cw.peephole else None, 0
+
+def translate_fragments(sources, options, jobs=1):
+    if jobs > 1 and len(sources) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(translate_fragment, sources, repeat(options)))
+    return [translate_fragment(source, options) for source in sources]
+
+def translate_parallel(cw, sources, jobs):
+    '''
+    translate every source in its own process, appended to cw in the given order
+    '''
+    for fragment in translate_fragments(sources, cw.options, jobs):
+        cw.write_fragment(*fragment)
+
+@lru_cache(maxsize=1)
+def translator_digest():
+    '''
+    the code the fragments come from, so a changed translator misses the cache,
+    read once per process
+    '''
+    digest = hashlib.sha1()
+    for module in [__file__, sys.modules[Peephole.__module__].__file__,
+                   sys.modules[VMProgram.__module__].__file__, sys.modules[VMOptimizer.__module__].__file__]:
+        with open(module, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+def fragment_key(name, text, options):
+    curr_file = name.replace('.vm', '').split('/')[-1]
+    key = json.dumps([curr_file, text, sorted(options.items()), translator_digest()])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def translate_cached(cw, sources, cache_dir, jobs=1):
+    '''
+    reuse the stored fragment of every file whose name, content and options
+    were translated before, translate and store only the rest
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    pairs = [source_text(source) for source in sources]
+    paths = [os.path.join(cache_dir, fragment_key(name, text, cw.options) + '.json') for name, text in pairs]
+    fragments = []
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'r') as cached:
+                fragments.append(json.load(cached))
+        else:
+            fragments.append(None)
+    missing = [index for index, fragment in enumerate(fragments) if fragment is None]
+    # peephole savings count only for what is translated now, a stored fragment keeps none
+    saved = {}
+    for index, fragment in zip(missing, translate_fragments([sources[index] for index in missing], cw.options, jobs)):
+        text, count, saved[index], start = fragment
+        fragment = [text, count, None, start]
+        with open(paths[index], 'w') as cached:
+            json.dump(fragment, cached)
+        fragments[index] = fragment
+    for index, (path, fragment) in enumerate(zip(paths, fragments)):
+        text, start = cw.write_fragment(fragment[0], fragment[1], saved.get(index), fragment[3])
+        if start != fragment[3]:
+            # keep it numbered the way it was last linked
+            with open(path, 'w') as cached:
+                json.dump([text, fragment[1], None, start], cached)
+    return len(missing)
+
+def write_sources(cw, sources, jobs=1, cache=None):
+    sources = list(sources)
+    if cache is not None:
+        translate_cached(cw, sources, cache, jobs)
+    elif jobs > 1 and len(sources) > 1:
+        translate_parallel(cw, sources, jobs)
+    else:
+        for source in sources:
+            if isinstance(source, str):
+                translate_vm(cw, source, source)
+            else:
+                with cw.stats.phase('parse'):
+                    name, program = source_program(source)
+                write_vm_program(cw, name, program)
+
+def translate(sources, assemble=False, bootstrap=True, jobs=1, cache=None, whole_program=False, inline=False,
+              stats=None, **options):
+    '''
+    translate without touching the disk for output
+    sources: a .vm file or directory path, or an iterable of .vm paths,
+             (name, vm text) and (name, VMProgram) pairs
+    stats: a Stats to record the translation in
+    returns the .asm lines, or the machine code as bytes if assemble is set
+    '''
+    if isinstance(sources, str):
+        sources = find_vm_files(sources)[1]
+    if whole_program or inline:
+        with (stats or NO_STATS).phase('optimize'):
+            sources = optimize_sources(sources, VMOptimizer(inline))
+    asm = io.StringIO()
+    cw = CodeWriter(asm, stats=stats, **options)
+    if bootstrap:
+        cw.write_init()
+    write_sources(cw, sources, jobs, cache)
+    cw.close()
+    lines = asm.getvalue().splitlines()
+    if assemble:
+        return Assembler(lines).binary()
+    return lines
+
+# the shared routines at the end of a translation, by their label
+ROUTINES = ('$$CALL', '$$RETURN', '$$EQ', '$$LT', '$$GT', '$$HALT')
+
+def source_map(lines, vm_files=()):
+    '''
+    the instruction ranges of every translated VM command, read back from the
+    // <vm command> and file comments of a translation, so comments must be on
+    one dict per command: start and end pc, file, line, function, command
+    code outside any command (the bootstrap, shared routines) gets the
+    function $$INIT or the routine's $$ label and no file
+    line is the command's line in its .vm file when that is among vm_files,
+    found by matching the commands in order, so commands the optimizer wrote
+    get None
+    '''
+    # file -> (command text -> its indexes in the file, line of every index)
+    sources = {}
+    for vm_file in vm_files:
+        name = vm_file.replace('.vm', '').split('/')[-1]
+        program = read_vm(vm_file)
+        positions = {}
+        for i in range(len(program)):
+            positions.setdefault(' '.join(program.words(i)), []).append(i)
+        sources[name] = (positions, command_lines(vm_file))
+    entries = []
+    curr_file, function, command, index = None, '$$INIT', None, -1
+    new_file = False
+    pc = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(COMMENT):
+            text = line[len(COMMENT):].strip()
+            if text == '////':
+                new_file = True
+            elif new_file:
+                new_file = False
+                curr_file, function, command, index = text, None, None, -1
+            else:
+                command = text
+                index += 1
+                if text.startswith('function '):
+                    function = text.split()[1]
+            continue
+        new_file = False
+        if line[0] == '(':
+            label = line[1:-1]
+            routine = label if label in ROUTINES else label.rsplit('$', 1)[0]
+            if routine in ROUTINES and (label == routine or function != routine):
+                # a shared routine, $$LT$Y is a second way into $$LT
+                curr_file, function, command = None, routine, None if label == routine else label
+            continue
+        key = (curr_file, function, command, index)
+        if entries and entries[-1]['key'] == key and entries[-1]['end'] == pc:
+            entries[-1]['end'] = pc + 1
+        else:
+            entries.append(dict(key=key, start=pc, end=pc + 1, file=curr_file,
+                                line=None, function=function, command=command))
+        pc += 1
+    # file -> the next source command to match, translated index -> line
+    cursors = dict((name, 0) for name in sources)
+    lines_found = {}
+    for entry in entries:
+        curr_file, function, command, index = key = entry.pop('key')
+        if curr_file not in sources or command is None:
+            continue
+        if key not in lines_found:
+            positions, numbers = sources[curr_file]
+            candidates = positions.get(command, [])
+            i = bisect_left(candidates, cursors[curr_file])
+            if i < len(candidates):
+                lines_found[key] = numbers[candidates[i]]
+                cursors[curr_file] = candidates[i] + 1
+            else:
+                lines_found[key] = None
+        entry['line'] = lines_found[key]
+    return entries
 
 if __name__ == '__main__':
-    import sys
-    file_path = sys.argv[1]
-    Main(file_path)
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Translate VM code into Hack assembly')
+    arg_parser.add_argument('file_path', help='a .vm file or a directory of .vm files')
+    arg_parser.add_argument('--trampoline', action='store_true',
+                            help='emit one shared $$CALL/$$RETURN routine instead of inlining every call and return')
+    arg_parser.add_argument('--optimize', action='store_true',
+                            help='run a peephole pass over the generated instructions and report the savings')
+    arg_parser.add_argument('--cache-top', action='store_true',
+                            help='keep the top of the stack in D, spilling it only at labels, branches, calls and returns')
+    arg_parser.add_argument('--fold', action='store_true',
+                            help='fold constant expressions and turn compare + if-goto into one conditional jump')
+    arg_parser.add_argument('--shared-compare', action='store_true',
+                            help='call one overflow-safe $$EQ/$$LT/$$GT routine instead of inlining every eq, lt and gt')
+    arg_parser.add_argument('--jobs', type=int, default=1,
+                            help='translate the files of a directory in this many processes')
+    arg_parser.add_argument('--cache', metavar='DIR',
+                            help='keep every file\'s translation in DIR and only retranslate changed files')
+    arg_parser.add_argument('--no-numbers', action='store_true',
+                            help='leave out the // N instruction numbers')
+    arg_parser.add_argument('--no-comments', action='store_true',
+                            help='leave out the // <vm command> and file comments')
+    arg_parser.add_argument('--whole-program', action='store_true',
+                            help='leave out the functions Sys.init never reaches')
+    arg_parser.add_argument('--inline', action='store_true',
+                            help='also replace calls to small leaf functions by their body, implies --whole-program')
+    arg_parser.add_argument('--no-bootstrap', action='store_true',
+                            help='leave out the SP=256 / call Sys.init bootstrap code')
+    arg_parser.add_argument('--stats', action='store_true',
+                            help='report the time of every phase, commands and instructions per kind and bytes written')
+    arg_parser.add_argument('--source-map', action='store_true',
+                            help='also write a .map.json file with the instruction range of every VM command')
+    args = arg_parser.parse_args()
+    if args.source_map and args.no_comments:
+        arg_parser.error('--source-map reads the comments that --no-comments leaves out')
+    main = Main(args.file_path, bootstrap=not args.no_bootstrap, jobs=args.jobs, cache=args.cache,
+                whole_program=args.whole_program, inline=args.inline, stats=Stats() if args.stats else None,
+                numbers=not args.no_numbers, comments=not args.no_comments, trampoline=args.trampoline, optimize=args.optimize, cache_top=args.cache_top,
+                fold=args.fold, shared_compare=args.shared_compare)
+    if args.optimize:
+        for line in main.cw.peephole.report():
+            print(line, file=sys.stderr)
+    if main.cw.folder is not None and args.jobs == 1:
+        # the other processes keep their own counts
+        print(main.cw.folder.report()[-1], file=sys.stderr)
+    if main.optimizer is not None:
+        for line in main.optimizer.report():
+            print(line, file=sys.stderr)
+    if args.stats:
+        for line in main.stats.report():
+            print(line, file=sys.stderr)
+    if args.source_map:
+        with open(main.asm_file, 'r') as asm:
+            entries = source_map(asm, main.vm_files)
+        with open(main.asm_file.replace('.asm', '.map.json'), 'w') as map_file:
+            json.dump(entries, map_file, indent=1)
@@ -0,0 +1,362 @@
+import io
+import json
+import os
+import selectors
+import socket
+import sys
+import time
+
+from VMOptimizer import VMOptimizer
+from VMProgram import read_vm
+from VMTranslator import CodeWriter, find_vm_files, program_fragment
+
+# seconds between looks at the watched files
+INTERVAL = 0.2
+# what a request may set, and the default of each
+OPTIONS = dict(bootstrap=True, whole_program=False, inline=False, trampoline=False, optimize=False,
+               cache_top=False, fold=False, shared_compare=False, numbers=True, comments=True)
+
+class Project(object):
+    '''
+    the warm state of one .vm file or directory under one set of options:
+    the text and VMProgram of every .vm file, and the translated fragment
+    of every file as the CodeWriter wrote it
+    build() stats the files and rereads, reparses and retranslates only the
+    ones that changed, then links all the fragments into the .asm file
+    with --whole-program or --inline the optimizer runs over all files on
+    every change, only the files whose optimized code changed are retranslated
+    '''
+    def __init__(self, file_path, bootstrap=True, whole_program=False, inline=False, **options):
+        self.file_path = file_path
+        self.bootstrap = bootstrap
+        self.whole_program = whole_program or inline
+        self.inline = inline
+        self.options = options
+        # path -> dict(stamp, text, program, error)
+        self.files = {}
+        self.vm_files = []
+        # (file name, vm text) -> (asm text, instructions, peephole savings, start)
+        self.fragments = {}
+        self.asm_file = None
+        self.linked = None
+        self.builds = 0
+
+    def scan(self):
+        '''
+        the paths that are new or changed since the last scan, and the removed ones
+        '''
+        self.asm_file, vm_files = find_vm_files(self.file_path)
+        changed = []
+        for path in vm_files:
+            stat = os.stat(path)
+            stamp = stat.st_mtime_ns, stat.st_size
+            known = self.files.get(path)
+            if known is not None and known['stamp'] == stamp:
+                continue
+            with open(path, 'r') as vm:
+                text = vm.read()
+            if known is not None and known['text'] == text:
+                known['stamp'] = stamp
+                continue
+            changed.append(path)
+            entry = dict(stamp=stamp, text=text, program=None, error=None)
+            try:
+                entry['program'] = read_vm(io.StringIO(text))
+            except ValueError as error:
+                # kept until the next save, the build fails until then
+                entry['error'] = '{}: {}'.format(path, error)
+            self.files[path] = entry
+        removed = [path for path in self.files if path not in vm_files]
+        for path in removed:
+            del self.files[path]
+        self.vm_files = vm_files
+        return changed, removed
+
+    def sources(self):
+        '''
+        (name, VMProgram, fragment key) for every file, in link order
+        '''
+        programs = [(path, self.files[path]['program']) for path in self.vm_files]
+        if not self.whole_program:
+            return [(path, program, (path, self.files[path]['text'])) for path, program in programs]
+        optimized = VMOptimizer(self.inline).optimize(programs)
+        return [(path, program, (path, program.text())) for path, program in optimized]
+
+    def build(self, force=False):
+        '''
+        bring the .asm file up to date, returns what was done as a dict
+        '''
+        start = time.perf_counter()
+        result = dict(path=self.file_path, asm=None, changed=[], removed=[], translated=0,
+                      linked=False, instructions=None, error=None)
+        try:
+            changed, removed = self.scan()
+        except OSError as error:
+            result['error'] = str(error)
+            return self.finish(result, start)
+        result.update(asm=self.asm_file, changed=changed, removed=removed)
+        errors = [self.files[path]['error'] for path in self.vm_files if self.files[path]['error']]
+        if errors:
+            result['error'] = '\n'.join(errors)
+            return self.finish(result, start)
+        if not (changed or removed or force) and self.linked is not None:
+            result['instructions'] = self.linked
+            return self.finish(result, start)
+        try:
+            sources = self.sources()
+            fragments = {}
+            for name, program, key in sources:
+                if key not in self.fragments:
+                    self.fragments[key] = program_fragment(name, program, self.options)
+                    result['translated'] += 1
+                fragments[key] = self.fragments[key]
+            # the fragments of old versions of files go
+            self.fragments = fragments
+            text, count = self.link([key for name, program, key in sources])
+        except ValueError as error:
+            result['error'] = str(error)
+            return self.finish(result, start)
+        try:
+            with open(self.asm_file, 'w') as asm:
+                asm.write(text)
+        except OSError as error:
+            # nothing is linked until a write goes through, the next build tries again
+            self.linked = None
+            result['error'] = str(error)
+            return self.finish(result, start)
+        self.linked = count
+        result.update(linked=True, instructions=self.linked)
+        self.builds += 1
+        return self.finish(result, start)
+
+    def finish(self, result, start):
+        result['ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return result
+
+    def link(self, keys):
+        '''
+        the bootstrap, the fragments in order and the shared routines as one .asm text,
+        and its instruction count
+        '''
+        asm = io.StringIO()
+        cw = CodeWriter(asm, **self.options)
+        if self.bootstrap:
+            cw.write_init()
+        for key in keys:
+            text, count, saved, start = self.fragments[key]
+            text, start = cw.write_fragment(text, count, saved, start)
+            # renumbered now, not again while it stays where it is
+            self.fragments[key] = text, count, saved, start
+        cw.close()
+        return asm.getvalue(), cw.line_count
+
+    def status(self):
+        return dict(path=self.file_path, asm=self.asm_file, files=len(self.files), builds=self.builds,
+                    instructions=self.linked, options=self.settings())
+
+    def settings(self):
+        settings = dict(self.options, bootstrap=self.bootstrap, whole_program=self.whole_program, inline=self.inline)
+        return dict((name, settings.get(name, default)) for name, default in OPTIONS.items())
+
+def project_options(options):
+    '''
+    the full option dict of a request, ValueError for anything unknown
+    '''
+    unknown = set(options) - set(OPTIONS)
+    if unknown:
+        raise ValueError('unknown options: {}'.format(', '.join(sorted(unknown))))
+    return dict((name, bool(options.get(name, default))) for name, default in OPTIONS.items())
+
+class Daemon(object):
+    '''
+    Projects kept warm between requests, one per path and options
+    a request is one line of JSON, its answer one line of JSON with the
+    same "id" if the request had one:
+    {"command": "build", "path": "FunctionCalls/FibonacciElement", "options": {"fold": true}, "force": false}
+    {"command": "watch", "path": ..., "options": ...}  build now and again whenever a file changes
+    {"command": "forget", "path": ..., "options": ...}
+    {"command": "status"}
+    {"command": "stop"}
+    a watched project that is rebuilt sends {"event": "build", ...} to every listener
+    '''
+    def __init__(self):
+        self.projects = {}
+        self.watched = set()
+        self.running = True
+        # called with every event line
+        self.listeners = []
+
+    def project(self, request):
+        options = project_options(request.get('options', {}))
+        key = os.path.abspath(request['path']), tuple(sorted(options.items()))
+        if key not in self.projects:
+            self.projects[key] = Project(request['path'], **options)
+        return key, self.projects[key]
+
+    def handle(self, request):
+        command = request.get('command')
+        if command in ('build', 'watch'):
+            key, project = self.project(request)
+            if command == 'watch':
+                self.watched.add(key)
+            return project.build(request.get('force', False))
+        elif command == 'forget':
+            key, project = self.project(request)
+            self.watched.discard(key)
+            del self.projects[key]
+            return dict(forgotten=project.file_path)
+        elif command == 'status':
+            return dict(projects=[project.status() for key, project in sorted(self.projects.items())],
+                        watched=[project.file_path for key, project in sorted(self.projects.items())
+                                 if key in self.watched])
+        elif command == 'stop':
+            self.running = False
+            return dict(stopped=True)
+        raise ValueError('unknown command: {}'.format(command))
+
+    def answer(self, line):
+        '''
+        the answer line to a request line
+        '''
+        request = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a request is a JSON object')
+            response = self.handle(request)
+        except Exception as error:
+            # every request gets an answer, a client waiting for it would hang
+            response = dict(error='{}: {}'.format(type(error).__name__, error))
+        if 'id' in request:
+            response['id'] = request['id']
+        return json.dumps(response)
+
+    def poll(self):
+        '''
+        rebuild the watched projects with changed files, tell the listeners
+        '''
+        for key in sorted(self.watched):
+            result = self.projects[key].build()
+            if result['changed'] or result['removed']:
+                result['event'] = 'build'
+                line = json.dumps(result)
+                for listener in self.listeners:
+                    listener(line)
+
+def serve(daemon, port=None, stdin=True, interval=INTERVAL):
+    '''
+    answer request lines from stdin and from clients of 127.0.0.1:port,
+    polling the watched projects every interval seconds in between
+    '''
+    selector = selectors.DefaultSelector()
+    # fd or socket -> bytes read that do not make a whole line yet
+    pending = {}
+    clients = []
+    daemon.listeners.append(lambda line: print(line, flush=True))
+    if stdin:
+        fd = sys.stdin.fileno()
+        selector.register(fd, selectors.EVENT_READ, 'stdin')
+        pending[fd] = b''
+    if port is not None:
+        server = socket.create_server(('127.0.0.1', port))
+        selector.register(server, selectors.EVENT_READ, 'accept')
+        def broadcast(line):
+            for client in list(clients):
+                try:
+                    client.sendall(line.encode() + b'\n')
+                except OSError:
+                    pass
+        daemon.listeners.append(broadcast)
+    try:
+        while daemon.running:
+            for key, events in selector.select(interval):
+                if key.data == 'accept':
+                    client, address = key.fileobj.accept()
+                    selector.register(client, selectors.EVENT_READ, 'client')
+                    pending[client] = b''
+                    clients.append(client)
+                    continue
+                if key.data == 'stdin':
+                    source = key.fileobj
+                    data = os.read(source, 65536)
+                    reply = lambda line: print(line, flush=True)
+                else:
+                    source = key.fileobj
+                    try:
+                        data = source.recv(65536)
+                    except OSError:
+                        data = b''
+                    reply = lambda line, client=source: client.sendall(line.encode() + b'\n')
+                if not data:
+                    selector.unregister(source)
+                    del pending[source]
+                    if key.data == 'stdin':
+                        # the editor went away
+                        daemon.running = False
+                    else:
+                        clients.remove(source)
+                        source.close()
+                    continue
+                lines = (pending[source] + data).split(b'\n')
+                pending[source] = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        try:
+                            reply(daemon.answer(line.decode()))
+                        except OSError:
+                            pass
+                if not daemon.running:
+                    break
+            daemon.poll()
+    finally:
+        for client in clients:
+            client.close()
+        selector.close()
+
+def request(port, message, timeout=60.0):
+    '''
+    send one request to a daemon on 127.0.0.1:port, returns its answer,
+    skipping the build events of watched projects that come before it
+    '''
+    with socket.create_connection(('127.0.0.1', port), timeout) as connection:
+        connection.sendall(json.dumps(message).encode() + b'\n')
+        reader = connection.makefile('r')
+        for line in reader:
+            answer = json.loads(line)
+            if 'event' not in answer:
+                return answer
+    raise ValueError('the daemon closed the connection')
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description='Keep VM translations warm and rebuild them as the .vm files change')
+    arg_parser.add_argument('paths', nargs='*', help='.vm files or directories to watch from the start')
+    arg_parser.add_argument('--port', type=int,
+                            help='also take requests on 127.0.0.1:PORT')
+    arg_parser.add_argument('--no-stdin', action='store_true',
+                            help='do not read requests from stdin, e.g. when run in the background')
+    arg_parser.add_argument('--interval', type=float, default=INTERVAL,
+                            help='seconds between looks at the watched files')
+    arg_parser.add_argument('--send', metavar='JSON',
+                            help='send one request to the daemon on --port, print the answer and exit')
+    arg_parser.add_argument('--no-bootstrap', action='store_true',
+                            help='translate the watched paths without the bootstrap code')
+    for flag in ['--trampoline', '--optimize', '--cache-top', '--fold', '--shared-compare',
+                 '--whole-program', '--inline', '--no-numbers', '--no-comments']:
+        arg_parser.add_argument(flag, action='store_true', help='translate the watched paths with VMTranslator.py ' + flag)
+    args = arg_parser.parse_args()
+    if args.send is not None:
+        if args.port is None:
+            arg_parser.error('--send needs the --port of the daemon')
+        print(json.dumps(request(args.port, json.loads(args.send))))
+        sys.exit(0)
+    if args.no_stdin and args.port is None:
+        arg_parser.error('with --no-stdin there is no way to reach the daemon but --port')
+    options = dict(bootstrap=not args.no_bootstrap, trampoline=args.trampoline, optimize=args.optimize,
+                   cache_top=args.cache_top, fold=args.fold, shared_compare=args.shared_compare,
+                   whole_program=args.whole_program, inline=args.inline, numbers=not args.no_numbers,
+                   comments=not args.no_comments)
+    daemon = Daemon()
+    for path in args.paths:
+        print(daemon.answer(json.dumps(dict(command='watch', path=path, options=options))), flush=True)
+    serve(daemon, args.port, not args.no_stdin, args.interval)
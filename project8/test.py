@@ -1,2 +0,0 @@
-for x in 5:
-    print(x)
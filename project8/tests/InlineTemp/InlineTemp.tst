@@ -0,0 +1,12 @@
+// File name: project8/tests/InlineTemp/InlineTemp.tst
+
+load InlineTemp.asm,
+output-file InlineTemp.out,
+compare-to InlineTemp.cmp,
+output-list RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1;
+
+repeat 1000 {
+  ticktock;
+}
+
+output;
@@ -0,0 +1,14 @@
+// File name: project8/tests/InlineTemp/InlineTempVME.tst
+
+load,  // loads all the VM files from the current directory.
+output-file InlineTemp.out,
+compare-to InlineTemp.cmp,
+output-list RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1;
+
+set sp 256,
+
+repeat 40 {
+  vmstep;
+}
+
+output;
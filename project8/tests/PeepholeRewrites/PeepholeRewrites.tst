@@ -0,0 +1,12 @@
+// File name: project8/tests/PeepholeRewrites/PeepholeRewrites.tst
+
+load PeepholeRewrites.asm,
+output-file PeepholeRewrites.out,
+compare-to PeepholeRewrites.cmp,
+output-list RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1 RAM[9]%D1.6.1 RAM[10]%D1.6.1 RAM[11]%D1.6.1 RAM[12]%D1.6.1 RAM[16]%D1.6.1;
+
+repeat 2000 {
+  ticktock;
+}
+
+output;
@@ -0,0 +1,14 @@
+// File name: project8/tests/PeepholeRewrites/PeepholeRewritesVME.tst
+
+load,  // loads all the VM files from the current directory.
+output-file PeepholeRewrites.out,
+compare-to PeepholeRewrites.cmp,
+output-list RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1 RAM[9]%D1.6.1 RAM[10]%D1.6.1 RAM[11]%D1.6.1 RAM[12]%D1.6.1 RAM[16]%D1.6.1;
+
+set sp 256,
+
+repeat 400 {
+  vmstep;
+}
+
+output;